@@ -1,64 +1,217 @@
 import typing
+import collections
 import numpy as np
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
 import trade_environment
 
 
-def detect_turning_points(values: np.ndarray, gap: int) -> typing.Tuple[np.ndarray, np.ndarray]:
-	"""指定数列の折返しポイントの地点を検出する.
+def turning_points_kernel(values, begin: int, end: int, gap: int, indices, index_offset: int, stalkers) -> int:
+	"""values[begin:end] の折返しポイントを検出する本体、Numba があればコンパイルして使う.
+
+	折返しの判定時に直前の折返しからの区間を走査し直す代わりに、区間内の最小値と最大値の位置を逐次更新する.
+	リストでも配列でも動作する様に要素の読み書き以外の操作は行わない.
 
 	Args:
 		values: 数列.
-		gap: 折返し判定閾値、この値を超えて反転したら折返しと判断する.
+		begin: 検出開始インデックス.
+		end: 検出終了インデックス+1.
+		gap: 折返し判定閾値.
+		indices: 折返しインデックスの書き込み先、begin からの相対インデックスを index_offset から書き込む.
+		index_offset: indices への書き込み開始位置.
+		stalkers: 一定値以上距離を保って付いてくる値の書き込み先、values と同じインデックスに書き込む.
 
 	Returns:
-		(折返しインデックス, 検出途中に生成した一定値以上距離を保って付いてくる値の数列) のタプル.
+		検出した折返しポイント数.
 	"""
-	indices = []
-	stalkers = np.empty((len(values),), dtype=np.int32)
-	last_value = int(values[0])
+	count = 0
+	last_value = values[begin]
 	stalker = last_value
-	stalkers[0] = stalker
-	last_i = 0
-	for i in range(1, len(values)):
-		v = int(values[i])
+	stalkers[begin] = stalker
+	min_i = begin
+	min_v = last_value
+	max_i = begin
+	max_v = last_value
+	for i in range(begin + 1, end):
+		v = values[i]
 		up = last_value < stalker and stalker <= v
 		down = stalker < last_value and v <= stalker
 		if up or down:
-			delta_array = values[last_i:i + 1]
-			tpi = last_i + int(np.argmin(delta_array) if up else np.argmax(delta_array))
-			tpv = int(values[tpi])
-			indices.append(tpi)
-			last_i = i
-			stalker = tpv - gap if up else tpv + gap
-			# indices.append(i - 1)
-			# stalker = v - gap if up else v + gap
+			# 直前の折返しから現在までの最小値(上昇時)か最大値(下降時)の最初の位置が折返し点
+			if up:
+				tpi = i if v < min_v else min_i
+				stalker = values[tpi] - gap
+			else:
+				tpi = i if max_v < v else max_i
+				stalker = values[tpi] + gap
+			indices[index_offset + count] = tpi - begin
+			count += 1
+			min_i = i
+			min_v = v
+			max_i = i
+			max_v = v
 		else:
 			d = v - stalker
 			if d < -gap:
 				stalker = v + gap
 			elif gap < d:
 				stalker = v - gap
+			if v < min_v:
+				min_i = i
+				min_v = v
+			if max_v < v:
+				max_i = i
+				max_v = v
 		stalkers[i] = stalker
 		last_value = v
-	return np.array(indices, dtype=np.int32), stalkers
+	return count
+
+
+def turning_points_episodes_kernel(values, episode_starts, gap: int, indices, index_counts, stalkers) -> None:
+	"""複数エピソードの折返しポイントを検出する本体、Numba があればコンパイルして使う."""
+	index_offset = 0
+	for e in range(len(episode_starts) - 1):
+		count = turning_points_kernel(values, episode_starts[e], episode_starts[e + 1], gap, indices, index_offset, stalkers)
+		index_counts[e] = count
+		index_offset += count
+
+
+if njit is not None:
+	turning_points_kernel = njit(cache=True)(turning_points_kernel)
+	turning_points_episodes_kernel = njit(cache=True)(turning_points_episodes_kernel)
+
+
+def detect_turning_points(values: np.ndarray, gap: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+	"""指定数列の折返しポイントの地点を検出する.
+
+	Args:
+		values: 数列.
+		gap: 折返し判定閾値、この値を超えて反転したら折返しと判断する.
+
+	Returns:
+		(折返しインデックス, 検出途中に生成した一定値以上距離を保って付いてくる値の数列) のタプル.
+	"""
+	n = len(values)
+	if njit is not None:
+		indices = np.empty((n,), dtype=np.int32)
+		stalkers = np.empty((n,), dtype=np.int32)
+		count = turning_points_kernel(np.asarray(values), 0, n, int(gap), indices, 0, stalkers)
+		return indices[:count].copy(), stalkers
+	else:
+		indices = [0] * n
+		stalkers = [0] * n
+		count = turning_points_kernel(np.asarray(values).tolist(), 0, n, int(gap), indices, 0, stalkers)
+		return np.array(indices[:count], dtype=np.int32), np.array(stalkers, dtype=np.int32)
+
+
+def detect_turning_points_episodes(values: np.ndarray, episode_starts: np.ndarray,
+                                   gap: int) -> typing.Tuple[typing.List[np.ndarray], np.ndarray]:
+	"""複数エピソードの折返しポイントを一括で検出する.
+
+	Args:
+		values: 全エピソードを含む数列.
+		episode_starts: エピソードの開始インデックス列、values[episode_starts[i]:episode_starts[i + 1]] が i 番目のエピソード.
+		gap: 折返し判定閾値.
+
+	Returns:
+		(エピソード毎のエピソード内折返しインデックスのリスト, 検出途中に生成した一定値以上距離を保って付いてくる値の数列) のタプル、
+		後者は values と同じインデックスで、エピソード外の値は不定.
+	"""
+	episode_starts = np.asarray(episode_starts, dtype=np.int64)
+	episode_num = max(len(episode_starts) - 1, 0)
+	if njit is not None:
+		n = len(values)
+		indices = np.empty((n,), dtype=np.int32)
+		index_counts = np.empty((episode_num,), dtype=np.int64)
+		stalkers = np.zeros((n,), dtype=np.int32)
+		turning_points_episodes_kernel(np.asarray(values), episode_starts, int(gap), indices, index_counts, stalkers)
+		# 分割したままだと全体のバッファが残り続けるので、エピソード毎にコピーする
+		return [a.copy() for a in np.split(indices[:index_counts.sum()], np.cumsum(index_counts)[:-1])], stalkers
+	else:
+		# リストへの変換は全体を一度に行うと大きくなりすぎるのでエピソード毎に行う
+		episode_indices = []
+		stalkers = np.zeros((len(values),), dtype=np.int32)
+		for e in range(episode_num):
+			i1 = episode_starts[e]
+			i2 = episode_starts[e + 1]
+			indices, stalkers[i1:i2] = detect_turning_points(values[i1:i2], gap)
+			episode_indices.append(indices)
+		return episode_indices, stalkers
 
 
 class TpActionSuggester:
 	"""予め折り返し点を探索し、それを用いて指定環境での状態からお勧めアクションを提示するクラス.
+
+	Args:
+		env: トレード用環境.
+		spread_adj: スプレッドに掛けて閾値とする係数.
+		episode_cache_size: エピソード毎の折返し点をキャッシュする最大エピソード数.
 	"""
 
-	def __init__(self, env: trade_environment.TradeEnvironment, spread_adj: int = 1) -> None:
+	def __init__(self, env: trade_environment.TradeEnvironment, spread_adj: int = 1, episode_cache_size: int = 64) -> None:
 		self.env = env # トレード用環境
 		self.threshould = int(np.rint(env.spread * spread_adj).item()) # エントリーするかどうか判断する閾値、現在値と折返し値の差がこの値以下ならエントリーしない
 		self.tp_indices = np.empty((0,), dtype=np.int32) # 折返し点のエピソード内インデックス一覧
 		self.tp_values = np.empty((0,), dtype=np.int32) # 折返し点の値一覧
+		self.episode_cache_size = episode_cache_size # キャッシュする最大エピソード数
+		self.episode_tp_indices = collections.OrderedDict() # エピソードインデックスから折返し点のエピソード内インデックス一覧へのキャッシュ、古く使われたものから捨てる
+		self.on_tp = None # エピソード内インデックス毎の現在折り返し点上かどうか
+		self.has_tp_delta = None # エピソード内インデックス毎のこれから折り返し点があるかどうか
+		self.tp_delta = None # エピソード内インデックス毎の現在値から次の折返し点の値への差
+		self.suggested_actions = None # (エピソード内インデックス, ポジションタイプ+1) 毎のお勧めアクション
 
 	def start_episode(self) -> None:
-		"""トレード用環境のエピソード開始直後に呼び出す必要がある."""
+		"""トレード用環境のエピソード開始直後に呼び出す必要がある.
+
+		エピソード内の全インデックスについて次の折返し点との関係とお勧めアクションを計算しておく.
+		"""
 		values = self.env.episode_values
 		c = values[:, 3]
-		self.tp_indices, _ = detect_turning_points(c, self.threshould)
-		self.tp_values = c[self.tp_indices]
+		# 折返し点はエピソード毎に初回のみ検出する、履歴ファイル全体は memmap のままにしておくため一括では検出しない
+		cache = self.episode_tp_indices
+		episode = self.env.cur_episode
+		tp_indices = cache.get(episode)
+		if tp_indices is None:
+			tp_indices, _ = detect_turning_points(c, self.threshould)
+			if self.episode_cache_size:
+				cache[episode] = tp_indices
+				if self.episode_cache_size < len(cache):
+					cache.popitem(last=False)
+		else:
+			cache.move_to_end(episode)
+		self.tp_indices = tp_indices
+		self.tp_values = c[tp_indices]
+
+		# 未来の直近折返し点、現在が丁度折り返し点なら次の折返し点が目標となる
+		n = len(c)
+		indices = np.arange(n)
+		tp_idx = np.searchsorted(tp_indices, indices)
+		on_tp = tp_idx < len(tp_indices)
+		on_tp[on_tp] = tp_indices[tp_idx[on_tp]] == indices[on_tp]
+		target = tp_idx + on_tp
+		has_delta = target < len(tp_indices)
+		tp_delta = np.zeros((n,), dtype=np.int64)
+		tp_delta[has_delta] = self.tp_values[target[has_delta]].astype(np.int64) - c[has_delta]
+		self.on_tp = on_tp
+		self.has_tp_delta = has_delta
+		self.tp_delta = tp_delta
+
+		# ポジションタイプ毎のお勧めアクション
+		threshould = self.threshould
+		buy = has_delta & (threshould < tp_delta)
+		sell = has_delta & (tp_delta < -threshould)
+		suggested_actions = np.empty((n, 3), dtype=np.int8)
+		# ポジション持っておらず、次の折返し値との差が閾値より大きいなら売買する
+		suggested_actions[:, 1] = np.where(buy, 1, np.where(sell, 2, 0))
+		for position_type in (-1, 1):
+			# 現在が折り返し点上の場合は次の折返しに備え、折り返し点間の場合は必要に応じてポジションを調整する
+			suggested_actions[:, position_type + 1] = np.where(
+			    on_tp, np.where(buy, 1, np.where(sell, 2, 3)),
+			    np.where(buy & (position_type != 1), 1, np.where(sell & (position_type != -1), 2, 0)))
+		self.suggested_actions = suggested_actions
 
 	def get_next_turning_index(self) -> int:
 		"""次の折返しインデックスの取得."""
@@ -67,55 +220,11 @@ class TpActionSuggester:
 
 	def get_suggested_action(self) -> int:
 		"""現状の状態でのお勧めアクションの取得."""
-		tp_indices = self.tp_indices # 折返し点インデックス列
-		tp_values = self.tp_values # 折り返し点値列
-		value = self.env.get_value() # 現在値
-		tp_idx = self.get_next_turning_index() # 未来の直近折り返し点インデックス
-		tp_delta = None # 現在値から次の折返し点の値への差
-		on_tp = False # 現在折り返し点上かどうか
-		if 0 <= tp_idx:
-			# 現在が丁度折り返し点なら次の折返し点が目標となる
-			if tp_indices[tp_idx] == self.env.index_in_episode:
-				on_tp = True
-				tp_idx += 1
-
-			# まだこれから折り返し点があるなら現在値との差分を計算
-			if tp_idx < len(tp_values):
-				tp_delta = tp_values[tp_idx] - value
-
-			threshould = self.threshould
-
-		suggested_action = 0 # 基本何もしない
-
-		if self.env.position_type == 0:
-			# ポジション持っておらず、次の折返し値との差が閾値より大きいなら売買する
-			if tp_delta is not None:
-				if threshould < tp_delta:
-					suggested_action = 1
-				elif tp_delta < -threshould:
-					suggested_action = 2
-		else:
-			# 既にポジション持っている際の処理
-			if on_tp:
-				# 現在が折り返し点上の場合は次の折返しに備える
-				suggested_action = 3
-				if tp_delta is not None:
-					if threshould < tp_delta:
-						suggested_action = 1
-					elif tp_delta < -threshould:
-						suggested_action = 2
-			else:
-				# 現在が折り返し点間の場合は必要に応じてポジションを調整する
-				suggested_action = 0
-				if tp_delta is not None:
-					if threshould < tp_delta and self.env.position_type != 1:
-						suggested_action = 1
-					elif tp_delta < -threshould and self.env.position_type != -1:
-						suggested_action = 2
-					# elif tp_delta * self.env.position_type < 0:
-					# 	suggested_action = 3
+		return int(self.suggested_actions[self.env.index_in_episode, self.env.position_type + 1])
 
-		return suggested_action
+	def get_suggested_actions(self, indices: np.ndarray, position_types: np.ndarray) -> np.ndarray:
+		"""エピソード内の複数インデックスとポジションタイプでのお勧めアクションをまとめて取得."""
+		return self.suggested_actions[indices, np.asarray(position_types) + 1]
 
 
 class TpRewardAdjuster:
@@ -139,56 +248,93 @@ class TpRewardAdjuster:
 		self.securing_profit_check = securing_profit_check
 		self.env = action_suggester.env
 		self.threshould = action_suggester.threshould
+		self.base_rewards = None # (インデックス, ポジションタイプ+1, アクション) 毎の含み損益に依存しない報酬調整量
+		self.loss_cut_masks = None # 含み損を報酬に加えるかどうか
+		self.securing_profit_masks = None # 含み益を報酬から引くかどうか
+		self.tables_source = None # 表作成元の TpActionSuggester.tp_delta、変わったら表を作り直す
 
-	def adjust_reward(self, action: int) -> float:
-		"""現状の状態で指定のアクションを行った際の報酬調整料の取得."""
-		tp_indices = self.action_suggester.tp_indices # 折返し点インデックス列
-		tp_values = self.action_suggester.tp_values # 折り返し点値列
-		value = self.env.get_value() # 現在値
-		tp_idx = self.action_suggester.get_next_turning_index() # 未来の直近折り返し点インデックス
-		tp_delta = None # 現在値から次の折返し点の値への差
-		on_tp = False # 現在折り返し点上かどうか
-		if 0 <= tp_idx:
-			# 現在が丁度折り返し点なら次の折返し点が目標となる
-			if tp_indices[tp_idx] == self.env.index_in_episode:
-				on_tp = True
-				tp_idx += 1
-
-			# まだこれから折り返し点があるなら現在値との差分を計算
-			if tp_idx < len(tp_values):
-				tp_delta = tp_values[tp_idx] - value
-
-		reward = 0.0
+	def update_tables(self) -> None:
+		"""お勧めアクション提示オブジェクトのエピソードに合わせて報酬調整量の表を作成する.
+
+		表は (インデックス, ポジションタイプ+1, アクション) 毎の含み損益に依存しない調整量と、含み損益を加減するかどうかのマスク.
+		"""
+		s = self.action_suggester
+		on_tp = s.on_tp[:, None, None]
+		has_delta = s.has_tp_delta[:, None, None]
+		tp_delta = s.tp_delta[:, None, None]
+		position_type = np.arange(-1, 2)[None, :, None]
+		action = np.arange(trade_environment.action_num)[None, None, :]
+		adj_rate = self.adj_rate
 
 		# 現状のポジションから行っても無視されるアクションを排除
-		if self.env.is_action_ignored(action):
-			action = 0
-
-		if 1 <= action and action <= 3 and self.env.position_type != 0:
-			# 決済するなら残りの損益から報酬を調整する
-			if tp_delta is not None and not on_tp:
-				reward -= self.adj_rate * self.env.position_type * tp_delta
-
-		if action == 0:
-			if tp_delta is not None:
-				if self.env.position_type == 0:
-					# チャンスがある状態で何もしていないなら報酬を減衰させる
-					if self.threshould < abs(tp_delta):
-						reward -= self.adj_rate * abs(tp_delta)
-				else:
-					pr = self.env.calc_positional_reward()
-					miss_position = tp_delta * self.env.position_type < 0
-
-					# 間違ったポジションなら報酬を減衰させ続ける
-					if self.loss_cut_check and miss_position and pr < 0:
-						reward += pr * self.adj_rate
-
-					# 正しいポジションなら利確すべきタイミングを逃した瞬間に報酬を減衰させる
-					if self.securing_profit_check and on_tp and miss_position and 0 < pr:
-						reward -= pr * self.adj_rate
-		elif action == 1 or action == 2:
-			# 売買の方向と次の折り返し点への差分から報酬を調整する
-			if tp_delta is not None:
-				reward += self.adj_rate * (1.0 if action == 1 else -1.0) * tp_delta
+		ignored = (action == 1) & (0 < position_type) | (action == 2) & (position_type < 0) | (action == 3) & (position_type == 0)
+		action = np.where(ignored, 0, action)
+		shape = np.broadcast_shapes(tp_delta.shape, position_type.shape, action.shape)
+
+		base = np.zeros(shape)
+		# 決済するなら残りの損益から報酬を調整する
+		m = (1 <= action) & (action <= 3) & (position_type != 0) & has_delta & ~on_tp
+		base = np.where(m, 0.0 - adj_rate * position_type * tp_delta, base)
+		# チャンスがある状態で何もしていないなら報酬を減衰させる
+		m = (action == 0) & has_delta & (position_type == 0) & (self.threshould < np.abs(tp_delta))
+		base = np.where(m, 0.0 - adj_rate * np.abs(tp_delta), base)
+		# 売買の方向と次の折り返し点への差分から報酬を調整する
+		m = ((action == 1) | (action == 2)) & has_delta
+		base = np.where(m, base + adj_rate * np.where(action == 1, 1.0, -1.0) * tp_delta, base)
+
+		miss_position = (action == 0) & has_delta & (position_type != 0) & (tp_delta * position_type < 0)
+		self.base_rewards = base
+		# 間違ったポジションなら含み損で報酬を減衰させ続ける
+		self.loss_cut_masks = np.broadcast_to(miss_position & self.loss_cut_check, shape)
+		# 正しいポジションなら利確すべきタイミングを逃した瞬間に含み益で報酬を減衰させる
+		self.securing_profit_masks = np.broadcast_to(miss_position & on_tp & self.securing_profit_check, shape)
+		self.tables_source = s.tp_delta
 
+	def adjust_rewards(self,
+	                   indices: np.ndarray,
+	                   position_types: np.ndarray,
+	                   positional_rewards: np.ndarray,
+	                   actions: np.ndarray = None) -> np.ndarray:
+		"""エピソード内の複数インデックスでの報酬調整量をまとめて取得.
+
+		Args:
+			indices: エピソード内インデックス列.
+			position_types: 各インデックスでのポジションタイプ.
+			positional_rewards: 各インデックスでの含み損益.
+			actions: 各インデックスで行うアクション、None なら全アクション分を取得する.
+
+		Returns:
+			actions 指定時は (インデックス数,)、それ以外は (インデックス数, アクション数) の報酬調整量.
+		"""
+		if self.tables_source is not self.action_suggester.tp_delta:
+			self.update_tables()
+		indices = np.asarray(indices)
+		columns = np.asarray(position_types) + 1
+		pr = np.asarray(positional_rewards, dtype=np.float64)[:, None]
+		rewards = self.base_rewards[indices, columns]
+		rewards = np.where(self.loss_cut_masks[indices, columns] & (pr < 0), rewards + pr * self.adj_rate, rewards)
+		rewards = np.where(self.securing_profit_masks[indices, columns] & (0 < pr), rewards - pr * self.adj_rate, rewards)
+		if actions is not None:
+			rewards = rewards[np.arange(len(indices)), actions]
+		return rewards
+
+	def adjust_reward_all_actions(self) -> np.ndarray:
+		"""現状の状態で各アクションを行った際の報酬調整量の取得."""
+		env = self.env
+		return self.adjust_rewards((env.index_in_episode,), (env.position_type,), (env.calc_positional_reward(),))[0]
+
+	def adjust_reward(self, action: int) -> float:
+		"""現状の状態で指定のアクションを行った際の報酬調整料の取得."""
+		if self.tables_source is not self.action_suggester.tp_delta:
+			self.update_tables()
+		env = self.env
+		i = env.index_in_episode
+		column = env.position_type + 1
+		reward = float(self.base_rewards[i, column, action])
+		if self.loss_cut_masks[i, column, action] or self.securing_profit_masks[i, column, action]:
+			pr = env.calc_positional_reward()
+			if pr < 0 and self.loss_cut_masks[i, column, action]:
+				reward += pr * self.adj_rate
+			elif 0 < pr and self.securing_profit_masks[i, column, action]:
+				reward -= pr * self.adj_rate
 		return reward
@@ -3,15 +3,11 @@ import os
 import time
 import datetime
 import json
-import multiprocessing as mp
 import random
 import numpy as np
 from collections import deque
 from collections import namedtuple
-import cv2
 import torch
-import psycopg2
-import matplotlib.pyplot as plt
 
 import db_initializer
 import tables
@@ -19,23 +15,50 @@ import trade_environment
 from trade_environment import TradeEnvironment
 import model
 import action_suggester
+import replay
+import transport
+import viewer
+
+
+class ActorEnv:
+	"""Actor が並行して動かす環境１つ分の状態.
+
+	Args:
+		env: トレード用環境.
+		suggester: お勧めアクション提示オブジェクト.
+		reward_adjuster: 報酬調整オブジェクト.
+		epsilon: この環境で使う探索率.
+	"""
+
+	def __init__(self, env, suggester, reward_adjuster, epsilon):
+		self.env = env
+		self.suggester = suggester
+		self.reward_adjuster = reward_adjuster
+		self.epsilon = epsilon
+		self.transitions = deque() # N-StepTransition 生成前の遷移
+		self.state = None # 現在の状態
+		self.state_ids = None # 現在の状態を構成するフレーム通し番号列、フレームリング方式でのみ使用
+		self.terminal = True # エピソード終了しているかどうか
+		self.ep_count = 0 # 現在のエピソード番号
+		self.ep_len = 0
+		self.ep_reward = 0.0
 
 
 class Actor:
 
-	def __init__(self, params, param_set_id, actor_id, status_dict, shared_state, remote_mem):
+	def __init__(self, params, param_set_id, actor_id, control, remote_mem, snapshots=None, flow=None):
 		self.params = params
 		self.param_set_id = param_set_id
 		self.actor_id = actor_id
-		self.status_dict = status_dict
-		self.shared_state = shared_state
+		self.control = control
 		self.remote_mem = remote_mem
+		self.snapshots = snapshots # 表示用プロセスへのスナップショット、None なら何も表示しない
+		self.flow = flow # Learner への流量制御、None なら制御しない
 
 		ep = params['env']
 		ap = params['actor']
 		lp = params['learner']
-		model_formula = f'model.{lp["model"]}(self.state_shape, self.action_dim, "Actor# {actor_id}", hidden_size={lp["hidden_size"]})'
-		model_formula_target = f'model.{lp["model"]}(self.state_shape, self.action_dim, hidden_size={lp["hidden_size"]})'
+		model_formula = f'model.{lp["model"]}(self.state_shape, self.action_dim, hidden_size={lp["hidden_size"]})'
 
 		self.window_size = ep['window_size']
 		self.state_shape = tuple(ep['frames_height_width'])
@@ -43,48 +66,131 @@ class Actor:
 		self.action_dim = trade_environment.action_num
 		self.num_steps = ap["num_steps"] # Nステップ数
 		self.n_step_transition_batch_size = ap['n_step_transition_batch_size']
-		self.env = TradeEnvironment('test.dat', self.window_size, self.state_shape[1:])
-		self.epsilon = ap['epsilon']**(1 + ap['alpha'] * self.actor_id / (ap['num_actors'] - 1))
-		self.last_Q_state_dict_id = 0
-
-		self.Q = eval(model_formula)
-		self.Q_target = eval(model_formula_target) # Target Q network which is slow moving replica of self.Q
-		Q_state_dict = self.shared_state["Q_state_dict"]
-		self.Q.load_state_dict(Q_state_dict[0])
-		self.Q_target.load_state_dict(Q_state_dict[1])
+		self.num_envs = ap.get('envs_per_actor', 1) # １プロセスで同時に動かす環境数
+
+		# 環境毎に Ape-X と同様の探索率を割り当てる、環境数が１なら Actor 毎の探索率と同じになる
+		num_envs_total = max(ap['num_actors'] * self.num_envs - 1, 1)
+		self.epsilons = [
+		    ap['epsilon']**(1 + ap['alpha'] * (self.actor_id * self.num_envs + k) / num_envs_total)
+		    for k in range(self.num_envs)
+		]
+		self.envs = [
+		    TradeEnvironment(ep.get('data_file', 'test.dat'), self.window_size, self.state_shape[1:])
+		    for _ in range(self.num_envs)
+		]
+
+		# 中間出力を表示する Actor のみ plot_* フックの出力を取り出せるモデルにする
+		self.capture = snapshots is not None and actor_id == viewer.get_plot_actor_id(params)
+		model.capture_enabled = self.capture
+		try:
+			self.Q = eval(model_formula)
+		finally:
+			model.capture_enabled = False
+		self.Q_target = eval(model_formula) # Target Q network which is slow moving replica of self.Q
+		self.Q_state_dicts = [self.Q.state_dict(), self.Q_target.state_dict()] # 共有メモリから直接書き込まれる tensor 群
+		self.shared_weights = transport.SharedWeights(
+		    transport.state_dicts_numel(self.Q_state_dicts), self.control.weights_name)
+		self.last_Q_state_dict_id = self.shared_weights.read_into(self.Q_state_dicts)
 		self.sum_los = 0
 
+		# フレームリング方式のリプレイメモリ用に送信前のフレームを通し番号で保持する
+		self.frame_ring = params['replay_memory'].get('storage', 'columnar') == 'frame_ring'
+		self.frames = {}
+		self.next_frame_id = 0
+		self.min_frame_id = 0
+
 	def make_state(self, state, frame):
 		return np.concatenate((frame, (state if state.shape[0] < self.frame_num else state[:state.shape[0] - 1])), axis=0)
 
+	def add_frame(self, frame):
+		"""フレームのコピーを保持し、その通し番号を取得する."""
+		frame_id = self.next_frame_id
+		self.frames[frame_id] = frame[0].copy()
+		self.next_frame_id += 1
+		return frame_id
+
+	def make_state_ids(self, state_ids, frame_id):
+		"""make_state と同じ順序で状態を構成するフレーム通し番号列を作成する."""
+		return (frame_id,) + (state_ids if len(state_ids) < self.frame_num else state_ids[:-1])
+
+	def release_frames(self, min_frame_id):
+		"""指定通し番号より前のもう参照されないフレームを破棄する."""
+		for i in range(self.min_frame_id, min_frame_id):
+			self.frames.pop(i, None)
+		self.min_frame_id = max(self.min_frame_id, min_frame_id)
+
+	def make_frame_batch(self, state_ids, latest_state_ids):
+		"""遷移バッチが参照するフレームを重複無く集め、バッチ内フレームインデックスに変換する.
+
+		Returns:
+			(フレーム, 状態のフレームインデックス, Nステップ後状態のフレームインデックス) のタプル.
+		"""
+		ids = np.array(state_ids + latest_state_ids, dtype=np.int64)
+		unique_ids, inverse = np.unique(ids, return_inverse=True)
+		frames = np.stack([self.frames[i] for i in unique_ids.tolist()])
+		inverse = inverse.reshape(ids.shape).astype(np.int32)
+		n = len(state_ids)
+		return frames, inverse[:n], inverse[n:]
+
+	def start_episode(self, e):
+		"""指定環境のエピソードを開始し、状態がフレーム数分溜まるまで進める.
+
+		Returns:
+			エピソード開始直後に終了してしまったら True.
+		"""
+		e.ep_len = 0
+		e.ep_reward = 0.0
+		e.terminal = False
+
+		# 初期状態の取得
+		state = e.env.reset()
+		state_ids = (self.add_frame(state),) if self.frame_ring else None
+		e.suggester.start_episode()
+		for _ in range(self.frame_num - 1):
+			frame, reward_info, e.terminal, _ = e.env.step(0, 0)
+			if e.terminal:
+				break
+			state = self.make_state(state, frame)
+			if self.frame_ring:
+				state_ids = self.make_state_ids(state_ids, self.add_frame(frame))
+		e.state = state
+		e.state_ids = state_ids
+		return e.terminal
+
 	def run(self):
 		torch.set_num_threads(1)
 
 		ap = self.params['actor']
 		lp = self.params['learner']
 
-		conn = psycopg2.connect(self.params["db"]["connection_string"])
-		conn.autocommit = True
+		dp = self.params['db']
 
-		status_dict = self.status_dict
+		control = self.control
+		actor_steps = control.actor_steps
+		actor_sync_num = control.actor_sync_num
+		actor_sync_latency = control.actor_sync_latency
 
+		# DBへの登録はバックグラウンドスレッドからまとめて行い、ステップ毎には待たない
 		t = tables.ActorData()
 		record_type = t.get_record_type()
-		record_insert = t.get_insert()
+		record_writer = t.get_writer(dp['connection_string'],
+		                             format=dp['copy_format'],
+		                             flush_rows=dp['copy_flush_rows'],
+		                             flush_interval=dp['copy_flush_interval'])
 
 		t = tables.RewardAdjData()
 		reward_adj_record_type = t.get_record_type()
-		reward_adj_insert = t.get_insert()
+		reward_adj_writer = t.get_writer(dp['connection_string'],
+		                                 format=dp['copy_format'],
+		                                 flush_rows=dp['copy_flush_rows'],
+		                                 flush_interval=dp['copy_flush_interval'])
 
 		param_set_id = self.param_set_id
 		actor_id = self.actor_id
 		now = datetime.datetime.now
 		ep_count = 0
-		ep_len = 0
-		ep_reward = 0.0
 		sum_reward = 0.0
 
-		transitions = deque()
 		n_step_transitions = []
 		n_step_transition_batch_size = self.n_step_transition_batch_size
 		num_steps = self.num_steps
@@ -95,10 +201,15 @@ class Actor:
 		Q_target = self.Q_target
 		take_offsets = torch.arange(n_step_transition_batch_size) * self.action_dim
 
-		wait_shared_memory_clear = ap['wait_shared_memory_clear']
+		flow = self.flow
 
-		self.env.spread = ap['spread']
-		self.env.loss_cut = ap['loss_cut']
+		# スナップショットは viewer_fps の頻度でのみ書き込み、表示自体は別プロセスで行う
+		snapshots = self.snapshots
+		capture = self.capture
+		snapshot_interval = 1.0 / ap['viewer_fps'] if snapshots is not None else 0.0
+		next_snapshot_time = 0.0
+		frame_ring = self.frame_ring
+		state_dtype = self.params['replay_memory'].get('state_dtype', 'float16') # 送信時点でリプレイメモリの格納型にしておく
 
 		# Actorの最後のステータスを読み込む
 		actor_state_file = f'{db_initializer.get_state_dict_name(self.params)}.{self.actor_id}.json'
@@ -109,73 +220,127 @@ class Actor:
 				ep_count = actor_state['ep_count']
 				sum_reward = actor_state['sum_reward']
 
-		# お勧めアクション生成、報酬調整オブジェクトを取得する
-		suggester = eval(f'action_suggester.{ap["action_suggester"].format("self.env")}')
-		reward_adjuster = eval(f'action_suggester.{ap["reward_adjuster"].format("suggester")}')
+		# 環境毎にお勧めアクション生成、報酬調整オブジェクトを取得する
+		envs = []
+		for env, epsilon in zip(self.envs, self.epsilons):
+			env.spread = ap['spread']
+			env.loss_cut = ap['loss_cut']
+			suggester = eval(f'action_suggester.{ap["action_suggester"].format("env")}')
+			reward_adjuster = eval(f'action_suggester.{ap["reward_adjuster"].format("suggester")}')
+			envs.append(ActorEnv(env, suggester, reward_adjuster, epsilon))
 
-		def plc_random(q):
+		def plc_random(e, q):
 			"""計算されたアクションまたは乱数を取得する.
 			"""
 			q_action = torch.argmax(q, 0).item()
-			if random.random() < self.epsilon:
+			if random.random() < e.epsilon:
 				return random.randrange(0, len(q)), q_action
 			else:
 				return q_action, q_action
 
-		def plc_suggested(q):
+		def plc_suggested(e, q):
 			"""計算されたアクションまたはお勧めアクションを取得する.
 			"""
 			q_action = torch.argmax(q, 0).item()
-			if random.random() < self.epsilon:
-				return suggester.get_suggested_action(), q_action
+			if random.random() < e.epsilon:
+				return e.suggester.get_suggested_action(), q_action
 			else:
 				return q_action, q_action
 
 		# 方策を取得する
 		policy = eval(ap['policy'])
 
-		while not status_dict['request_quit']:
-			ep_len = 0
-			ep_count += 1
-			ep_reward = 0.0
-			terminal = False
-
-			# 初期状態の取得
-			state = self.env.reset()
-			suggester.start_episode()
-			for _ in range(self.frame_num - 1):
-				frame, reward_info, terminal, _ = self.env.step(0, 0)
-				if terminal:
-					break
-				state = self.make_state(state, frame)
-
-			while not terminal:
+		def send_n_step_transitions():
+			"""溜まった N-StepTransition の優先度となるTD誤差を計算してリモートメモリに追加する."""
+			if frame_ring:
+				# 重複の無いフレームとそのインデックスから状態を組み立てる
+				frames, s_idx, s_latest_idx = self.make_frame_batch([t[6] for t in n_step_transitions],
+				                                                     [t[7] for t in n_step_transitions])
+				s = torch.from_numpy(frames[s_idx])
+				s_latest = torch.from_numpy(frames[s_latest_idx])
+			else:
+				s = torch.from_numpy(np.stack([t[0] for t in n_step_transitions]))
+				s_latest = torch.from_numpy(np.stack([t[4] for t in n_step_transitions]))
+			a = torch.tensor([t[1] for t in n_step_transitions], dtype=torch.int64)
+			r = torch.tensor([t[2] for t in n_step_transitions], dtype=torch.float32)
+			a_latest = torch.tensor([t[3] for t in n_step_transitions], dtype=torch.int64)
+			term = torch.tensor([t[5] for t in n_step_transitions], dtype=torch.float32)
+			n_step_transitions.clear()
+
+			with torch.no_grad():
+				Q.eval()
+				Q_target.eval()
+				Gt = r + (1.0 - term) * gamma_n * Q_target(s_latest).take(take_offsets + a_latest).squeeze()
+				priorities = (Gt - Q(s).take(take_offsets + a).squeeze()).abs()
+				del Gt
+
+			# Learner からクレジットが返されるのを待ってからリモートメモリに追加、待っている間に終了要求があれば送らない
+			# ※torch.tensor のまま送るとLearner側の都合で問題があるので numpy にしている
+			if flow is not None:
+				while not flow.acquire(actor_id, 0.1):
+					if control.request_quit:
+						return
+			a = a.numpy().astype(np.int8)
+			r = r.numpy()
+			a_latest = a_latest.numpy().astype(np.int8)
+			term = term.numpy().astype(np.int8)
+			if frame_ring:
+				frames = replay.to_storage_states(frames, state_dtype)
+				self.remote_mem.put((priorities.numpy(), (frames, s_idx, a, r, a_latest, s_latest_idx, term)), sender=actor_id)
+
+				# 未処理の遷移や現在の状態から参照されなくなったフレームは破棄する
+				self.release_frames(
+				    min(min([min(t[5]) for t in e.transitions] + [min(e.state_ids)]) for e in envs if e.state_ids))
+			else:
+				s = replay.to_storage_states(s.numpy(), state_dtype)
+				s_latest = replay.to_storage_states(s_latest.numpy(), state_dtype)
+				self.remote_mem.put((priorities.numpy(), (s, a, r, a_latest, s_latest, term)), sender=actor_id)
+
+		while not control.request_quit:
+			# エピソード終了している環境は次のエピソードを開始する
+			for e in envs:
+				while e.terminal:
+					ep_count += 1
+					e.ep_count = ep_count
+					self.start_episode(e)
+
+			# 全環境の状態をまとめて１回で推論する
+			snapshot = snapshots is not None and next_snapshot_time <= time.perf_counter()
+			if snapshot and capture:
+				model.captured = []
+			with torch.no_grad():
+				q_batch = Q(torch.from_numpy(np.stack([e.state for e in envs])))
+			if snapshot:
+				values = [envs[0].state.sum(axis=0), q_batch[0].numpy()]
+				if capture:
+					values += [c[2] for c in model.captured]
+					model.captured = None
+				snapshots.publish(actor_id, values)
+				next_snapshot_time = time.perf_counter() + snapshot_interval
+
+			for k, e in enumerate(envs):
+				env = e.env
+				state = e.state
+				state_ids = e.state_ids
+				transitions = e.transitions
+
 				# 状態とポリシーを基に取るべき行動を選択する
-				with torch.no_grad():
-					if self.actor_id == 7:
-						model.show_plot = True
-					q = Q(torch.tensor(state.reshape((1,) + state.shape))).squeeze()
-					if self.actor_id == 7:
-						model.plt_pause(0.001)
-						model.show_plot = False
-				action = policy(q)
+				action = policy(e, q_batch[k])
 
 				# 指定アクションから報酬調整量を取得する
-				reward_adj = reward_adjuster.adjust_reward(action[0])
+				reward_adj = e.reward_adjuster.adjust_reward(action[0])
 
 				# 環境に行動を適用し次の状態を取得する
-				index_in_episode = self.env.index_in_episode
-				frame, reward_info, terminal, _ = self.env.step(action[0], action[1])
+				index_in_episode = env.index_in_episode
+				frame, reward_info, terminal, _ = env.step(action[0], action[1])
 				next_state = self.make_state(state, frame)
+				next_state_ids = self.make_state_ids(state_ids, self.add_frame(frame)) if frame_ring else None
 				reward_org = reward_info[0]
 				reward = reward_org + reward_adj
-				img = next_state.sum(axis=0)
-				img *= 1.0 / img.max()
-				cv2.imshow(f'Actor# {self.actor_id}', img)
-				# self.env.render()
+				# env.render()
 
 				# N-StepTransition のために状態遷移情報を追加する
-				transitions.append((state, action[0], reward, next_state, terminal))
+				transitions.append((state, action[0], reward, next_state, terminal, state_ids, next_state_ids))
 
 				# N-StepTransition の処理
 				len_transitions = len(transitions)
@@ -189,77 +354,43 @@ class Actor:
 						r += transitions[i][2] * g
 						g *= gamma
 					transitions.popleft()
-					n_step_transitions.append((first[0], first[1], r, latest[1], latest[3], latest[4]))
+					n_step_transitions.append((first[0], first[1], r, latest[1], latest[3], latest[4], first[5], latest[6]))
 
 					# N-StepTransition がある程度溜まったら優先度となるTD誤差を計算してリモートメモリに追加
 					if n_step_transition_batch_size <= len(n_step_transitions):
-						# サンプリングの優先度となるTD誤差を計算する
-						s = torch.tensor([t[0] for t in n_step_transitions], dtype=torch.float32)
-						a = torch.tensor([t[1] for t in n_step_transitions], dtype=torch.int64)
-						r = torch.tensor([t[2] for t in n_step_transitions], dtype=torch.float32)
-						a_latest = torch.tensor([t[3] for t in n_step_transitions], dtype=torch.int64)
-						s_latest = torch.tensor([t[4] for t in n_step_transitions], dtype=torch.float32)
-						term = torch.tensor([t[5] for t in n_step_transitions], dtype=torch.float32)
-						n_step_transitions.clear()
-
-						with torch.no_grad():
-							Q.eval()
-							Q_target.eval()
-							Gt = r + (1.0 - term) * gamma_n * Q_target(s_latest).take(take_offsets + a_latest).squeeze()
-							priorities = (Gt - Q(s).take(take_offsets + a).squeeze()).abs()
-							del Gt
-
-						# Learner 側が処理するのを待ってからリモートメモリに追加
-						# ※torch.tensor のまま送るとLearner側の都合で問題があるので numpy にしている
-						if wait_shared_memory_clear:
-							while n_step_transition_batch_size <= self.remote_mem.qsize():
-								time.sleep(0.001)
-						s = s.numpy()
-						a = a.numpy().astype(np.int8)
-						r = r.numpy()
-						a_latest = a_latest.numpy().astype(np.int8)
-						s_latest = s_latest.numpy()
-						term = term.numpy().astype(np.int8)
-						batch = [v for v in zip(s, a, r, a_latest, s_latest, term)]
-						self.remote_mem.put((priorities, batch))
-
-				# Learner からの共有パラメータが更新されていたらロードする
-				id = status_dict['Q_state_dict_id']
-				if 1 <= id - self.last_Q_state_dict_id:
-					print(f'Actor#: {self.actor_id} state loaded.')
-					Q_state_dict = self.shared_state["Q_state_dict"]
-					self.Q.load_state_dict(Q_state_dict[0])
-					self.Q_target.load_state_dict(Q_state_dict[1])
-					self.last_Q_state_dict_id = id
-
-				# 終了要求があったらループを抜ける
-				if cv2.waitKey(1) == 27 or status_dict['request_quit']:
-					status_dict['request_quit'] = True
-					break
+						send_n_step_transitions()
 
 				# 次のループに備える
-				state = next_state
-				ep_reward += reward_org
-				ep_len += 1
+				e.state = next_state
+				e.state_ids = next_state_ids
+				e.terminal = terminal
+				e.ep_reward += reward_org
+				e.ep_len += 1
 				sum_reward += reward_org
 
 				# エピソード終了かまたは報酬が入った際にDBへデータ登録
 				if terminal or reward_org:
 					if action[0] == action[1]:
 						print(
-						    f'Actor#: {self.actor_id} t: {t} rew: {reward_org} {reward} act: {action[0]} ep_len: {ep_len} ep_rew: {ep_reward} sum_rew: {sum_reward}'
+						    f'Actor#: {self.actor_id} t: {t} rew: {reward_org} {reward} act: {action[0]} ep_len: {e.ep_len} ep_rew: {e.ep_reward} sum_rew: {sum_reward}'
 						)
-					train_num = status_dict['train_num']
-					record = record_type(param_set_id, actor_id, now(), train_num, ep_count, self.env.cur_episode,
+					train_num = control.train_num
+					record = record_type(param_set_id, actor_id, now(), train_num, e.ep_count, env.cur_episode,
 					                     index_in_episode, action[0], action[1], reward_info[0], reward_info[1], reward_info[2],
 					                     reward_info[3], sum_reward)
-					with conn.cursor() as cur:
-						record_insert(cur, record)
+					record_writer.write(record)
 
 				# 報酬調整量をDBへ登録
-				with conn.cursor() as cur:
-					reward_adj_insert(cur, reward_adj_record_type(param_set_id, actor_id, ep_count, index_in_episode,
-					                                              reward_adj))
+				reward_adj_writer.write(reward_adj_record_type(param_set_id, actor_id, e.ep_count, index_in_episode, reward_adj))
+
+			# Learner からの共有パラメータが更新されていたらロードする
+			if self.last_Q_state_dict_id != self.shared_weights.version():
+				print(f'Actor#: {self.actor_id} state loaded.')
+				self.last_Q_state_dict_id = self.shared_weights.read_into(self.Q_state_dicts)
+				actor_sync_latency[actor_id] += time.time() - self.shared_weights.read_publish_time
+				actor_sync_num[actor_id] += 1
+
+			actor_steps[actor_id] += len(envs)
 
 		# Actor の現在のステータスを保存しておく
 		actor_state['ep_count'] = ep_count
@@ -267,6 +398,9 @@ class Actor:
 		with open(actor_state_file, 'w') as f:
 			json.dump(actor_state, f)
 
+		record_writer.close()
+		reward_adj_writer.close()
+		self.shared_weights.close()
 		print(f'Actor#: {self.actor_id} end')
 
 
@@ -274,25 +408,36 @@ if __name__ == "__main__":
 	""" 
 	Simple standalone test routine for Actor class
 	"""
+	import threading
 	import learner
 
 	with open('parameters.json', 'r') as f:
 		params = json.load(f)
+	params['actor']['T'] = 2000
 
 	param_set_id = db_initializer.initialize(params)
 
-	mp_manager = mp.Manager()
-	status_dict = mp_manager.dict()
-	shared_state = mp_manager.dict()
-	shared_mem = mp_manager.Queue()
+	control = transport.ControlBlock(params['actor']['num_actors'])
+	shared_mem = transport.SharedMemoryQueue(
+	    replay.get_batch_fields(params['replay_memory'], params['env']['frames_height_width'],
+	                            params['actor']['n_step_transition_batch_size']), params['actor']['transport_slots'])
 
 	params['actor']['wait_shared_memory_clear'] = False
 
-	status_dict['quit'] = False
-	status_dict['Q_state_dict_stored'] = False
-	status_dict['request_quit'] = False
-
-	l = learner.Learner(params, param_set_id, status_dict, shared_state, shared_mem)
-
-	actor = Actor(params, param_set_id, 0, status_dict, shared_state, shared_mem)
-	actor.run()
+	l = learner.Learner(params, param_set_id, control, shared_mem)
+
+	actor = Actor(params, param_set_id, 0, control, shared_mem)
+
+	# 共有メモリのスロット数は有限なので、Actor は別スレッドで動かし Learner の代わりに読み捨てる
+	# Actor が T ステップ進んだら終了させ、送信途中で止まらない様に終了するまで読み捨て続ける
+	actor_thread = threading.Thread(target=actor.run)
+	actor_thread.start()
+	while actor_thread.is_alive():
+		if params['actor']['T'] <= control.actor_steps[0]:
+			control.request_quit = True
+		shared_mem.wait(0.1)
+		shared_mem.drain(lambda priorities, batch: None)
+	control.quit = True
+	l.shared_weights.close()
+	shared_mem.close()
+	control.close()
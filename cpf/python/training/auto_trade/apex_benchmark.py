@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+import os
+import time
+import datetime
+import json
+import tempfile
+import multiprocessing as mp
+from argparse import ArgumentParser
+import numpy as np
+
+import db_initializer
+import replay
+import transport
+import synthetic_data
+from actor import Actor
+from learner import Learner
+
+arg_parser = ArgumentParser(prog="apex_benchmark.py")
+arg_parser.add_argument("--params-file", default="parameters.json", type=str, help="Base parameters file")
+arg_parser.add_argument("--actors", default=None, type=str,
+                        help="Comma separated numbers of actor processes, powers of two up to the core count if omitted")
+arg_parser.add_argument("--seconds", default=20.0, type=float, help="Seconds to measure each case")
+arg_parser.add_argument("--warmup", default=5.0, type=float, help="Seconds to run after the learner starts before measuring")
+arg_parser.add_argument("--start-timeout", default=600.0, type=float, help="Seconds to wait for the learner to start")
+arg_parser.add_argument("--sample-interval", default=0.05, type=float, help="Seconds between queue depth samples")
+arg_parser.add_argument("--data", default=None, type=str, help="Binary history file, a synthetic one is generated if omitted")
+arg_parser.add_argument("--records", default=200000, type=int, help="Number of records of the synthetic history file")
+arg_parser.add_argument("--sink", default="sqlite", choices=["sqlite", "none", "params"],
+                        help="Where actor and learner logs go: a temporary SQLite file, nowhere or the parameters file DB")
+arg_parser.add_argument("--set", default=[], nargs="*", type=str, metavar="SECTION.KEY=JSON", help="Override parameters")
+arg_parser.add_argument("--output", default="apex_benchmark.json", type=str, help="JSON file to write the results to")
+args = arg_parser.parse_args()
+
+
+def learner(params, param_set_id, control, shared_mem, flow):
+	learner = Learner(params, param_set_id, control, shared_mem, flow)
+	learner.learn()
+
+
+def actor(params, param_set_id, i, control, shared_mem, flow):
+	actor = Actor(params, param_set_id, i, control, shared_mem, None, flow)
+	actor.run()
+
+
+def get_counters(control):
+	"""計測に使う通算値."""
+	return dict(time=time.perf_counter(),
+	            env_steps=int(control.actor_steps.sum()),
+	            inserted=control.inserted_num,
+	            updates=control.train_num,
+	            syncs=int(control.actor_sync_num.sum()),
+	            sync_latency=float(control.actor_sync_latency.sum()))
+
+
+def stop(control, learner_proc, actor_procs):
+	"""train.py と同じ順に Actor、Learner を終了させる."""
+	control.request_quit = True
+	for p in actor_procs:
+		p.join()
+	control.quit = True
+	learner_proc.join()
+
+
+def run(params, param_set_id, actor_num):
+	"""train.py と同じ構成で actor_num 個の Actor と１つの Learner を動かし、学習開始後の処理速度を計測する."""
+	ap = params['actor']
+	control = transport.ControlBlock(actor_num)
+	shared_mem = transport.SharedMemoryQueue(
+	    replay.get_batch_fields(params['replay_memory'], params['env']['frames_height_width'],
+	                            ap['n_step_transition_batch_size']), ap['transport_slots'])
+	flow = None
+	if ap['wait_shared_memory_clear']:
+		flow = transport.FlowControl(actor_num, ap['transport_credits'], params['learner']['target_replay_ratio'])
+
+	learner_proc = mp.Process(target=learner, args=(params, param_set_id, control, shared_mem, flow))
+	learner_proc.start()
+	while not control.Q_state_dict_stored:
+		time.sleep(0.001)
+	start_train_num = control.train_num
+
+	actor_procs = []
+	for i in range(actor_num):
+		p = mp.Process(target=actor, args=(params, param_set_id, i, control, shared_mem, flow))
+		p.start()
+		actor_procs.append(p)
+
+	# リプレイメモリが溜まって学習が始まるのを待ってから計測する
+	t = time.perf_counter()
+	while control.train_num == start_train_num:
+		if args.start_timeout < time.perf_counter() - t or not learner_proc.is_alive():
+			stop(control, learner_proc, actor_procs)
+			shared_mem.close()
+			control.close()
+			raise RuntimeError(f'Learner did not start within {args.start_timeout} seconds')
+		time.sleep(0.1)
+	start_seconds = time.perf_counter() - t
+	time.sleep(args.warmup)
+
+	start = get_counters(control)
+	depths = []
+	while time.perf_counter() - start['time'] < args.seconds:
+		depths.append(shared_mem.qsize())
+		time.sleep(args.sample_interval)
+	end = get_counters(control)
+
+	stop(control, learner_proc, actor_procs)
+	shared_mem.close()
+	control.close()
+
+	d = {k: end[k] - start[k] for k in start}
+	elapsed = d['time']
+	depths = np.array(depths)
+	return dict(actors=actor_num,
+	            seconds=elapsed,
+	            learner_start_seconds=start_seconds,
+	            env_steps_per_sec=d['env_steps'] / elapsed,
+	            transitions_inserted_per_sec=d['inserted'] / elapsed,
+	            learner_updates_per_sec=d['updates'] / elapsed,
+	            replay_ratio=d['updates'] / d['inserted'] if d['inserted'] else None,
+	            weight_syncs_per_sec=d['syncs'] / elapsed,
+	            weight_sync_latency_ms=d['sync_latency'] / d['syncs'] * 1000 if d['syncs'] else None,
+	            queue_depth_mean=float(depths.mean()),
+	            queue_depth_max=int(depths.max()),
+	            queue_slots=ap['transport_slots'])
+
+
+if __name__ == "__main__":
+	with open(args.params_file, 'r') as f:
+		params = json.load(f)
+	for kv in args.set:
+		k, v = kv.split('=', 1)
+		section, key = k.split('.')
+		params[section][key] = json.loads(v)
+
+	if args.actors:
+		actor_nums = [int(s) for s in args.actors.split(',')]
+	else:
+		cpu_count = os.cpu_count()
+		actor_nums = sorted(set([2**i for i in range(cpu_count.bit_length()) if 2**i <= cpu_count] + [cpu_count]))
+
+	results = []
+	with tempfile.TemporaryDirectory() as tmpdir:
+		ep = params['env']
+		if args.data:
+			ep['data_file'] = args.data
+		else:
+			ep['data_file'] = os.path.join(tmpdir, 'synthetic.dat')
+			synthetic_data.write(ep['data_file'], args.records)
+
+		dp = params['db']
+		if args.sink == 'sqlite':
+			dp['connection_string'] = f'sqlite:{os.path.join(tmpdir, "apex_benchmark.db")}'
+		elif args.sink == 'none':
+			dp['connection_string'] = None
+
+		for actor_num in actor_nums:
+			# 保存済みの重みや Actor の状態を読み込まないよう、毎回一時ディレクトリ内の別名にする
+			params['learner']['state_dict_prefix'] = os.path.join(tmpdir, f'apex_{actor_num}')
+			params['actor']['num_actors'] = actor_num
+			param_set_id = db_initializer.initialize(params) if dp['connection_string'] is not None else 0
+
+			r = run(params, param_set_id, actor_num)
+			results.append(r)
+			print(f'actors: {actor_num:>3} env steps/s: {r["env_steps_per_sec"]:9.1f} '
+			      f'inserts/s: {r["transitions_inserted_per_sec"]:9.1f} updates/s: {r["learner_updates_per_sec"]:8.1f} '
+			      f'weight sync latency: {r["weight_sync_latency_ms"] or 0:8.2f} ms '
+			      f'queue depth: {r["queue_depth_mean"]:6.2f} / {r["queue_depth_max"]}')
+
+	output = dict(timestamp=datetime.datetime.now().isoformat(),
+	              cpu_count=os.cpu_count(),
+	              sink=args.sink,
+	              data=args.data,
+	              records=None if args.data else args.records,
+	              seconds=args.seconds,
+	              warmup=args.warmup,
+	              params={k: params[k] for k in ('env', 'actor', 'learner', 'replay_memory')},
+	              results=results)
+	with open(args.output, 'w') as f:
+		json.dump(output, f, indent=1)
+	print(f'Results written to {args.output}')
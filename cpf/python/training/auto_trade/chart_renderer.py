@@ -0,0 +1,192 @@
+import typing
+import collections
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import cv2
+
+ma_kernel_sizes = np.array([5, 15, 31, 61], np.int64)
+ma_kernel_size_halfs = ma_kernel_sizes // 2
+ma_kernels = [np.ones(size) / size for size in ma_kernel_sizes]
+ma_value_types = (1, 2, 3) # 移動平均を計算する値の種類、high, low, close
+
+grid_interval = 50 # 目盛りの間隔
+grid_color = 0.1 # 目盛りの色
+indicator_color = 1.0 # ポジション損益と現在値の線の色
+ma_color = 0.3 # 移動平均線の色
+value_color = 0.7 # open, high, low, close 線の色
+
+
+class ChartRenderer:
+	"""TradeEnvironment のチャート画像を描画するクラス.
+
+	エピソード開始時に全移動平均と窓毎の表示範囲を一括計算しておき、描画時は全系列の座標を一度に計算して色毎に１回の cv2.polylines で描画する.
+	複数ステップ分の画像をまとめて描画することもできる.
+
+	Args:
+		height_width: 画像の (高さ, 幅).
+		window_size: 表示する分足の数.
+		episode_cache_size: エピソード毎の計算結果をキャッシュする最大エピソード数.
+	"""
+
+	def __init__(self, height_width: typing.Tuple[int, int], window_size: int, episode_cache_size: int = 64) -> None:
+		self.h = height_width[0] # 画像高さ(px)
+		self.w = height_width[1] # 画像幅(px)
+		self.window_size = window_size # 表示する分足の数
+		self.chart_x = 5 # チャート部のX左端(px)
+		self.chart_y = 0 # チャート部のY上端(px)
+		self.chart_w = self.w - 10 # チャート部の幅(px)
+		self.chart_h = self.h # チャート部の高さ(px)
+
+		self.episode_time = None # １エピソード全体分の time 値
+		self.episode_values = None # １エピソード全体分の open, high, low, close 値
+		self.series = None # 描画する全系列、移動平均と open, high, low, close の順、(系列数, エピソード長)
+		self.ma_num = len(ma_kernel_sizes) * len(ma_value_types) # series 内の移動平均系列の数
+		self.ma_starts = np.repeat(ma_kernel_size_halfs * 2, len(ma_value_types)) # 各移動平均系列が有効となる最小インデックス
+		self.window_min = None # 窓先頭インデックス毎の表示対象全系列の最小値
+		self.window_max = None # 窓先頭インデックス毎の表示対象全系列の最大値
+		self.episode_cache_size = episode_cache_size # キャッシュする最大エピソード数
+		self.episode_cache = collections.OrderedDict() # エピソードキーから (series, window_min, window_max) へのキャッシュ、古く使われたものから捨てる
+
+	def set_episode(self, episode_time: np.ndarray, episode_values: np.ndarray, episode_key: typing.Hashable = None) -> None:
+		"""エピソード全体の値を設定し、移動平均と窓毎の表示範囲を計算する.
+
+		Args:
+			episode_time: １エピソード全体分の time 値.
+			episode_values: １エピソード全体分の open, high, low, close 値.
+			episode_key: エピソードを識別するキー、指定されたら計算結果をキャッシュし同じキーで再利用する.
+		"""
+		self.episode_time = episode_time.astype(np.int64)
+		self.episode_values = episode_values
+
+		cache = self.episode_cache
+		if episode_key is not None and episode_key in cache:
+			cache.move_to_end(episode_key)
+			self.series, self.window_min, self.window_max = cache[episode_key]
+			return
+
+		# 移動平均は各点で終わる区間の平均とし、窓内の点と同じ位置に揃える、値が無い位置は 0
+		# 従来の窓毎の描画と画素単位で一致する様、同じカーネルの np.convolve でエピソード全体を一度に計算する
+		n = len(episode_values)
+		series = np.zeros((self.ma_num + 4, n), np.float64)
+		for ki, kernel in enumerate(ma_kernels):
+			offset = ma_kernel_size_halfs[ki] * 2
+			if offset < n:
+				i = ki * len(ma_value_types)
+				for j, value_type in enumerate(ma_value_types):
+					series[i + j, offset:] = np.convolve(episode_values[:, value_type], kernel, mode='valid')
+		series[self.ma_num:] = episode_values.T
+		self.series = series
+
+		# 窓先頭インデックス毎の表示範囲、移動平均は窓全体で値がある場合のみ対象とする
+		windows = sliding_window_view(series, self.window_size, axis=1)
+		valid = self.ma_starts[:, None] <= np.arange(windows.shape[1])
+		self.window_min = np.minimum(
+		    np.where(valid, windows[:self.ma_num].min(axis=2), np.inf).min(axis=0),
+		    windows[self.ma_num:].min(axis=(0, 2)))
+		self.window_max = np.maximum(
+		    np.where(valid, windows[:self.ma_num].max(axis=2), -np.inf).max(axis=0),
+		    windows[self.ma_num:].max(axis=(0, 2)))
+
+		if episode_key is not None and self.episode_cache_size:
+			cache[episode_key] = (self.series, self.window_min, self.window_max)
+			if self.episode_cache_size < len(cache):
+				cache.popitem(last=False)
+
+	def render(self,
+	           out: np.ndarray,
+	           indices_in_episode: np.ndarray,
+	           position_types: np.ndarray = None,
+	           position_start_values: np.ndarray = None) -> np.ndarray:
+		"""エピソード内の指定インデックスを最新値としたチャート画像をまとめて描画する.
+
+		Args:
+			out: 描画先の (画像数, 1, 高さ, 幅) の float32 配列.
+			indices_in_episode: 各画像の最新値のエピソード内インデックス.
+			position_types: 各画像のポジションタイプ、0: なし、1: 買い、-1: 売り、None なら全てポジション無し.
+			position_start_values: 各画像のポジション持った時の値.
+
+		Returns:
+			out.
+		"""
+		indices_in_episode = np.asarray(indices_in_episode, np.int64)
+		num = len(indices_in_episode)
+		if position_types is None:
+			position_types = np.zeros(num, np.int64)
+			position_start_values = np.zeros(num, np.int64)
+		position_types = np.asarray(position_types)
+		position_start_values = np.asarray(position_start_values)
+
+		h = self.h
+		w = self.w
+		h_max = h - 1
+		chart_x = self.chart_x
+		chart_y = self.chart_y
+		chart_right = chart_x + self.chart_w
+		chart_bottom = chart_y + self.chart_h
+		chart_w_for_scale = self.chart_w - 1
+		chart_h_for_scale = self.chart_h - 1
+		window_size = self.window_size
+		starts = indices_in_episode + 1 - window_size
+		window = starts[:, None] + np.arange(window_size)
+		rows = np.arange(h)
+
+		imgs = out[:, 0]
+		imgs[:] = 0
+		charts = imgs[:, chart_y:chart_bottom, chart_x:chart_right]
+
+		# 表示範囲となる最大最小
+		time = self.episode_time[window]
+		time_max = time.max(axis=1)
+		time_min = time_max - window_size * 60
+		values_min = self.window_min[starts]
+		values_max = self.window_max[starts]
+		has_position = position_types != 0
+		values_min = np.where(has_position, np.minimum(values_min, position_start_values), values_min)
+		values_max = np.where(has_position, np.maximum(values_max, position_start_values), values_max)
+
+		time_scale = chart_w_for_scale / (time_max - time_min)
+		value_scale = -chart_h_for_scale / (values_max - values_min)
+		value_translate = chart_h_for_scale - values_min * value_scale
+
+		close = self.episode_values[indices_in_episode, 3]
+		cur = np.rint(close * value_scale + value_translate).astype(np.int64)
+		pos = np.rint(position_start_values * value_scale + value_translate).astype(np.int64)
+		positional_reward = np.where(position_start_values != 0, (close - position_start_values) * position_types, 0)
+
+		# 目盛り描画、目盛り値は np.arange と同じ計算で求める
+		grid_start = values_min - values_min % grid_interval
+		grid_stop = values_max + (grid_interval + 1) - values_max % grid_interval
+		grid_count = np.maximum(np.ceil((grid_stop - grid_start) / grid_interval), 0).astype(np.int64)
+		grid_images = np.repeat(np.arange(num), grid_count)
+		grid_k = np.arange(len(grid_images)) - np.repeat(np.cumsum(grid_count) - grid_count, grid_count)
+		grid_y = np.rint((grid_start[grid_images] + grid_k * ((grid_start + grid_interval) - grid_start)[grid_images]) *
+		                 value_scale[grid_images] + value_translate[grid_images]).astype(np.int32)
+		m = (0 <= grid_y) & (grid_y < charts.shape[1])
+		grid_rows = np.zeros(charts.shape[:2], np.bool_)
+		grid_rows[grid_images[m], grid_y[m]] = True
+		charts[grid_rows] = grid_color
+
+		# ポジション持っていたら、ポジった値から現在値まで塗りつぶす
+		fill = has_position & (positional_reward != 0)
+		if fill.any():
+			fill_rows = (np.maximum(np.minimum(pos, cur), 0)[:, None] <= rows) & (rows <= np.minimum(np.maximum(pos, cur), h_max)[:, None])
+			imgs[:, :, :5][fill_rows & (fill & (positional_reward < 0))[:, None]] = indicator_color
+			imgs[:, :, w - 5:][fill_rows & (fill & (0 < positional_reward))[:, None]] = indicator_color
+
+		# 現在値として水平線を描画
+		cur_rows = ((0 <= cur) & (cur < h))[:, None] & (cur[:, None] - 1 <= rows) & (rows <= cur[:, None] + 1)
+		imgs[cur_rows] = indicator_color
+
+		# 全系列の座標を一括計算し、移動平均線の後に open, high, low, close を色毎に１回で描画する
+		pts = np.empty((num, len(self.series), window_size, 2), np.int32)
+		pts[:, :, :, 0] = np.rint((time - time_min[:, None]) * time_scale[:, None])[:, None, :]
+		pts[:, :, :, 1] = np.rint(self.series[:, window].transpose(1, 0, 2) * value_scale[:, None, None] +
+		                          value_translate[:, None, None])
+		ma_visible = np.searchsorted(self.ma_starts, starts, side='right')
+		ma_num = self.ma_num
+		for i in range(num):
+			if ma_visible[i]:
+				cv2.polylines(charts[i], pts[i, :ma_visible[i]], False, ma_color)
+			cv2.polylines(charts[i], pts[i, ma_num:], False, value_color)
+
+		return out
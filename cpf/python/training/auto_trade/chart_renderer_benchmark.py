@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import time
+from argparse import ArgumentParser
+import numpy as np
+import cv2
+
+import trade_environment
+import synthetic_data
+from chart_renderer import ChartRenderer, ma_kernel_sizes, ma_kernel_size_halfs, ma_kernels
+
+arg_parser = ArgumentParser(prog="chart_renderer_benchmark.py")
+arg_parser.add_argument("--data", default=None, type=str, help="Binary history file, a synthetic one is generated if omitted")
+arg_parser.add_argument("--records", default=200000, type=int, help="Number of records of the synthetic history file")
+arg_parser.add_argument("--frames", default=5000, type=int, help="Number of frames to render")
+arg_parser.add_argument("--batch-sizes", default="1,16,64", type=str, help="Comma separated batch sizes for batch rendering")
+arg_parser.add_argument("--window-size", default=30, type=int, help="Number of candles in a chart")
+arg_parser.add_argument("--height-width", default="200,240", type=str, help="Image size (height,width)")
+arg_parser.add_argument("--seed", default=0, type=int, help="Random seed")
+args = arg_parser.parse_args()
+
+
+
+def draw_img_cv2(img, episode_time, episode_values, index_in_episode, window_size, position_type, position_start_value):
+	"""従来の TradeEnvironment.draw_img と同じ処理で描画する、比較用."""
+	end = index_in_episode + 1
+	h = img.shape[1]
+	w = img.shape[2]
+	chart_x = 5
+	chart_y = 0
+	chart_w = w - 10
+	chart_h = h
+	chart_w_for_scale = chart_w - 1
+	chart_h_for_scale = chart_h - 1
+	chart_right = chart_x + chart_w
+	chart_bottom = chart_y + chart_h
+	h_max = h - 1
+
+	img[:] = 0
+	positional_reward = (episode_values[index_in_episode, 3].item() - position_start_value) * position_type if position_start_value else 0
+
+	if positional_reward < 0:
+		ind_x1 = 0
+		ind_x2 = 5
+	elif 0 < positional_reward:
+		ind_x1 = w - 5
+		ind_x2 = w
+
+	time = episode_time[end - window_size:end]
+	values = episode_values[end - window_size:end]
+	ma = []
+
+	for ki in range(len(ma_kernel_sizes)):
+		size_needed = window_size + ma_kernel_size_halfs[ki] * 2
+		if size_needed <= end:
+			start = end - size_needed
+			ma.append(np.convolve(episode_values[start:end, 1], ma_kernels[ki], mode='valid'))
+			ma.append(np.convolve(episode_values[start:end, 2], ma_kernels[ki], mode='valid'))
+			ma.append(np.convolve(episode_values[start:end, 3], ma_kernels[ki], mode='valid'))
+
+	time_max = time.max()
+	time_min = time_max - window_size * 60
+	values_min = values.min()
+	values_max = values.max()
+
+	for y in ma:
+		values_min = min(values_min, y.min())
+		values_max = max(values_max, y.max())
+
+	if position_type:
+		values_min = min(values_min, position_start_value)
+		values_max = max(values_max, position_start_value)
+
+	time_scale = chart_w_for_scale / (time_max - time_min)
+	value_scale = -chart_h_for_scale / (values_max - values_min)
+	value_translate = chart_h_for_scale - values_min * value_scale
+
+	cur = int(np.rint(values[-1, 3] * value_scale + value_translate).item())
+	if position_type:
+		pos = int(np.rint(position_start_value * value_scale + value_translate).item())
+	else:
+		pos = 0
+
+	trg = img[0]
+	chart_trg = trg[chart_y:chart_bottom, chart_x:chart_right]
+
+	for y in np.rint(
+	    np.arange(values_min - values_min % 50, values_max + 51 - (values_max % 50), 50) * value_scale +
+	    value_translate).astype(np.int32):
+		if 0 <= y and y < chart_trg.shape[0]:
+			chart_trg[y, :] = 0.1
+
+	if position_type and positional_reward:
+		ind_y1 = max(min(pos, cur), 0)
+		ind_y2 = min(max(pos, cur), h_max) + 1
+		trg[ind_y1:ind_y2, ind_x1:ind_x2] = 1
+
+	if 0 <= cur and cur < h:
+		cur_y1 = max(cur - 1, 0)
+		cur_y2 = min(cur + 1, h_max) + 1
+		trg[cur_y1:cur_y2, :] = 1.0
+
+	pts = np.empty((values.shape[0], 1, 2), dtype=np.int32)
+	pts[:, 0, 0] = np.rint((time - time_min) * time_scale)
+
+	for y in ma:
+		pts[:, 0, 1] = np.rint(y * value_scale + value_translate)
+		cv2.polylines(chart_trg, [pts], False, 0.3)
+
+	for value_type in range(4):
+		pts[:, 0, 1] = np.rint(values[:, value_type] * value_scale + value_translate)
+		cv2.polylines(chart_trg, [pts], False, 0.7)
+
+
+def load_episodes(filepath, window_size):
+	"""描画に使えるエピソードの (time, values) 一覧を読み込む."""
+	records = trade_environment.read_records(filepath)
+	eps = trade_environment.get_separation_indices(records)
+	episodes = []
+	for i1, i2 in zip(eps[:-1], eps[1:]):
+		if window_size * 2 <= i2 - i1:
+			rcds = records[i1:i2]
+			values = np.stack([rcds[name] for name in ('open', 'high', 'low', 'close')], axis=1)
+			episodes.append((rcds['time'].astype(np.int64), values))
+	return episodes
+
+
+def make_frames(rng, episodes, window_size, num):
+	"""エピソードを先頭から順に進めた際のインデックスとポジションの組み合わせを作成する、ポジションはランダムに持ち決済する."""
+	frames = []
+	while len(frames) < num:
+		ei = int(rng.integers(len(episodes)))
+		episode_values = episodes[ei][1]
+		position_type = 0
+		position_start_value = 0
+		for index in range(window_size, len(episode_values)):
+			if rng.random() < 0.05:
+				if position_type:
+					position_type = 0
+					position_start_value = 0
+				else:
+					position_type = int(rng.choice([-1, 1]))
+					position_start_value = int(episode_values[index, 3]) + position_type * 5
+			frames.append((ei, index, position_type, position_start_value))
+	return frames[:num]
+
+
+if __name__ == "__main__":
+	if args.data is None:
+		tmpdir, args.data = synthetic_data.write_temporary(args.records, seed=args.seed)
+	rng = np.random.default_rng(args.seed)
+	window_size = args.window_size
+	height_width = tuple(int(s) for s in args.height_width.split(','))
+	episodes = load_episodes(args.data, window_size)
+	frames = make_frames(rng, episodes, window_size, args.frames)
+
+	# 画素単位での一致確認
+	renderer = ChartRenderer(height_width, window_size)
+	expected = np.zeros((1,) + height_width, np.float32)
+	actual = np.zeros((1, 1) + height_width, np.float32)
+	mismatch = 0
+	max_pixels = 0
+	last_ei = -1
+	for ei, index, position_type, position_start_value in frames:
+		if ei != last_ei:
+			renderer.set_episode(*episodes[ei])
+			last_ei = ei
+		draw_img_cv2(expected, *episodes[ei], index, window_size, position_type, position_start_value)
+		renderer.render(actual, [index], [position_type], [position_start_value])
+		pixels = np.count_nonzero(expected != actual[0])
+		mismatch += 0 < pixels
+		max_pixels = max(max_pixels, pixels)
+	print(f'frame mismatches against cv2 renderer: {mismatch} / {len(frames)} max mismatched pixels in a frame: {max_pixels}')
+	if mismatch:
+		raise RuntimeError('Vectorized renderer does not match cv2 renderer')
+
+	# エピソード開始時の前計算、キャッシュ無しと有り
+	# キャッシュ有りはキャッシュに収まる数のエピソードを繰り返し切り替える
+	cache_episodes = episodes[:renderer.episode_cache_size // 2]
+	t = time.perf_counter()
+	for episode in cache_episodes:
+		renderer.set_episode(*episode)
+	t_cold = (time.perf_counter() - t) / len(cache_episodes)
+	for ei, episode in enumerate(cache_episodes):
+		renderer.set_episode(*episode, ei)
+	repeat = 10
+	t = time.perf_counter()
+	for _ in range(repeat):
+		for ei, episode in enumerate(cache_episodes):
+			renderer.set_episode(*episode, ei)
+	t_cached = (time.perf_counter() - t) / (len(cache_episodes) * repeat)
+	print(f'set_episode: {t_cold * 1000:8.3f} ms cached: {t_cached * 1000:8.3f} ms ({len(cache_episodes)} episodes)')
+
+	# cv2 による従来の描画
+	t = time.perf_counter()
+	for ei, index, position_type, position_start_value in frames:
+		draw_img_cv2(expected, *episodes[ei], index, window_size, position_type, position_start_value)
+	fps_cv2 = len(frames) / (time.perf_counter() - t)
+	print(f'cv2 renderer: {fps_cv2:10.0f} frames/s')
+
+	# ベクトル化した描画、エピソード切り替え時の前計算も含める
+	for batch_size in [int(s) for s in args.batch_sizes.split(',')]:
+		out = np.zeros((batch_size, 1) + height_width, np.float32)
+		runs = []
+		for ei, index, position_type, position_start_value in frames:
+			if not runs or runs[-1][0] != ei or runs[-1][1][-1][0] + 1 != index:
+				runs.append((ei, []))
+			runs[-1][1].append((index, position_type, position_start_value))
+		t = time.perf_counter()
+		for ei, items in runs:
+			renderer.set_episode(*episodes[ei], ei)
+			items = np.array(items, np.int64)
+			for i in range(0, len(items), batch_size):
+				b = items[i:i + batch_size]
+				renderer.render(out[:len(b)], b[:, 0], b[:, 1], b[:, 2])
+		fps = len(frames) / (time.perf_counter() - t)
+		print(f'vectorized renderer batch: {batch_size:>4} {fps:10.0f} frames/s speedup: {fps / fps_cv2:6.1f}x')
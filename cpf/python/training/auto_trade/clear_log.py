@@ -1,20 +1,52 @@
+import sys
 import json
-import psycopg2
 
+import db
 import tables
 
+# 引数無しなら全テーブルを削除し、param_set_id を指定したらそのパラメータセットのログのパーティションのみ切り離して削除する
+param_set_ids = [int(a) for a in sys.argv[1:]]
+
 with open('parameters.json', 'r') as f:
 	params = json.load(f)
 
 dbp = params['db']
-with psycopg2.connect(dbp['connection_string']) as conn:
+with db.connect(dbp['connection_string']) as conn:
 	conn.autocommit = True
 	with conn.cursor() as cur:
 		ps = tables.ParamSet()
 		ad = tables.ActorData()
 		ld = tables.LearnerData()
 		rad = tables.RewardAdjData()
-		cur.execute(ps.get_drop_statement())
-		cur.execute(ad.get_drop_statement())
-		cur.execute(ld.get_drop_statement())
-		cur.execute(rad.get_drop_statement())
+		ls = tables.LearnerSummary()
+		es = tables.ActorEpisodeSummary()
+		ts = tables.ActorTrainSummary()
+		rs = tables.RollupState()
+		if len(param_set_ids) == 0:
+			cur.execute(ps.get_drop_statement())
+			cur.execute(ad.get_drop_statement())
+			cur.execute(ld.get_drop_statement())
+			cur.execute(rad.get_drop_statement())
+			cur.execute(ls.get_drop_statement())
+			cur.execute(es.get_drop_statement())
+			cur.execute(ts.get_drop_statement())
+			cur.execute(rs.get_drop_statement())
+		else:
+			for t in (ad, ld, rad, ls, es, ts):
+				if not db.get_backend(cur).partitioning:
+					# SQLite にはパーティションが無いので行を削除する
+					if t.get_relkind(cur) is not None:
+						for param_set_id in param_set_ids:
+							cur.execute(f'DELETE FROM {t._name} WHERE param_set_id=%s;', (param_set_id,))
+						print(f'{t._name} rows of {param_set_ids} deleted.')
+					continue
+				if t.get_relkind(cur) != 'p':
+					print(f'{t._name} is not partitioned, run clear_log.py without arguments to recreate it.')
+					continue
+				for param_set_id in param_set_ids:
+					if t.get_relkind(cur, t.get_partition_name(param_set_id)) is not None:
+						cur.execute(t.get_detach_partition_statement(param_set_id))
+						print(f'{t.get_partition_name(param_set_id)} dropped.')
+			if rs.get_relkind(cur) is not None:
+				for param_set_id in param_set_ids:
+					cur.execute('DELETE FROM rollup_state WHERE param_set_id=%s;', (param_set_id,))
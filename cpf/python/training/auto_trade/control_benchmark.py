@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import time
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+import transport
+
+arg_parser = ArgumentParser(prog="control_benchmark.py")
+arg_parser.add_argument("--actors", default="1,4,8", type=str, help="Comma separated numbers of actor processes")
+arg_parser.add_argument("--work-us", default="0,100,1000", type=str, help="Comma separated microseconds of work per actor step")
+arg_parser.add_argument("--seconds", default=2.0, type=float, help="Seconds to run each case")
+args = arg_parser.parse_args()
+
+
+class DictControl:
+	"""従来の mp.Manager の dict を ControlBlock と同じ属性で読み書きする."""
+
+	def __init__(self, status_dict):
+		self.status_dict = status_dict
+
+	@property
+	def quit(self):
+		return self.status_dict['quit']
+
+	@quit.setter
+	def quit(self, value):
+		self.status_dict['quit'] = value
+
+	@property
+	def request_quit(self):
+		return self.status_dict['request_quit']
+
+	@request_quit.setter
+	def request_quit(self, value):
+		self.status_dict['request_quit'] = value
+
+	@property
+	def train_num(self):
+		return self.status_dict['train_num']
+
+	@train_num.setter
+	def train_num(self, value):
+		self.status_dict['train_num'] = value
+
+
+def busy(us):
+	"""環境の step や推論の代わりに us マイクロ秒 CPU を使う."""
+	deadline = time.perf_counter() + us * 1e-6
+	while time.perf_counter() < deadline:
+		pass
+
+
+def actor(control, work_us, ready, start, results):
+	"""Actor の run と同じく毎ステップ終了要求と学習回数を読む."""
+	ready.release()
+	start.wait()
+	steps = 0
+	while not control.request_quit:
+		busy(work_us)
+		train_num = control.train_num
+		steps += 1
+	results.put(steps)
+
+
+def learner(control, ready, start, results):
+	"""Learner の learn と同じく毎回終了指示を読み学習回数を書く."""
+	ready.release()
+	start.wait()
+	train_num = 0
+	while not control.quit:
+		busy(100)
+		train_num += 1
+		control.train_num = train_num
+	results.put(train_num)
+
+
+def run(control, actor_num, work_us):
+	"""actor_num 個の Actor と１つの Learner を args.seconds 秒動かし、(Actor の合計ステップ/秒, 学習回数/秒) を返す."""
+	control.quit = False
+	control.request_quit = False
+	control.train_num = 0
+	ready = mp.Semaphore(0)
+	start = mp.Event()
+	actor_results = mp.Queue()
+	learner_results = mp.Queue()
+	procs = [mp.Process(target=actor, args=(control, work_us, ready, start, actor_results)) for _ in range(actor_num)]
+	procs.append(mp.Process(target=learner, args=(control, ready, start, learner_results)))
+	for p in procs:
+		p.start()
+	for p in procs:
+		ready.acquire()
+	t = time.perf_counter()
+	start.set()
+	time.sleep(args.seconds)
+	control.request_quit = True
+	control.quit = True
+	steps = sum(actor_results.get() for _ in range(actor_num))
+	train_num = learner_results.get()
+	elapsed = time.perf_counter() - t
+	for p in procs:
+		p.join()
+	return steps / elapsed, train_num / elapsed
+
+
+if __name__ == "__main__":
+	mp_manager = mp.Manager()
+	dict_control = DictControl(mp_manager.dict())
+	block_control = transport.ControlBlock(1)
+
+	for actor_num in [int(s) for s in args.actors.split(',')]:
+		for work_us in [int(s) for s in args.work_us.split(',')]:
+			dict_steps, dict_trains = run(dict_control, actor_num, work_us)
+			block_steps, block_trains = run(block_control, actor_num, work_us)
+			print(f'actors: {actor_num} work: {work_us:5d} us '
+			      f'actor steps/s manager dict: {dict_steps:10.0f} control block: {block_steps:10.0f} ({block_steps / dict_steps:6.1f}x) '
+			      f'learner updates/s manager dict: {dict_trains:8.0f} control block: {block_trains:8.0f}')
+
+	block_control.close()
+	mp_manager.shutdown()
@@ -1,13 +1,31 @@
+import io
+import json
+import math
+import time
+import struct
 import datetime
+import weakref
+import itertools
+import threading
+import collections
+import sqlite3
 from collections import namedtuple
+import numpy as np
 import psycopg2
+import psycopg2.extras
 
 
 class Type:
 
-	def __init__(self, type_name, is_serial=False):
+	def __init__(self, type_name, is_serial=False, oid=None, fmt=None, element=None, dtype=None):
 		self.type_name = type_name
 		self.is_serial = is_serial
+		self.oid = oid # バイナリ形式の COPY で使う型の OID
+		self.fmt = fmt # バイナリ形式での struct フォーマット文字、可変長なら None
+		self.element = element # 配列型なら要素の型
+		if dtype is None:
+			dtype = fmt if fmt is not None and element is None else object
+		self.dtype = np.dtype(dtype) # numpy で読み込む際の型、固定長でなければ object
 
 	def __str__(self):
 		return self.type_name
@@ -16,26 +34,521 @@ class Type:
 		return self.type_name
 
 
-serial32 = Type('serial', True)
-serial64 = Type('bigserial', True)
-boolean = Type('boolean')
-int16 = Type('smallint')
-int32 = Type('integer')
-int64 = Type('bigint')
-float32 = Type('real')
-float64 = Type('double precision')
-text = Type('text')
-timestamp = Type('timestamp')
-array_serial32 = Type('serial[]')
-array_serial64 = Type('bigserial[]')
-array_boolean = Type('boolean[]')
-array_int16 = Type('smallint[]')
-array_int32 = Type('integer[]')
-array_int64 = Type('bigint[]')
-array_float32 = Type('real[]')
-array_float64 = Type('double precision[]')
-array_text = Type('text[]')
-array_timestamp = Type('timestamp[]')
+serial32 = Type('serial', True, 23, 'i')
+serial64 = Type('bigserial', True, 20, 'q')
+boolean = Type('boolean', oid=16, fmt='?')
+int16 = Type('smallint', oid=21, fmt='h')
+int32 = Type('integer', oid=23, fmt='i')
+int64 = Type('bigint', oid=20, fmt='q')
+float32 = Type('real', oid=700, fmt='f')
+float64 = Type('double precision', oid=701, fmt='d')
+text = Type('text', oid=25)
+timestamp = Type('timestamp', oid=1114, fmt='q', dtype='datetime64[us]')
+array_serial32 = Type('serial[]', oid=1007, element=serial32)
+array_serial64 = Type('bigserial[]', oid=1016, element=serial64)
+array_boolean = Type('boolean[]', oid=1000, element=boolean)
+array_int16 = Type('smallint[]', oid=1005, element=int16)
+array_int32 = Type('integer[]', oid=1007, element=int32)
+array_int64 = Type('bigint[]', oid=1016, element=int64)
+array_float32 = Type('real[]', oid=1021, element=float32)
+array_float64 = Type('double precision[]', oid=1022, element=float64)
+array_text = Type('text[]', oid=1009, element=text)
+array_timestamp = Type('timestamp[]', oid=1115, element=timestamp)
+
+pg_epoch = datetime.datetime(2000, 1, 1) # バイナリ形式の timestamp の基準日時
+unix_epoch = datetime.datetime(1970, 1, 1) # SQLite に整数で格納する timestamp の基準日時
+pg_epoch_us = np.datetime64(pg_epoch, 'us').astype(np.int64) # pg_epoch の UNIX 時間でのマイクロ秒
+one_microsecond = datetime.timedelta(microseconds=1)
+copy_text_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+copy_binary_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+copy_binary_trailer = struct.pack('!h', -1)
+copy_binary_null = struct.pack('!i', -1)
+
+
+def to_literal(type, value):
+	"""値を PostgreSQL の入力形式の文字列にする、配列は {...} 形式になる."""
+	if type.element is not None:
+		elements = []
+		for v in value:
+			if v is None:
+				elements.append('NULL')
+			elif type.element.fmt is None:
+				elements.append('"' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"')
+			else:
+				elements.append(to_literal(type.element, v))
+		return '{' + ','.join(elements) + '}'
+	if type.fmt == '?':
+		return 't' if value else 'f'
+	if type.fmt == 'f' or type.fmt == 'd':
+		value = float(value)
+		if math.isfinite(value):
+			return repr(value)
+		if math.isnan(value):
+			return 'NaN'
+		return 'Infinity' if 0 < value else '-Infinity'
+	if type.fmt is None or isinstance(value, datetime.datetime):
+		return str(value)
+	return str(int(value))
+
+
+def get_text_encoder(type):
+	"""COPY テキスト形式で１列分の値をエスケープ済み文字列にする関数を取得する."""
+
+	def encode(value):
+		if value is None:
+			return '\\N'
+		return to_literal(type, value).translate(copy_text_escapes)
+
+	return encode
+
+
+def get_binary_encoder(type):
+	"""COPY バイナリ形式で１列分の値を長さ付きのバイト列にする関数を取得する."""
+	if type.element is not None:
+		element = type.element
+		if element.fmt is None:
+			element_encode = get_binary_encoder(element)
+
+			def encode(value):
+				if value is None:
+					return copy_binary_null
+				body = b''.join([element_encode(v) for v in value])
+				has_null = int(any(v is None for v in value))
+				header = struct.pack('!iiiii', 1, has_null, element.oid, len(value), 1) if len(value) else struct.pack('!iii', 0, 0, element.oid)
+				return struct.pack('!i', len(header) + len(body)) + header + body
+
+			return encode
+
+		# 固定長要素の配列は (長さ, 値) の構造体配列として一括で変換する
+		item_dtype = np.dtype([('len', '>i4'), ('value', '>' + element.fmt)])
+
+		def encode(value):
+			if value is None:
+				return copy_binary_null
+			if element is timestamp:
+				value = [(v - pg_epoch) // one_microsecond for v in value]
+			n = len(value)
+			if n == 0:
+				header = struct.pack('!iii', 0, 0, element.oid)
+				return struct.pack('!i', len(header)) + header
+			items = np.empty(n, item_dtype)
+			items['len'] = item_dtype['value'].itemsize
+			items['value'] = value
+			header = struct.pack('!iiiii', 1, 0, element.oid, n, 1)
+			return struct.pack('!i', len(header) + items.nbytes) + header + items.tobytes()
+
+		return encode
+
+	if type.fmt is None:
+
+		def encode(value):
+			if value is None:
+				return copy_binary_null
+			b = str(value).encode()
+			return struct.pack('!i', len(b)) + b
+
+		return encode
+
+	packer = struct.Struct('!i' + type.fmt)
+	size = packer.size - 4
+	if type is timestamp:
+
+		def encode(value):
+			if value is None:
+				return copy_binary_null
+			return packer.pack(size, (value - pg_epoch) // one_microsecond)
+
+		return encode
+
+	def encode(value):
+		if value is None:
+			return copy_binary_null
+		return packer.pack(size, value)
+
+	return encode
+
+
+cursor_name_counter = itertools.count()
+
+
+def named_cursor(conn, itersize=10000):
+	"""サーバー側カーソルを作成する、結果は itersize 行ずつ取得される.
+
+	autocommit の接続ではトランザクション外でも使えるよう WITH HOLD カーソルにする.
+	"""
+	return get_backend(conn).named_cursor(conn, itersize)
+
+
+def read_arrays(cursor, sql, params, names, types, itersize=100000):
+	"""SQL の結果を列の型に合わせた numpy の構造化配列として取得する.
+
+	全列が固定長で通常のカーソルなら COPY ... TO STDOUT のバイナリ形式を直接 numpy で解釈し、行毎の Python オブジェクトを作らない.
+	サーバー側カーソル、可変長の列を含む場合や NULL があった場合は itersize 行ずつ取得して構造化配列へ変換する.
+	SQLite では常に itersize 行ずつ取得し、配列の列は Python のリストに戻す.
+	NULL は浮動小数点と object の列でのみ扱え、それぞれ NaN と None になる.
+
+	Args:
+		cursor: カーソル、named_cursor で作成したものなら結果全体をクライアントのメモリに載せない.
+		sql: %s をパラメータとした SELECT 文.
+		params: SQL のパラメータ.
+		names: 各列の名前.
+		types: 各列の Type、None なら object として扱う.
+		itersize: 行毎に取得する場合の１回の取得行数.
+
+	Returns:
+		numpy の構造化配列.
+	"""
+	dtype = np.dtype([(name, t.dtype if t is not None else object) for name, t in zip(names, types)])
+	backend = get_backend(cursor)
+	if backend.copy and cursor.name is None and all(t is not None and t.fmt is not None and t.element is None for t in types):
+		arrays = read_arrays_by_copy(cursor, sql, params, dtype, types)
+		if arrays is not None:
+			return arrays
+
+	cursor.execute(sql, params)
+	chunks = []
+	while True:
+		rows = cursor.fetchmany(itersize)
+		if not rows:
+			break
+		chunks.append(np.array(rows, dtype))
+	arrays = np.concatenate(chunks) if chunks else np.empty(0, dtype)
+	backend.decode_arrays(arrays, types)
+	return arrays
+
+
+def read_arrays_by_copy(cursor, sql, params, dtype, types):
+	"""COPY のバイナリ形式で取得して numpy で解釈する、NULL を含むなどで解釈できなければ None."""
+	buf = io.BytesIO()
+	cursor.copy_expert(f'COPY ({cursor.mogrify(sql.strip().rstrip(";"), params).decode()}) TO STDOUT WITH (FORMAT binary)', buf)
+	data = buf.getbuffer()
+	header_size = len(copy_binary_header) + struct.unpack_from('!i', data, len(copy_binary_header) - 4)[0]
+	body = data[header_size:len(data) - len(copy_binary_trailer)]
+
+	# 全列 NULL 無しなら１行は固定長の (列数, (長さ, 値), ...) になる
+	fields = [('count', '>i2')]
+	for i, t in enumerate(types):
+		fields.append((f'len{i}', '>i4'))
+		fields.append((f'value{i}', '>' + t.fmt))
+	row_dtype = np.dtype(fields)
+	if len(body) % row_dtype.itemsize:
+		return None
+	rows = np.frombuffer(body, row_dtype)
+	if (rows['count'] != len(types)).any():
+		return None
+	for i, t in enumerate(types):
+		if (rows[f'len{i}'] != row_dtype[f'value{i}'].itemsize).any():
+			return None
+
+	arrays = np.empty(len(rows), dtype)
+	for i, (name, t) in enumerate(zip(dtype.names, types)):
+		if t.dtype.kind == 'M':
+			arrays[name] = (rows[f'value{i}'] + pg_epoch_us).view('datetime64[us]')
+		else:
+			arrays[name] = rows[f'value{i}']
+	return arrays
+
+
+class Prepared:
+	"""サーバー側で PREPARE した文を EXECUTE で実行する、PREPARE は接続毎に最初の実行時のみ行う.
+
+	Args:
+		sql: %s をパラメータとした SQL.
+	"""
+
+	name_counter = itertools.count()
+
+	def __init__(self, sql):
+		sql = sql.strip().rstrip(';')
+		parts = sql.split('%s')
+		self.sql = sql
+		self.name = f'prepared_{next(Prepared.name_counter)}'
+		self.prepare_sql = f'PREPARE {self.name} AS ' + ''.join([f'{p}${i + 1}' for i, p in enumerate(parts[:-1])]) + parts[-1]
+		self.execute_sql = f'EXECUTE {self.name}' + (f'({",".join(["%s"] * (len(parts) - 1))})' if 1 < len(parts) else '')
+		self.connections = weakref.WeakSet() # PREPARE 済みの接続
+
+	def execute(self, cursor, params=None):
+		conn = cursor.connection
+		if conn not in self.connections:
+			cursor.execute(self.prepare_sql)
+			self.connections.add(conn)
+		cursor.execute(self.execute_sql, params)
+
+
+class Statement:
+	"""%s をパラメータとした SQL を、カーソルの DB に合わせて実行する.
+
+	Args:
+		sql: %s をパラメータとした SQL.
+		types: パラメータの Type、SQLite ではこれに合わせて値を変換する、None なら変換しない.
+		prepared: PostgreSQL で PREPARE して実行するかどうか.
+	"""
+
+	def __init__(self, sql, types=None, prepared=False):
+		self.sql = sql
+		self.types = types
+		self.prepared = Prepared(sql) if prepared else None
+		self.sqlite_encode = sqlite.get_params_encoder(types) if types is not None else None # SQLite 用のパラメータの変換
+
+	def execute(self, cursor, params=None):
+		get_backend(cursor).execute(self, cursor, params)
+
+
+class Backend:
+	"""DB の種類毎の接続方法、型名、値の変換、カタログの参照の違いを吸収する.
+
+	接続文字列が 'sqlite:' で始まれば SQLite、それ以外は PostgreSQL になる、get_backend を参照.
+	"""
+
+	name = None
+	partitioning = False # 宣言的パーティショニングを使えるかどうか
+	copy = False # COPY で読み書きできるかどうか
+
+	def connect(self, connection_string):
+		raise NotImplementedError()
+
+	def get_type_name(self, type):
+		return type.type_name
+
+	def execute(self, statement, cursor, params):
+		cursor.execute(statement.sql, params)
+
+	def get_row_decoder(self, types):
+		"""DB から取得した行を Type に合わせた値に変換する関数、変換不要なら None."""
+		return None
+
+	def decode_arrays(self, arrays, types):
+		"""read_arrays で取得した構造化配列の列を Type に合わせた値に変換する."""
+		pass
+
+	def get_relkind(self, cursor, name):
+		raise NotImplementedError()
+
+	def get_oid(self, cursor, name):
+		raise NotImplementedError()
+
+	def get_col_names(self, cursor, name):
+		"""DB 上のテーブルの列名のリスト、存在しなければ空."""
+		raise NotImplementedError()
+
+	def named_cursor(self, conn, itersize):
+		raise NotImplementedError()
+
+
+class PostgresBackend(Backend):
+
+	name = 'postgresql'
+	partitioning = True
+	copy = True
+
+	def connect(self, connection_string):
+		return psycopg2.connect(connection_string)
+
+	def execute(self, statement, cursor, params):
+		if statement.prepared:
+			statement.prepared.execute(cursor, params)
+		else:
+			cursor.execute(statement.sql, params)
+
+	def get_relkind(self, cursor, name):
+		cursor.execute('SELECT relkind FROM pg_class WHERE oid=to_regclass(%s);', (name,))
+		r = cursor.fetchone()
+		return r[0] if r else None
+
+	def get_oid(self, cursor, name):
+		cursor.execute('SELECT to_regclass(%s)::oid;', (name,))
+		r = cursor.fetchone()[0]
+		return int(r) if r is not None else None
+
+	def get_col_names(self, cursor, name):
+		cursor.execute('SELECT attname FROM pg_attribute WHERE attrelid=to_regclass(%s) AND 0<attnum AND NOT attisdropped;',
+		               (name,))
+		return [r[0] for r in cursor.fetchall()]
+
+	def named_cursor(self, conn, itersize):
+		cursor = conn.cursor(name=f'cursor_{next(cursor_name_counter)}', withhold=conn.autocommit)
+		cursor.itersize = itersize
+		return cursor
+
+
+class SqliteCursor(sqlite3.Cursor):
+	"""psycopg2 と同じく %s をパラメータとした SQL を実行でき、with 文で閉じられるカーソル.
+
+	; で区切った複数の文はパラメータ無しなら executescript で実行する.
+	"""
+
+	name = None # psycopg2 のサーバー側カーソル名に相当、常に None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def execute(self, sql, params=()):
+		sql = sql.replace('%s', '?').replace('%%', '%')
+		if not params and ';' in sql.strip().rstrip(';'):
+			return self.executescript(sql)
+		return super().execute(sql, params if params is not None else ())
+
+	def executemany(self, sql, seq_of_params):
+		return super().executemany(sql.replace('%s', '?').replace('%%', '%'), seq_of_params)
+
+
+class SqliteConnection(sqlite3.Connection):
+	"""psycopg2 の接続と同じく autocommit と closed を持ち、SqliteCursor を作成する接続."""
+
+	def cursor(self, factory=SqliteCursor):
+		return super().cursor(factory)
+
+	@property
+	def autocommit(self):
+		return self.isolation_level is None
+
+	@autocommit.setter
+	def autocommit(self, value):
+		self.isolation_level = None if value else 'DEFERRED'
+
+	@property
+	def closed(self):
+		try:
+			self.total_changes
+			return False
+		except sqlite3.ProgrammingError:
+			return True
+
+
+class SqliteBackend(Backend):
+	"""ファイル１つの組み込み DB、サーバー無しで単一マシンの学習を記録する.
+
+	WAL モードで開き、読み込みと書き込みを並行できるようにする.
+	timestamp は UNIX 時間のマイクロ秒の整数、固定長要素の配列はリトルエンディアンの値を詰めたバイト列、それ以外の配列は JSON で格納する.
+	パーティショニングは無く、パーティションキーの列で絞り込む.
+	"""
+
+	name = 'sqlite'
+	busy_timeout_ms = 60000 # 他のプロセスが書き込み中の場合に待つ最大ミリ秒
+
+	def connect(self, connection_string):
+		path = connection_string[len('sqlite:'):]
+		conn = sqlite3.connect(path, timeout=self.busy_timeout_ms / 1000, factory=SqliteConnection, check_same_thread=False)
+		conn.execute('PRAGMA journal_mode=WAL;')
+		conn.execute('PRAGMA synchronous=NORMAL;')
+		return conn
+
+	def get_type_name(self, type):
+		if type.is_serial and type.element is None:
+			return 'INTEGER PRIMARY KEY'
+		if type.element is not None:
+			return 'BLOB' if type.element.fmt is not None else 'TEXT'
+		if type.fmt in ('f', 'd'):
+			return 'REAL'
+		if type.fmt is None:
+			return 'TEXT'
+		return 'INTEGER'
+
+	def get_encoder(self, type):
+		"""値を SQLite に格納する値にする関数を取得する、変換不要なら None."""
+		element = type.element
+		if element is not None:
+			if element.fmt is None:
+				return lambda value: None if value is None else json.dumps(list(value))
+			dtype = np.dtype('<' + element.fmt)
+			if element is timestamp:
+				return lambda value: None if value is None else np.array(
+				    [(v - unix_epoch) // one_microsecond for v in value], dtype).tobytes()
+			return lambda value: None if value is None else np.asarray(value, dtype).tobytes()
+		if type is timestamp:
+			return lambda value: None if value is None else (value - unix_epoch) // one_microsecond
+		if type.fmt in ('f', 'd'):
+			return lambda value: None if value is None else float(value)
+		if type.fmt is not None:
+			return lambda value: None if value is None else int(value)
+		return None
+
+	def get_decoder(self, type):
+		"""SQLite から取得した値を psycopg2 と同じ Python の値にする関数を取得する、変換不要なら None."""
+		element = type.element
+		if element is not None:
+			if element.fmt is None:
+				return lambda value: None if value is None else json.loads(value)
+			dtype = np.dtype('<' + element.fmt)
+			if element is timestamp:
+				return lambda value: None if value is None else [
+				    unix_epoch + datetime.timedelta(microseconds=int(v)) for v in np.frombuffer(value, dtype)
+				]
+			return lambda value: None if value is None else np.frombuffer(value, dtype).tolist()
+		if type is timestamp:
+			return lambda value: None if value is None else unix_epoch + datetime.timedelta(microseconds=value)
+		if type.fmt == '?':
+			return lambda value: None if value is None else bool(value)
+		return None
+
+	def get_params_encoder(self, types):
+		encoders = [self.get_encoder(t) for t in types]
+		if all(e is None for e in encoders):
+			return None
+		encoders = [e if e else (lambda v: v) for e in encoders]
+		return lambda params: [e(v) for e, v in zip(encoders, params)]
+
+	def execute(self, statement, cursor, params):
+		encode = statement.sqlite_encode
+		cursor.execute(statement.sql, encode(params) if encode else params)
+
+	def decode_arrays(self, arrays, types):
+		for name, t in zip(arrays.dtype.names, types):
+			decode = self.get_decoder(t) if t is not None and t.element is not None else None
+			if decode:
+				arrays[name] = [decode(v) for v in arrays[name]]
+
+	def get_row_decoder(self, types):
+		decoders = [self.get_decoder(t) if t is not None else None for t in types]
+		if all(d is None for d in decoders):
+			return None
+		decoders = [d if d else (lambda v: v) for d in decoders]
+		return lambda row: [d(v) for d, v in zip(decoders, row)]
+
+	def get_relkind(self, cursor, name):
+		cursor.execute("SELECT 'r' FROM sqlite_master WHERE type='table' AND name=%s;", (name,))
+		r = cursor.fetchone()
+		return r[0] if r else None
+
+	def get_oid(self, cursor, name):
+		cursor.execute("SELECT rootpage FROM sqlite_master WHERE type='table' AND name=%s;", (name,))
+		r = cursor.fetchone()
+		return r[0] if r else None
+
+	def get_col_names(self, cursor, name):
+		cursor.execute("SELECT name FROM pragma_table_info(%s);", (name,))
+		return [r[0] for r in cursor.fetchall()]
+
+	def named_cursor(self, conn, itersize):
+		# SQLite のカーソルは元々結果を少しずつ取得する
+		cursor = conn.cursor()
+		cursor.arraysize = itersize
+		return cursor
+
+
+postgresql = PostgresBackend()
+sqlite = SqliteBackend()
+
+for t in (np.bool_, np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64):
+	sqlite3.register_adapter(t, int)
+for t in (np.float16, np.float32, np.float64):
+	sqlite3.register_adapter(t, float)
+sqlite3.register_adapter(datetime.datetime, lambda value: (value - unix_epoch) // one_microsecond)
+
+
+def get_backend(target):
+	"""接続文字列、接続またはカーソルに対応する Backend を取得する."""
+	if isinstance(target, str):
+		return sqlite if target.startswith('sqlite:') else postgresql
+	return sqlite if isinstance(target, (sqlite3.Connection, sqlite3.Cursor)) else postgresql
+
+
+def connect(connection_string):
+	"""接続文字列に合わせて DB に接続する、'sqlite:<ファイルパス>' なら SQLite、それ以外は PostgreSQL の接続文字列."""
+	return get_backend(connection_string).connect(connection_string)
 
 
 class Col:
@@ -59,14 +572,27 @@ class Col:
 
 
 class Idx:
+	"""インデックス、複数列なら複合インデックスになる.
+
+	Args:
+		tbl: 対象テーブル.
+		cols: 対象列.
+		method: インデックスの種類、'btree' または 'brin' など、挿入順に値が増える列には小さく更新の軽い 'brin' が向く.
+	"""
 
-	def __init__(self, tbl, cols):
+	def __init__(self, tbl, cols, method='btree'):
 		self.tbl = tbl
 		self.cols = cols
-		self.name = f'idx_{tbl._name}_{"_".join([c.name for c in cols])}'
+		self.method = method
 
-	def get_create_statement(self):
-		return f'CREATE INDEX IF NOT EXISTS {self.name} ON {self.tbl._name}({", ".join([c.name for c in self.cols])});'
+	@property
+	def name(self):
+		suffix = '' if self.method == 'btree' else f'_{self.method}'
+		return f'idx_{self.tbl._name}_{"_".join([c.name for c in self.cols])}{suffix}'
+
+	def get_create_statement(self, backend=None):
+		using = '' if self.method == 'btree' or backend is sqlite else f' USING {self.method}'
+		return f'CREATE INDEX IF NOT EXISTS {self.name} ON {self.tbl._name}{using}({", ".join([c.name for c in self.cols])});'
 
 
 class Tbl:
@@ -103,8 +629,21 @@ class Tbl:
 	def pk(self, cols):
 		self.get_primary_key_cols().extend(cols)
 
-	def idx(self, cols):
-		self.get_indices().append(Idx(self, cols))
+	def idx(self, cols, method='btree'):
+		self.get_indices().append(Idx(self, cols, method))
+
+	def partition_by(self, cols, method='LIST'):
+		"""宣言的パーティショニングの親テーブルにする.
+
+		Args:
+			cols: パーティションキーの列.
+			method: 'LIST' または 'RANGE'.
+		"""
+		self._partition = (method, cols)
+
+	def get_partition(self):
+		"""(パーティショニング方法, キーの列)、パーティショニングしないなら None."""
+		return self.__dict__.get('_partition')
 
 	def get_cols(self, filter=None):
 		d = self.__dict__
@@ -124,10 +663,17 @@ class Tbl:
 	def get_record_type(self, filter=None):
 		return namedtuple(f'{self._name}_record', [c.name for c in self.get_cols(filter)])
 
-	def get_create_statement(self):
-		col_defs = [f'{c.name} {c.type.type_name}' for c in self.get_cols()]
+	def get_create_statement(self, backend=None):
+		"""テーブルとインデックスを作成する文を取得する、backend が None なら PostgreSQL 用.
+
+		SQLite では serial 列を INTEGER PRIMARY KEY にし、主キーとパーティショニングはそれに含めない.
+		"""
+		backend = backend if backend else postgresql
+		col_defs = [f'{c.name} {backend.get_type_name(c.type)}' for c in self.get_cols()]
 		col_defs = ','.join(col_defs)
 		pk_defs = [c.name for c in self.get_primary_key_cols()]
+		if backend is sqlite and self.get_serial_cols():
+			pk_defs = []
 		if len(pk_defs) != 0:
 			pk_defs = f',PRIMARY KEY({",".join(pk_defs)})'
 		else:
@@ -135,45 +681,129 @@ class Tbl:
 		if len(self.get_indices()) == 0:
 			create_index_statement = ''
 		else:
-			create_index_statement = ';'.join([idx.get_create_statement() for idx in self.get_indices()]) + ';'
-		return f'CREATE TABLE IF NOT EXISTS {self._name} ({col_defs}{pk_defs});{create_index_statement}'
+			create_index_statement = ';'.join([idx.get_create_statement(backend) for idx in self.get_indices()]) + ';'
+		partition = self.get_partition()
+		if partition is None or not backend.partitioning:
+			partition_def = ''
+		else:
+			partition_def = f' PARTITION BY {partition[0]} ({",".join([c.name for c in partition[1]])})'
+		return f'CREATE TABLE IF NOT EXISTS {self._name} ({col_defs}{pk_defs}){partition_def};{create_index_statement}'
 
 	def get_drop_statement(self):
 		return f'DROP TABLE IF EXISTS {self._name};'
 
-	def get_insert(self, filter=None):
-		cols = [c.name for c in self.get_cols(filter)]
+	def get_add_columns_statement(self, cursor):
+		"""DB 上の既存のテーブルに無い列を追加する文を取得する、追加する列が無ければ空文字列.
+
+		後から列を増やしたテーブルを作り直さずに使い続けるためのもので、既存の行の新しい列は NULL になる.
+		パーティショニングされた親に追加すればパーティションにも追加される.
+		"""
+		backend = get_backend(cursor)
+		names = set(backend.get_col_names(cursor, self._name))
+		if not names:
+			return ''
+		return ''.join([
+		    f'ALTER TABLE {self._name} ADD COLUMN {c.name} {backend.get_type_name(c.type)};'
+		    for c in self.get_cols()
+		    if c.name not in names
+		])
+
+	def get_partition_name(self, values):
+		"""パーティションのテーブル名、values はパーティションを表す値で LIST なら値そのもの、RANGE なら開始値."""
+		if not isinstance(values, (list, tuple)):
+			values = [values]
+		suffix = '_'.join([''.join([ch if ch.isalnum() else '_' for ch in str(v)]) for v in values])
+		return f'{self._name}_p{suffix}'
+
+	def get_create_partition_statement(self, values, end_values=None):
+		"""パーティションを作成する文を取得する.
+
+		Args:
+			values: LIST なら含める値、RANGE なら開始値、複数列のキーならそのリスト.
+			end_values: RANGE の終了値、この値は含まない.
+		"""
+		method, cols = self.get_partition()
+		if not isinstance(values, (list, tuple)):
+			values = [values]
+		literals = ','.join([f"'{to_literal(c.type, v)}'" for c, v in zip(cols, values)])
+		if method == 'LIST':
+			bound = f'IN ({literals})'
+		else:
+			if not isinstance(end_values, (list, tuple)):
+				end_values = [end_values]
+			end_literals = ','.join([f"'{to_literal(c.type, v)}'" for c, v in zip(cols, end_values)])
+			bound = f'FROM ({literals}) TO ({end_literals})'
+		return f'CREATE TABLE IF NOT EXISTS {self.get_partition_name(values)} PARTITION OF {self._name} FOR VALUES {bound};'
+
+	def get_detach_partition_statement(self, values):
+		"""パーティションを切り離して削除する文を取得する、切り離しはデータ量によらずカタログの更新のみで済む."""
+		name = self.get_partition_name(values)
+		return f'ALTER TABLE {self._name} DETACH PARTITION {name};DROP TABLE {name};'
+
+	def get_relkind(self, cursor, name=None):
+		"""DB 上のテーブルの種類、'r' なら通常、'p' ならパーティショニングされた親、存在しなければ None.
+
+		Args:
+			cursor: カーソル.
+			name: 調べるテーブル名、None ならこのテーブル、パーティションを調べる場合は get_partition_name の結果を指定する.
+		"""
+		return get_backend(cursor).get_relkind(cursor, name if name else self._name)
+
+	def get_oid(self, cursor, name=None):
+		"""DB 上のテーブルを識別する番号、テーブルが作り直されると変わる、存在しなければ None.
+
+		Args:
+			cursor: カーソル.
+			name: 調べるテーブル名、None ならこのテーブル.
+		"""
+		return get_backend(cursor).get_oid(cursor, name if name else self._name)
+
+	def get_insert(self, filter=None, prepared=True):
+		cols = self.get_cols(filter)
 		colps = ','.join(['%s' for _ in cols])
-		cols = ','.join(cols)
-		sql = f'INSERT INTO {self._name}({cols}) VALUES({colps});'
-
-		def insert(cursor, record):
-			cursor.execute(sql, record)
-
-		return insert
+		sql = f'INSERT INTO {self._name}({",".join([c.name for c in cols])}) VALUES({colps});'
+		return Statement(sql, [c.type for c in cols], prepared).execute
 
-	def get_inserts(self, filter=None):
-		cols = [c.name for c in self.get_cols(filter)]
-		cols = ','.join(cols)
-		sql = f'INSERT INTO {self._name}({cols}) VALUES'
+	def get_inserts(self, filter=None, page_size=1000):
+		"""複数レコードを execute_values で page_size 件毎にまとめて INSERT する関数を取得する、SQLite では executemany で登録する."""
+		cols = self.get_cols(filter)
+		col_names = ','.join([c.name for c in cols])
+		sql = f'INSERT INTO {self._name}({col_names}) VALUES %s'
+		sqlite_sql = f'INSERT INTO {self._name}({col_names}) VALUES({",".join(["%s" for _ in cols])});'
+		sqlite_encode = sqlite.get_params_encoder([c.type for c in cols])
 
 		def insert(cursor, records):
-			values = []
-			params = []
-			for r in records:
-				values.append(f'({",".join(["%s" for _ in r])})')
-				params.extend(r)
-			values = ",".join(values)
-			cursor.execute(sql + values, params)
+			if get_backend(cursor) is sqlite:
+				cursor.executemany(sqlite_sql, [sqlite_encode(r) for r in records] if sqlite_encode else records)
+			else:
+				psycopg2.extras.execute_values(cursor, sql, records, page_size=page_size)
 
 		return insert
 
-	def get_is_exists(self, filter=None):
-		condition = ' AND '.join([f'{c.name}=%s' for c in self.get_cols(filter)])
+	def get_copy_sql(self, filter=None, format='text'):
+		cols = ','.join([c.name for c in self.get_cols(filter)])
+		options = ' WITH (FORMAT binary)' if format == 'binary' else ''
+		return f'COPY {self._name}({cols}) FROM STDIN{options};'
+
+	def get_writer(self, connection_string, filter=None, **kwargs):
+		"""レコードをまとめて登録する CopyWriter を作成する、引数は CopyWriter を参照.
+
+		SQLite なら SqliteWriter、connection_string が None なら登録せずに捨てる NullWriter になる.
+		"""
+		if connection_string is None:
+			return NullWriter()
+		if get_backend(connection_string) is sqlite:
+			return SqliteWriter(self, connection_string, filter, **kwargs)
+		return CopyWriter(self, connection_string, filter, **kwargs)
+
+	def get_is_exists(self, filter=None, prepared=True):
+		cols = self.get_cols(filter)
+		condition = ' AND '.join([f'{c.name}=%s' for c in cols])
 		sql = f'SELECT 1 FROM {self._name} WHERE {condition};'
+		execute = Statement(sql, [c.type for c in cols], prepared).execute
 
 		def is_exists(cursor, record):
-			cursor.execute(sql, record)
+			execute(cursor, record)
 			exists = False
 			for _ in cursor:
 				exists = True
@@ -181,26 +811,209 @@ class Tbl:
 
 		return is_exists
 
-	def get_find(self, select_cols, filter=None):
+	def get_find(self, select_cols, filter=None, prepared=True):
 		return_record_type = namedtuple(f'{self._name}_found_record', [c.name for c in select_cols])
 		select_col_names = ','.join([c.name for c in select_cols])
-		condition = ' AND '.join([f'{c.name}=%s' for c in self.get_cols(filter)])
+		cols = self.get_cols(filter)
+		condition = ' AND '.join([f'{c.name}=%s' for c in cols])
 		sql = f'SELECT {select_col_names} FROM {self._name} WHERE {condition} LIMIT 1;'
+		execute = Statement(sql, [c.type for c in cols], prepared).execute
+		sqlite_decode = sqlite.get_row_decoder([c.type for c in select_cols])
 
 		def find(cursor, record):
-			cursor.execute(sql, record)
+			execute(cursor, record)
+			decode = sqlite_decode if sqlite_decode and get_backend(cursor) is sqlite else None
 			found_record = None
 			for r in cursor:
-				found_record = return_record_type(*r)
+				found_record = return_record_type(*(decode(r) if decode else r))
 			return found_record
 
 		return find
 
 
+class CopyWriter:
+	"""レコードをバッファに溜め、バックグラウンドスレッドから COPY ... FROM STDIN でまとめて登録する.
+
+	write はバッファへ追加するだけで DB を待たない.
+	溜まったレコード数が flush_rows 以上になるか、flush_interval 秒経過したらスレッド専用の接続で登録する.
+	DB が追いつかず未登録レコードが max_pending_rows を超えたら古いものから捨てる.
+
+	Args:
+		tbl: 登録先テーブル.
+		connection_string: 接続文字列.
+		filter: 登録する列のフィルタ、Tbl.get_cols と同じ.
+		format: COPY の形式、'text' または 'binary'.
+		flush_rows: 登録を始めるレコード数.
+		flush_interval: 登録間隔の最大秒数.
+		max_pending_rows: 未登録レコードの最大数.
+	"""
+
+	def __init__(self,
+	             tbl,
+	             connection_string,
+	             filter=None,
+	             format='text',
+	             flush_rows=1000,
+	             flush_interval=1.0,
+	             max_pending_rows=1000000):
+		if format not in ('text', 'binary'):
+			raise ValueError(f'Unknown COPY format: {format}')
+		self.tbl = tbl
+		self.connection_string = connection_string
+		self.format = format
+		self.prepare(filter)
+		self.flush_rows = flush_rows
+		self.flush_interval = flush_interval
+		self.pending = collections.deque(maxlen=max_pending_rows) # 未登録レコード、上限を超えたら古いものが捨てられる
+		self.write_count = 0 # write されたレコード数
+		self.copied_rows = 0 # 登録できたレコード数
+		self.failed_rows = 0 # 登録に失敗したレコード数
+		self.copy_seconds = 0.0 # 変換と登録に掛かった秒数
+		self.closing = False
+		self.flush_event = threading.Event()
+		self.conn = self.connect() # 接続エラーは呼び出し元で分かるようここで接続する
+		self.thread = threading.Thread(target=self.run, name=f'CopyWriter({tbl._name})', daemon=True)
+		self.thread.start()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def prepare(self, filter):
+		"""登録する SQL と列毎の変換関数を用意する."""
+		cols = self.tbl.get_cols(filter)
+		self.sql = self.tbl.get_copy_sql(filter, self.format)
+		self.encoders = [get_binary_encoder(c.type) if self.format == 'binary' else get_text_encoder(c.type) for c in cols]
+		self.col_count = struct.pack('!h', len(cols))
+
+	def connect(self):
+		return psycopg2.connect(self.connection_string)
+
+	def send(self, records):
+		"""レコード群を１トランザクションで登録する."""
+		with self.conn.cursor() as cur:
+			cur.copy_expert(self.sql, io.BytesIO(self.encode(records)))
+		self.conn.commit()
+
+	def write(self, record):
+		"""レコードをバッファへ追加する、DB への登録は待たない."""
+		pending = self.pending
+		pending.append(record)
+		self.write_count += 1
+		if self.flush_rows <= len(pending):
+			self.flush_event.set()
+
+	def dropped_rows(self):
+		"""上限を超えて捨てられたレコード数."""
+		return self.write_count - self.copied_rows - self.failed_rows - len(self.pending)
+
+	def encode(self, records):
+		"""レコード群を COPY のデータ部のバイト列にする."""
+		encoders = self.encoders
+		if self.format == 'binary':
+			col_count = self.col_count
+			chunks = [copy_binary_header]
+			for r in records:
+				chunks.append(col_count)
+				chunks.extend([e(v) for e, v in zip(encoders, r)])
+			chunks.append(copy_binary_trailer)
+			return b''.join(chunks)
+		else:
+			return ''.join(['\t'.join([e(v) for e, v in zip(encoders, r)]) + '\n' for r in records]).encode()
+
+	def copy_pending(self):
+		"""溜まっているレコードを全て登録する、書き込みスレッドからのみ呼び出す."""
+		pending = self.pending
+		n = len(pending)
+		if n == 0:
+			return
+		records = [pending.popleft() for _ in range(n)]
+		t = time.perf_counter()
+		try:
+			if self.conn.closed:
+				self.conn = self.connect()
+			self.send(records)
+			self.copied_rows += n
+		except Exception as ex:
+			# 学習は止めずにこの分は捨てる
+			print(f'{self.thread.name}: failed to copy {n} records: {ex}')
+			self.failed_rows += n
+			try:
+				self.conn.rollback()
+			except Exception:
+				self.conn.close()
+		self.copy_seconds += time.perf_counter() - t
+
+	def run(self):
+		while True:
+			self.flush_event.wait(self.flush_interval)
+			self.flush_event.clear()
+			closing = self.closing
+			self.copy_pending()
+			if closing:
+				break
+		self.conn.close()
+
+	def close(self):
+		"""残りのレコードを登録してスレッドを終了する."""
+		if not self.closing:
+			self.closing = True
+			self.flush_event.set()
+			self.thread.join()
+
+
+class SqliteWriter(CopyWriter):
+	"""CopyWriter の SQLite 版、溜まったレコードを１トランザクションの executemany でまとめて登録する.
+
+	SQLite の書き込みはファイル全体で１つずつなので、まとめて登録してロックを取る回数を減らす.
+	format は無視する、それ以外の引数は CopyWriter と同じ.
+	"""
+
+	def __init__(self, tbl, connection_string, filter=None, format=None, **kwargs):
+		super().__init__(tbl, connection_string, filter, 'text', **kwargs)
+
+	def prepare(self, filter):
+		cols = self.tbl.get_cols(filter)
+		self.sql = f'INSERT INTO {self.tbl._name}({",".join([c.name for c in cols])}) VALUES({",".join(["?" for _ in cols])});'
+		self.sqlite_encode = sqlite.get_params_encoder([c.type for c in cols])
+
+	def connect(self):
+		return sqlite.connect(self.connection_string)
+
+	def send(self, records):
+		encode = self.sqlite_encode
+		with self.conn:
+			self.conn.executemany(self.sql, [encode(r) for r in records] if encode else records)
+
+
+class NullWriter:
+	"""CopyWriter と同じように使えるが何も登録しない、ベンチマークなどでログの登録を無効にする際に使う."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def write(self, record):
+		pass
+
+	def dropped_rows(self):
+		return 0
+
+	def close(self):
+		pass
+
+
 class SqlBuildable:
 
 	def __init__(self, owner):
 		self.owner = owner
+		self._sql = None # sql() の結果のキャッシュ
+		self._record_type = None # record_type() の結果のキャッシュ
+		self._prepared = None # prepared() の結果のキャッシュ
 
 	def build(self, forward_buffer, backward_buffer):
 		if self.owner:
@@ -208,12 +1021,25 @@ class SqlBuildable:
 			self.owner.build(forward_buffer, backward_buffer)
 
 	def sql(self):
-		forward_buffer = []
-		backward_buffer = []
-		self.build(forward_buffer, backward_buffer)
-		return '\n'.join(forward_buffer)
+		if self._sql is None:
+			forward_buffer = []
+			backward_buffer = []
+			self.build(forward_buffer, backward_buffer)
+			self._sql = '\n'.join(forward_buffer)
+		return self._sql
+
+	def prepared(self):
+		"""この SQL を PREPARE して実行する Prepared を取得する."""
+		if self._prepared is None:
+			self._prepared = Prepared(self.sql())
+		return self._prepared
 
 	def record_type(self):
+		if self._record_type is None:
+			self._record_type = self.build_record_type()
+		return self._record_type
+
+	def build_record_type(self):
 		o = self
 		while o:
 			if isinstance(o, Select):
@@ -229,14 +1055,48 @@ class SqlBuildable:
 					names.append(name)
 				return namedtuple('record_type', names)
 			o = o.owner
-		raise 'No columns in SQL.'
+		raise ValueError('No columns in SQL.')
 
-	def read(self, cursor, *params):
+	def read(self, cursor, *params, prepared=False):
 		rt = self.record_type()
-		sql = self.sql()
-		cursor.execute(sql, params)
-		for r in cursor:
-			yield rt(*r)
+		backend = get_backend(cursor)
+		if prepared and backend is postgresql:
+			self.prepared().execute(cursor, params)
+		else:
+			cursor.execute(self.sql(), params)
+		decode = backend.get_row_decoder(self.select_types())
+		if decode:
+			for r in cursor:
+				yield rt(*decode(r))
+		else:
+			for r in cursor:
+				yield rt(*r)
+
+	def stream(self, conn, *params, itersize=10000):
+		"""サーバー側カーソルで itersize 行ずつ取得しながらレコードを返す、結果全体をメモリに載せない."""
+		with named_cursor(conn, itersize) as cursor:
+			yield from self.read(cursor, *params)
+
+	def select_types(self):
+		"""SELECT 対象列の型、Col 以外の式なら None."""
+		o = self
+		while not isinstance(o, Select):
+			o = o.owner
+		return [c.type if isinstance(c, Col) else None for c in o.cols]
+
+	def dtype(self):
+		"""結果を格納する numpy の構造化配列の型、列名は record_type と同じ."""
+		types = self.select_types()
+		return np.dtype([(name, t.dtype if t is not None else object) for name, t in zip(self.record_type()._fields, types)])
+
+	def read_arrays(self, cursor, *params, itersize=100000):
+		"""結果を Tbl の列の型に合わせた numpy の構造化配列として取得する、詳細は db.read_arrays を参照."""
+		return read_arrays(cursor, self.sql(), params, self.record_type()._fields, self.select_types(), itersize)
+
+	def read_frame(self, cursor, *params, itersize=100000):
+		"""read_arrays の結果を pandas の DataFrame として取得する."""
+		import pandas as pd
+		return pd.DataFrame(self.read_arrays(cursor, *params, itersize=itersize))
 
 class JoinOwner:
 
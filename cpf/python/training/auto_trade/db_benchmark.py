@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import time
+import datetime
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+
+import parameters
+import db
+import tables
+
+arg_parser = ArgumentParser(prog="db_benchmark.py")
+arg_parser.add_argument("--connection-string", default=None, type=str, help="Connection string, parameters.json is used if omitted")
+arg_parser.add_argument("--rows", default=20000, type=int, help="Number of records to register per table")
+arg_parser.add_argument("--formats", default="text,binary", type=str, help="Comma separated COPY formats")
+arg_parser.add_argument("--flush-rows", default=1000, type=int, help="Records per COPY")
+arg_parser.add_argument("--sample-size", default=32, type=int, help="Array length of learner records")
+arg_parser.add_argument("--read-rows", default=200000, type=int, help="Number of actor records to read back")
+args = arg_parser.parse_args()
+
+
+def make_actor_records(record_type, num):
+	"""Actor が登録するのと同じ形のダミーレコードを作成する."""
+	now = datetime.datetime.now()
+	return [
+	    record_type(1, i % 8, now, i, i // 100, i % 50, i % 1000, i % 4, (i + 1) % 4, 0.5, i % 4, (i + 2) % 4, i % 1000, float(i))
+	    for i in range(num)
+	]
+
+
+def make_learner_records(record_type, num, sample_size):
+	"""Learner が登録するのと同じ形のダミーレコードを作成する."""
+	rng = np.random.default_rng(0)
+	now = datetime.datetime.now()
+	records = []
+	for i in range(num):
+		records.append(
+		    record_type(1, now, i, i, float(rng.random()),
+		                rng.random(4, np.float32).tolist(),
+		                rng.random(sample_size, np.float32).tolist(),
+		                rng.random(sample_size, np.float32).tolist(),
+		                rng.integers(0, 100000, sample_size).tolist(), i // 100, i // 10))
+	return records
+
+
+def count_rows(cur, tbl):
+	cur.execute(f'SELECT COUNT(*) FROM {tbl._name};')
+	return cur.fetchone()[0]
+
+
+def recreate(cur, tbl):
+	"""計測用のテーブルを作り直す、パーティショニングできる DB ならパラメータセット 1 のパーティションも作る."""
+	backend = db.get_backend(cur)
+	cur.execute(tbl.get_drop_statement())
+	cur.execute(tbl.get_create_statement(backend))
+	if backend.partitioning:
+		cur.execute(tbl.get_create_partition_statement(1))
+
+
+def run_insert(conn, tbl, records):
+	"""従来の１レコード毎の INSERT で登録し、秒数を返す."""
+	insert = tbl.get_insert()
+	with conn.cursor() as cur:
+		t = time.perf_counter()
+		for r in records:
+			insert(cur, r)
+	return time.perf_counter() - t
+
+
+def run_writer(connection_string, tbl, records, format):
+	"""CopyWriter で登録し、(write 呼び出しの秒数, 全件登録完了までの秒数, writer) を返す."""
+	writer = tbl.get_writer(connection_string, format=format, flush_rows=args.flush_rows)
+	t = time.perf_counter()
+	for r in records:
+		writer.write(r)
+	t_write = time.perf_counter() - t
+	writer.close()
+	return t_write, time.perf_counter() - t, writer
+
+
+if __name__ == "__main__":
+	connection_string = args.connection_string if args.connection_string else parameters.load()['db']['connection_string']
+	conn = db.connect(connection_string)
+	conn.autocommit = True
+	cur = conn.cursor()
+
+	for tbl in (tables.ActorData(), tables.LearnerData()):
+		# 本番のテーブルを汚さないよう名前を変えたテーブルで計測する
+		tbl._name += '_benchmark'
+		record_type = tbl.get_record_type()
+		if isinstance(tbl, tables.ActorData):
+			records = make_actor_records(record_type, args.rows)
+		else:
+			records = make_learner_records(record_type, args.rows, args.sample_size)
+
+		recreate(cur, tbl)
+		t_insert = run_insert(conn, tbl, records)
+		assert count_rows(cur, tbl) == len(records)
+		print(f'{tbl._name:>24} per-row insert: {len(records) / t_insert:10.0f} rows/s')
+
+		for format in args.formats.split(','):
+			recreate(cur, tbl)
+			t_write, t_total, writer = run_writer(connection_string, tbl, records, format)
+			assert count_rows(cur, tbl) == len(records)
+			print(f'{tbl._name:>24} copy {format:>6}: {len(records) / t_total:10.0f} rows/s '
+			      f'speedup: {t_insert / t_total:6.1f}x write() {t_write / len(records) * 1e6:6.2f} us/row '
+			      f'copy thread busy: {writer.copy_seconds:6.3f} s')
+
+		cur.execute(tbl.get_drop_statement())
+
+	# 読み込み、pandas.read_sql と行毎のレコード、サーバー側カーソル、numpy の構造化配列
+	tbl = tables.ActorData()
+	tbl._name += '_benchmark'
+	recreate(cur, tbl)
+	with tbl.get_writer(connection_string, format='binary', flush_rows=100000) as writer:
+		for r in make_actor_records(tbl.get_record_type(), args.read_rows):
+			writer.write(r)
+	s = db.select(tbl.get_cols()).frm(tbl)
+	for name, read in (('pandas.read_sql', lambda: pd.read_sql(s.sql(), conn)),
+	                   ('read namedtuples', lambda: list(s.read(cur))),
+	                   ('stream namedtuples', lambda: sum(1 for _ in s.stream(conn))),
+	                   ('read_arrays copy', lambda: s.read_arrays(cur)),
+	                   ('read_arrays named cursor', lambda: s.read_arrays(db.named_cursor(conn)))):
+		t = time.perf_counter()
+		read()
+		t = time.perf_counter() - t
+		print(f'{tbl._name:>24} {name:>24}: {args.read_rows / t:10.0f} rows/s')
+	cur.execute(tbl.get_drop_statement())
+
+	conn.close()
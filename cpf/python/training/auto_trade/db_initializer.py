@@ -1,4 +1,4 @@
-import psycopg2
+import db
 import tables
 
 def get_state_dict_name(params):
@@ -15,17 +15,31 @@ def initialize(params):
 	lp = params["learner"]
 	rp = params["replay_memory"]
 
-	with psycopg2.connect(db_conf["connection_string"]) as conn:
+	with db.connect(db_conf["connection_string"]) as conn:
 		conn.autocommit = True
 		with conn.cursor() as cur:
+			backend = db.get_backend(cur)
 			ps = tables.ParamSet()
 			ad = tables.ActorData()
 			ld = tables.LearnerData()
 			rad = tables.RewardAdjData()
-			cur.execute(ps.get_create_statement())
-			cur.execute(ad.get_create_statement())
-			cur.execute(ld.get_create_statement())
-			cur.execute(rad.get_create_statement())
+			ls = tables.LearnerSummary()
+			es = tables.ActorEpisodeSummary()
+			ts = tables.ActorTrainSummary()
+			cur.execute(ps.get_create_statement(backend))
+			cur.execute(ad.get_create_statement(backend))
+			cur.execute(ld.get_create_statement(backend))
+			cur.execute(rad.get_create_statement(backend))
+			cur.execute(ls.get_create_statement(backend))
+			cur.execute(es.get_create_statement(backend))
+			cur.execute(ts.get_create_statement(backend))
+			cur.execute(tables.RollupState().get_create_statement(backend))
+
+			# 以前のバージョンで作成されたテーブルに後から増えた列を追加する
+			for t in (ps, ad, ld, rad, ls, es, ts):
+				add_columns = t.get_add_columns_statement(cur)
+				if add_columns:
+					cur.execute(add_columns)
 
 			filter = lambda c: not c.type.is_serial
 			record = ps.get_record_type(filter)
@@ -42,8 +56,17 @@ def initialize(params):
 			if found is None:
 				insert(cur, r)
 			found = find(cur, r)
+			param_set_id = found[0]
+
+			# ログはパラメータセット毎のパーティションへ登録する、以前の分割されていないテーブルならそのまま使う
+			# SQLite にはパーティションが無いので１つのテーブルへ登録する
+			for t in (ad, ld, rad, ls, es, ts):
+				if t.get_relkind(cur) == 'p':
+					cur.execute(t.get_create_partition_statement(param_set_id))
+				elif backend.partitioning:
+					print(f'{t._name} is not partitioned, run clear_log.py to recreate it with partitions.')
 
-			return found[0]
+			return param_set_id
 
 def override_parameters_from_db(params, param_set_id):
 	db_conf = params['db']
@@ -52,16 +75,12 @@ def override_parameters_from_db(params, param_set_id):
 	lp = params["learner"]
 	rp = params["replay_memory"]
 
-	with psycopg2.connect(db_conf["connection_string"]) as conn:
+	with db.connect(db_conf["connection_string"]) as conn:
 		conn.autocommit = True
 		with conn.cursor() as cur:
 			ps = tables.ParamSet()
 
-			record = ps.get_record_type()
-
-			cur.execute('SELECT * FROM param_set WHERE param_set_id=%s', [param_set_id])
-			for r in cur:
-				ps = record(*r)
+			for ps in db.select(ps.get_cols()).frm(ps).where('param_set_id=%s').read(cur, param_set_id):
 				lp['model'] = ps.model
 				lp['hidden_size'] = ps.hidden_size
 				lp['optimizer'] = ps.optimizer
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+import time
+import multiprocessing as mp
+from queue import Empty
+from argparse import ArgumentParser
+import numpy as np
+
+import replay
+import transport
+
+arg_parser = ArgumentParser(prog="flow_benchmark.py")
+arg_parser.add_argument("--actors", default="1,4,8", type=str, help="Comma separated numbers of actor processes")
+arg_parser.add_argument("--batch-size", default=16, type=int, help="Transitions per batch")
+arg_parser.add_argument("--state-shape", default="5,80,90", type=str, help="State shape (frames,height,width)")
+arg_parser.add_argument("--slots", default=64, type=int, help="Number of shared memory slots")
+arg_parser.add_argument("--credits", default=4, type=int, help="Credits per actor")
+arg_parser.add_argument("--actor-us", default=2000, type=int, help="Microseconds of work per actor batch")
+arg_parser.add_argument("--learner-us", default=1000, type=int, help="Microseconds of work per learner update")
+arg_parser.add_argument("--ratios", default="0,0.0625,0.25", type=str, help="Comma separated target replay ratios")
+arg_parser.add_argument("--seconds", default=3.0, type=float, help="Seconds to run each case")
+args = arg_parser.parse_args()
+
+
+def busy(us):
+	"""環境の step や推論、学習の代わりに us マイクロ秒 CPU を使う."""
+	deadline = time.perf_counter() + us * 1e-6
+	while time.perf_counter() < deadline:
+		pass
+
+
+def actor(actor_id, queue, flow, control, fields, ready, start, results):
+	"""Actor の send_n_step_transitions と同じく送信前に待ち、待っている間の CPU 時間を計る."""
+	arrays = [np.random.random_sample(shape).astype(dtype) for shape, dtype in fields]
+	item = (arrays[0], tuple(arrays[1:]))
+	ready.release()
+	start.wait()
+	wait_cpu = 0.0
+	wait_time = 0.0
+	while not control.request_quit:
+		busy(args.actor_us)
+		t = time.perf_counter()
+		c = time.process_time()
+		if flow is None:
+			# 従来のキューの長さのポーリング
+			while args.batch_size <= queue.qsize() and not control.request_quit:
+				time.sleep(0.001)
+		else:
+			acquired = False
+			while not acquired and not control.request_quit:
+				acquired = flow.acquire(actor_id, 0.1)
+			if not acquired:
+				break
+		wait_cpu += time.process_time() - c
+		wait_time += time.perf_counter() - t
+		queue.put(item, sender=actor_id)
+	results.put((wait_cpu, wait_time))
+
+
+def run(actor_num, flow, fields):
+	"""actor_num 個の Actor と Learner 相当の処理を args.seconds 秒動かす.
+
+	Returns:
+		(追加遷移数/秒, 学習回数/秒, 学習回数/追加遷移数, Actor の待ち時間の割合, 待ち時間中の CPU 使用率).
+	"""
+	queue = transport.SharedMemoryQueue(fields, args.slots)
+	control = transport.ControlBlock(actor_num)
+	ready = mp.Semaphore(0)
+	start = mp.Event()
+	results = mp.Queue()
+	procs = [
+	    mp.Process(target=actor, args=(i, queue, flow, control, fields, ready, start, results)) for i in range(actor_num)
+	]
+	for p in procs:
+		p.start()
+	for p in procs:
+		ready.acquire()
+
+	inserted_num = 0
+	update_num = 0
+
+	def add(sender, priorities, batch):
+		nonlocal inserted_num
+		inserted_num += len(priorities)
+		if flow is not None:
+			flow.inserted(sender, len(priorities))
+
+	t = time.perf_counter()
+	start.set()
+	if flow is not None:
+		flow.start()
+	while time.perf_counter() - t < args.seconds:
+		queue.drain(add, with_sender=True)
+		if flow is not None and flow.ahead():
+			queue.wait(0.1)
+			continue
+		busy(args.learner_us)
+		update_num += 1
+		if flow is not None:
+			flow.updated()
+	control.request_quit = True
+	elapsed = time.perf_counter() - t
+
+	# 送信途中の Actor が終了できるよう残りを読み捨てる
+	wait_cpu = 0.0
+	wait_time = 0.0
+	for _ in procs:
+		while True:
+			queue.drain(add, with_sender=True)
+			try:
+				c, w = results.get(timeout=0.01)
+				break
+			except Empty:
+				pass
+		wait_cpu += c
+		wait_time += w
+	for p in procs:
+		p.join()
+	queue.close()
+	control.close()
+	return (inserted_num / elapsed, update_num / elapsed, update_num / max(inserted_num, 1), wait_time /
+	        (elapsed * actor_num), wait_cpu / max(wait_time, 1e-9))
+
+
+if __name__ == "__main__":
+	state_shape = tuple(int(s) for s in args.state_shape.split(','))
+	fields = replay.get_batch_fields({}, state_shape, args.batch_size)
+
+	for actor_num in [int(s) for s in args.actors.split(',')]:
+		cases = [('polling', None)]
+		for ratio in [float(s) for s in args.ratios.split(',')]:
+			cases.append((f'credits ratio {ratio:g}', transport.FlowControl(actor_num, args.credits, ratio)))
+		for name, flow in cases:
+			inserts, updates, ratio, wait, wait_cpu = run(actor_num, flow, fields)
+			print(f'actors: {actor_num:>3} {name:<20} inserts/s: {inserts:9.0f} updates/s: {updates:7.0f} '
+			      f'replay ratio: {ratio:7.4f} actor waiting: {wait * 100:5.1f} % cpu while waiting: {wait_cpu * 100:5.1f} %')
@@ -1,33 +1,34 @@
 #!/usr/bin/env python
 import os
-import time
 import datetime
-import multiprocessing as mp
-from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 import numpy as np
 from collections import namedtuple
-import psycopg2
 
 import trade_environment
 import db_initializer
 import tables
+import replay
 from replay import ReplayMemory
 import model
+import transport
+from telemetry import LearnerTelemetry
 
 
 class Learner(object):
 
-	def __init__(self, params, param_set_id, status_dict, shared_state, remote_mem):
+	def __init__(self, params, param_set_id, control, remote_mem, flow=None):
 		self.params = params
 		self.param_set_id = param_set_id
-		self.status_dict = status_dict
-		self.shared_state = shared_state
+		self.control = control
 		self.remote_mem = remote_mem
+		self.flow = flow # Actor からの流量制御、None なら制御しない
+		self.inserted_num = 0
 
-		gpu = 0
-		torch.cuda.set_device(gpu)
+		gpu = 0 if torch.cuda.is_available() else -1
+		if 0 <= gpu:
+			torch.cuda.set_device(gpu)
 
 		ep = params['env']
 		ap = params['actor']
@@ -37,10 +38,6 @@ class Learner(object):
 		model_formula = f'model.{lp["model"]}(self.state_shape, self.action_dim, hidden_size={lp["hidden_size"]}).to(self.device)'
 		optimizer_formula = lp["optimizer"].format('self.Q.parameters()')
 
-		self.conn = psycopg2.connect(params["db"]["connection_string"])
-		self.conn.autocommit = True
-		self.cur = self.conn.cursor()
-
 		self.device = torch.device("cuda:{}".format(gpu) if 0 <= gpu and torch.cuda.is_available() else "cpu")
 		self.state_shape = tuple(ep['frames_height_width'])
 		self.batch_size = lp['replay_sample_size']
@@ -51,7 +48,7 @@ class Learner(object):
 		self.Q = eval(model_formula)
 		self.Q_target = eval(model_formula) # Target Q network which is slow moving replica of self.Q
 		self.optimizer = eval(optimizer_formula)
-		self.replay_memory = ReplayMemory(rmp)
+		self.replay_memory = ReplayMemory(rmp, self.state_shape)
 
 		self.train_num = 0
 		self.model_file_name = db_initializer.get_state_dict_name(params)
@@ -62,36 +59,44 @@ class Learner(object):
 			self.optimizer.load_state_dict(saved_state['optimizer'])
 			self.train_num = saved_state['train_num']
 
-		self.shared_state['Q_state_dict'] = self.state_dict_to_cpu(self.Q.state_dict()), self.state_dict_to_cpu(
-		    self.Q_target.state_dict())
-		self.status_dict['Q_state_dict_stored'] = True
+		# 重みは共有メモリ上のバッファで配信し、Actor が接続できる様にその名前を共有する
+		state_dicts = [self.Q.state_dict(), self.Q_target.state_dict()]
+		self.shared_weights = transport.SharedWeights(transport.state_dicts_numel(state_dicts))
+		self.shared_weights.publish(state_dicts)
+		self.control.weights_name = self.shared_weights.name
+		self.control.Q_state_dict_stored = True
 
-		self.last_Q_state_dict_id = 1
-		self.status_dict['Q_state_dict_id'] = self.last_Q_state_dict_id
-		self.status_dict['train_num'] = self.train_num
+		self.control.train_num = self.train_num
 
 		self.gamma_n = params['actor']['gamma']**params['actor']['num_steps']
 
-	def state_dict_to_cpu(self, state_dict):
-		d = OrderedDict()
-		for k, v in state_dict.items():
-			d[k] = v.cpu()
-		return d
-
 	def add_experience_to_replay_mem(self):
-		while self.remote_mem.qsize():
-			priorities, batch = self.remote_mem.get()
-			self.replay_memory.add(priorities, batch)
+		# 共有メモリ上のバッチをそのままリプレイメモリへコピーし、送信元の Actor へクレジットを返せるようにする
+		self.remote_mem.drain(self.add_batch, with_sender=True)
+		self.control.inserted_num = self.inserted_num
 
-	def compute_loss_and_priorities(self, batch_size):
-		indices, n_step_transition_batch, before_priorities = self.replay_memory.sample(batch_size)
+	def add_batch(self, sender, priorities, batch):
+		self.replay_memory.add(priorities, batch)
+		n = len(priorities)
+		self.inserted_num += n
+		if self.flow is not None:
+			self.flow.inserted(sender, n)
 
-		s = n_step_transition_batch[0].to(self.device)
-		a = n_step_transition_batch[1].to(self.device)
-		r = n_step_transition_batch[2].to(self.device)
-		a_latest = n_step_transition_batch[3].to(self.device)
-		s_latest = n_step_transition_batch[4].to(self.device)
-		terminal = n_step_transition_batch[5].to(self.device)
+	def compute_loss_and_priorities(self, batch_size):
+		indices, n_step_transition_batch, before_priorities, weights = self.replay_memory.sample(batch_size)
+
+		# リプレイメモリ内の格納型のまま転送してからデバイス上で変換する
+		s = n_step_transition_batch[0].to(self.device, non_blocking=True).float()
+		a = n_step_transition_batch[1].to(self.device, non_blocking=True).long()
+		r = n_step_transition_batch[2].to(self.device, non_blocking=True)
+		a_latest = n_step_transition_batch[3].to(self.device, non_blocking=True).long()
+		s_latest = n_step_transition_batch[4].to(self.device, non_blocking=True).float()
+		terminal = n_step_transition_batch[5].to(self.device, non_blocking=True).float()
+		state_scale = self.replay_memory.state_scale
+		if state_scale != 1.0:
+			s *= state_scale
+			s_latest *= state_scale
+		weights = torch.from_numpy(weights).to(self.device)
 
 		q = self.Q(s)
 		q_a = q.take(self.take_offsets + a).squeeze()
@@ -101,7 +106,8 @@ class Learner(object):
 			Gt = r + (1.0 - terminal) * self.gamma_n * self.Q_target(s_latest).take(self.take_offsets + a_latest).squeeze()
 			td_error = Gt - q_a
 
-		loss = F.smooth_l1_loss(q_a, Gt)
+		# 優先度付きサンプリングによる偏りを重要度サンプリングの重みで補正する
+		loss = (weights * F.smooth_l1_loss(q_a, Gt, reduction='none')).mean()
 		# loss = td_error**2 / 2
 
 		# Compute the new priorities of the experience
@@ -126,10 +132,17 @@ class Learner(object):
 	def learn(self):
 		lp = self.params['learner']
 
-		t = tables.LearnerData()
-		record_type = t.get_record_type()
-		record_insert = t.get_insert()
-		cur = self.cur
+		dp = self.params['db']
+		writer_options = dict(format=dp['copy_format'], flush_rows=dp['copy_flush_rows'], flush_interval=dp['copy_flush_interval'])
+
+		# 通常は summary_steps ステップ毎の集計値のみ登録し、record_raw_data 指定時のみステップ毎の生データも登録する
+		summary_writer = tables.LearnerSummary().get_writer(dp['connection_string'], **writer_options)
+		telemetry = LearnerTelemetry(summary_writer, self.param_set_id, lp['summary_steps'])
+		record_raw_data = lp['record_raw_data']
+		if record_raw_data:
+			t = tables.LearnerData()
+			record_type = t.get_record_type()
+			record_writer = t.get_writer(dp['connection_string'], **writer_options)
 		param_set_id = self.param_set_id
 		now = datetime.datetime.now
 		step_num = 0
@@ -139,13 +152,22 @@ class Learner(object):
 		send_to_actor_freq = lp['send_to_actor_freq']
 
 		print('learner waiting for replay memory.')
-		while self.replay_memory.size() <= min_replay_mem_size:
+		control = self.control
+		while self.replay_memory.size() <= min_replay_mem_size and not control.quit:
 			self.add_experience_to_replay_mem()
-			time.sleep(0.01)
+			self.remote_mem.wait(0.1)
 		step_num = 0
 		print('learner start')
-		while not self.status_dict['quit']:
+		flow = self.flow
+		if flow is not None:
+			flow.start()
+		telemetry.start(self.inserted_num)
+		while not control.quit:
 			self.add_experience_to_replay_mem()
+			# 遷移１つあたりの学習回数が目標に達していたら、Actor から新たな遷移が届くまで待つ
+			if flow is not None and flow.ahead():
+				self.remote_mem.wait(0.1)
+				continue
 			# 4. Sample a prioritized batch of transitions
 			# 5. & 7. Apply double-Q learning rule, compute loss and experience priorities
 			# 8. Update priorities
@@ -156,29 +178,36 @@ class Learner(object):
 			# 6. Update parameters of the Q network(s)
 			if self.update_Q(loss):
 				target_sync_num += 1
+			if flow is not None:
+				flow.updated()
 			if step_num % send_to_actor_freq == 0:
-				self.shared_state['Q_state_dict'] = self.state_dict_to_cpu(self.Q.state_dict()), self.state_dict_to_cpu(
-				    self.Q_target.state_dict())
-				self.last_Q_state_dict_id += 1
-				self.status_dict['Q_state_dict_id'] = self.last_Q_state_dict_id
+				self.shared_weights.publish([self.Q.state_dict(), self.Q_target.state_dict()])
 				print('Send params to actors.')
 				send_param_num += 1
 
 			# 9. Periodically remove old experience from replay memory
 			step_num += 1
 			self.train_num += 1
-			self.status_dict['train_num'] = self.train_num
+			control.train_num = self.train_num
 
 			# DBへデータ登録
-			r = record_type(param_set_id, now(), self.train_num,
-			                step_num, loss.item(), q[0].tolist(), before_priorities.tolist(), after_priorities.tolist(),
-			                indices.tolist(), target_sync_num, send_param_num)
-			record_insert(cur, r)
-
+			telemetry.add(self.train_num, step_num, loss, q, before_priorities, after_priorities, indices, target_sync_num,
+			              send_param_num, self.inserted_num)
+			if record_raw_data:
+				r = record_type(param_set_id, now(), self.train_num,
+				                step_num, loss.item(), q[0].tolist(), before_priorities.tolist(), after_priorities.tolist(),
+				                indices.tolist(), target_sync_num, send_param_num)
+				record_writer.write(r)
+
+		telemetry.flush(self.train_num, step_num, target_sync_num, send_param_num, self.inserted_num)
+		summary_writer.close()
+		if record_raw_data:
+			record_writer.close()
 		print('learner end')
 
 		state_dict = {'module': self.Q.state_dict(), 'optimizer': self.optimizer.state_dict(), 'train_num': self.train_num}
 		torch.save(state_dict, self.model_file_name)
+		self.shared_weights.close()
 
 
 if __name__ == "__main__":
@@ -186,6 +215,8 @@ if __name__ == "__main__":
 	Simple standalone test routine for Leaner class
 	"""
 	import json
+	import time
+	import threading
 	import actor
 
 	with open('parameters.json', 'r') as f:
@@ -195,18 +226,26 @@ if __name__ == "__main__":
 
 	param_set_id = db_initializer.initialize(params)
 
-	mp_manager = mp.Manager()
-	status_dict = mp_manager.dict()
-	shared_state = mp_manager.dict()
-	shared_mem = mp_manager.Queue()
-
-	status_dict['quit'] = False
-	status_dict['Q_state_dict_stored'] = False
-	status_dict['request_quit'] = False
-
-	l = Learner(params, param_set_id, status_dict, shared_state, shared_mem)
-
-	actor = actor.Actor(params, param_set_id, 0, status_dict, shared_state, shared_mem)
-	actor.run()
-
-	l.learn()
+	control = transport.ControlBlock(params['actor']['num_actors'])
+	shared_mem = transport.SharedMemoryQueue(
+	    replay.get_batch_fields(params['replay_memory'], params['env']['frames_height_width'],
+	                            params['actor']['n_step_transition_batch_size']), params['actor']['transport_slots'])
+
+	l = Learner(params, param_set_id, control, shared_mem)
+
+	actor = actor.Actor(params, param_set_id, 0, control, shared_mem)
+
+	# 共有メモリのスロット数は有限なので、Actor は別スレッドで動かし Learner が読み出しながら学習する
+	# Actor が T ステップ進んだら train.py と同じく Actor、Learner の順に終了させる
+	actor_thread = threading.Thread(target=actor.run)
+	learner_thread = threading.Thread(target=l.learn)
+	learner_thread.start()
+	actor_thread.start()
+	while control.actor_steps[0] < params['actor']['T'] and actor_thread.is_alive():
+		time.sleep(0.1)
+	control.request_quit = True
+	actor_thread.join()
+	control.quit = True
+	learner_thread.join()
+	shared_mem.close()
+	control.close()
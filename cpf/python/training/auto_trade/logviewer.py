@@ -1,37 +1,127 @@
+import os
 import sys
 import datetime
 import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import psycopg2
 
 import parameters
+import db
+import tables
 
 params = parameters.load()
 dbp = params['db']
 ap = params['actor']
-conn = psycopg2.connect(dbp['connection_string'])
+conn = db.connect(dbp['connection_string'])
 conn.autocommit = True
 cur = conn.cursor()
 
+cache_dir = '.logviewer_cache' # actor_data の取得結果のキャッシュを置くディレクトリ
+cache_seconds = 60.0 # 登録が遅れて届くことがあるため、取得済みの最新の行からこの秒数以内に作られた行はキャッシュしない
+
+# 取得する列、is_q は action=q_action かどうか、cum_reward は actor_id と is_q 毎の reward の累積和
+col_names = [
+    'actor_id', 'train_num', 'ep_count', 'episode_index', 'index_in_episode', 'timestamp', 'action', 'q_action', 'reward',
+    'sum_reward', 'is_q', 'cum_reward'
+]
+col_types = [
+    db.int16, db.int32, db.int32, db.int32, db.int32, db.timestamp, db.int16, db.int16, db.float32, db.float32, db.boolean,
+    db.float64
+]
+rows_sql = f'''SELECT {",".join(col_names[:-2])}, action=q_action AS is_q,
+sum(CAST(reward AS double precision)) OVER (PARTITION BY actor_id, action=q_action ORDER BY train_num, timestamp ROWS UNBOUNDED PRECEDING) AS cum_reward
+FROM actor_data
+WHERE param_set_id=%s AND %s<train_num
+ORDER BY actor_id, train_num, timestamp;'''
+
+
+def load_cache(cache_filepath, table_oid):
+	"""キャッシュを読み込む、無いかテーブルが作り直されていたら空にする.
+
+	Returns:
+		(キャッシュ済みの最大 train_num, 行の構造化配列).
+	"""
+	try:
+		with np.load(cache_filepath) as cache:
+			if int(cache['table_oid']) == table_oid:
+				return int(cache['train_num']), cache['rows']
+	except (OSError, KeyError, ValueError):
+		pass
+	return -1, np.empty(0, [(name, t.dtype) for name, t in zip(col_names, col_types)])
+
+
+def save_cache(cache_filepath, table_oid, train_num, rows):
+	os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+	tmp_filepath = f'{cache_filepath}.{os.getpid()}.tmp'
+	with open(tmp_filepath, 'wb') as f:
+		np.savez(f, table_oid=table_oid, train_num=train_num, rows=rows)
+	os.replace(tmp_filepath, cache_filepath)
+
+
+def continue_cum_reward(cached_rows, new_rows):
+	"""新たに取得した行の累積和をキャッシュ済みの行の続きにする."""
+	for actor_id in np.unique(new_rows['actor_id']):
+		for is_q in (False, True):
+			m = (cached_rows['actor_id'] == actor_id) & (cached_rows['is_q'] == is_q)
+			if m.any():
+				new_m = (new_rows['actor_id'] == actor_id) & (new_rows['is_q'] == is_q)
+				new_rows['cum_reward'][new_m] += cached_rows['cum_reward'][m][-1]
+
+
+def fetch_rows(param_set_id):
+	"""param_set_id の全 actor_data 行を、キャッシュに無い分だけ DB から取得して返す.
+
+	キャッシュは (param_set_id, 最大 train_num) をキーとし、続きの行だけを１回の問い合わせで取得する.
+	actor_data は param_set_id でパーティショニングされているので、問い合わせはそのパーティションのみを読む.
+	累積和はサーバー側でウィンドウ関数により計算し、キャッシュ済みの合計から続ける.
+
+	キャッシュ済みの train_num 以下の行は再取得しないため、取得済みの最新の行より cache_seconds 秒以上前に作られたのに
+	キャッシュ後に届いた行は、キャッシュファイルを削除するまで表示されない.
+	"""
+	# パーティションかテーブルが作り直されたらキャッシュを捨てるため、その OID もキーにする
+	ad = tables.ActorData()
+	table_oid = ad.get_oid(cur, ad.get_partition_name(param_set_id)) or ad.get_oid(cur)
+	cache_filepath = os.path.join(cache_dir, f'actor_data.{param_set_id}.npz')
+	cached_train_num, cached_rows = load_cache(cache_filepath, table_oid)
+
+	new_rows = db.read_arrays(cur, rows_sql, (param_set_id, cached_train_num), col_names, col_types)
+	continue_cum_reward(cached_rows, new_rows)
+	rows = np.concatenate([cached_rows, new_rows])
+	rows = rows[np.argsort(rows['actor_id'], kind='stable')]
+
+	# 登録が確定したと見なせる範囲までをキャッシュする
+	# train_num は単調に増えるので、cutoff 以前に作られた行の最大 train_num より小さい行は全て cutoff 以前に作られている
+	if len(new_rows):
+		cutoff = new_rows['timestamp'].max() - np.timedelta64(int(cache_seconds * 1e6), 'us')
+		old_train_nums = new_rows['train_num'][new_rows['timestamp'] <= cutoff]
+		cache_train_num = int(old_train_nums.max()) - 1 if len(old_train_nums) else -1
+		if cached_train_num < cache_train_num:
+			save_cache(cache_filepath, table_oid, cache_train_num, rows[rows['train_num'] <= cache_train_num])
+	return rows
+
+
 if __name__ == "__main__":
 	ax = None
 
 	if sys.argv[1] == 'latest':
-		df = pd.read_sql(f'SELECT max(param_set_id) FROM param_set', conn)
+		df = pd.read_sql(f'SELECT max(param_set_id) AS max FROM param_set', conn)
 		param_set_id = int(df['max'][0])
 	else:
 		param_set_id = int(sys.argv[1])
 
 	min_actor_id = int(sys.argv[2]) if 2 < len(sys.argv) else 0
 	max_actor_id = int(sys.argv[3]) if 3 < len(sys.argv) else 7
-	min_train_num = sys.argv[4] if 4 < len(sys.argv) else 0
+	min_train_num = int(sys.argv[4]) if 4 < len(sys.argv) else 0
 	index = sys.argv[5] if 5 < len(sys.argv) else 'train_num'
+	if index not in col_names:
+		raise ValueError(f'index must be one of {col_names}')
 
 	ps = pd.read_sql(f'SELECT * FROM param_set WHERE param_set_id={param_set_id}', conn)
 	title = f"{ps['state_dict_prefix'][0]} {ps['model'][0]} hidden_size: {ps['hidden_size'][0]} {ps['action_suggester'][0]} {ps['reward_adjuster'][0]} {ps['policy'][0]}"
 
+	rows = fetch_rows(param_set_id)
+
 	plt.style.use('seaborn-whitegrid')
 
 	fig = plt.figure()
@@ -46,36 +136,29 @@ if __name__ == "__main__":
 	ax_q_action_number.set_title('Q action')
 
 	for i in range(min_actor_id, max_actor_id + 1):
-		cond = f'param_set_id={param_set_id} AND actor_id={i} AND {min_train_num}<={index}'
-
-		df = pd.read_sql(f'SELECT sum(reward) FROM actor_data WHERE {cond} AND action=q_action', conn)
-		if df.shape[0] != 0:
-			ax_action.set_title(f'Reward Q action : sum={df["sum"][0]}')
-
-		df = pd.read_sql(f'SELECT {index}, reward FROM actor_data WHERE {cond} AND action=q_action ORDER BY {index}', conn)
-		if df.shape[0] != 0:
-			df['reward'] = np.cumsum(df['reward'].values)
-			df.plot(x=index, ax=ax_action)
-
-		df = pd.read_sql(f'SELECT sum(reward) FROM actor_data WHERE {cond} AND action<>q_action', conn)
-		if df.shape[0] != 0:
-			ax_q_action.set_title(f'Reward Q action : sum={df["sum"][0]}')
-
-		df = pd.read_sql(f'SELECT {index}, reward FROM actor_data WHERE {cond} AND action<>q_action ORDER BY {index}', conn)
-		if df.shape[0] != 0:
-			df['reward'] = np.cumsum(df['reward'].values)
-			df.plot(x=index, ax=ax_q_action)
-
-		df = pd.read_sql(f'SELECT {index}, sum_reward FROM actor_data WHERE {cond} ORDER BY {index}', conn)
-		if df.shape[0] != 0:
-			df.plot(x=index, ax=ax_sum)
-
-		df = pd.read_sql(f'SELECT {index}, action FROM actor_data WHERE {cond} AND action=q_action ORDER BY {index}', conn)
-		if df.shape[0] != 0:
-			df.plot(x=index, ax=ax_q_action_number, linestyle='None', marker='.')
-		df = pd.read_sql(f'SELECT {index}, action FROM actor_data WHERE {cond} AND action<>q_action ORDER BY {index}', conn)
-		if df.shape[0] != 0:
-			df.plot(x=index, ax=ax_q_action_number, linestyle='None', marker='.')
+		r = rows[(rows['actor_id'] == i) & (min_train_num <= rows[index])]
+		if index != 'train_num':
+			r = r[np.argsort(r[index], kind='stable')]
+
+		for is_q, ax_reward, name in ((True, ax_action, 'Q action'), (False, ax_q_action, 'random action')):
+			g = r[r['is_q'] == is_q]
+			if len(g) != 0:
+				if index == 'train_num':
+					# サーバー側の累積和は train_num 順の全期間分で、表示範囲はその後ろ側なので先頭の直前までを引く
+					cum_reward = g['cum_reward'] - (g['cum_reward'][0] - g['reward'][0])
+				else:
+					# 他の列で絞り込むと除外された行が間に挟まるので、index 順に表示範囲だけで累積和を取る
+					cum_reward = np.cumsum(g['reward'], dtype=np.float64)
+				ax_reward.set_title(f'Reward {name} : sum={cum_reward[-1]}')
+				pd.DataFrame({index: g[index], 'reward': cum_reward}).plot(x=index, ax=ax_reward)
+
+		if len(r) != 0:
+			pd.DataFrame({index: r[index], 'sum_reward': r['sum_reward']}).plot(x=index, ax=ax_sum)
+
+		for is_q in (True, False):
+			g = r[r['is_q'] == is_q]
+			if len(g) != 0:
+				pd.DataFrame({index: g[index], 'action': g['action']}).plot(x=index, ax=ax_q_action_number, linestyle='None', marker='.')
 
 	# print(df)
 	plt.show()
@@ -7,6 +7,8 @@ from dnn import nn
 
 plot_enabled = False
 show_plot = False
+capture_enabled = False # モデル生成時に True なら plot_* フックの出力を captured へ取り出せるようにする
+captured = None # None 以外のリストなら推論時に plot_* フックが (種類名, プロット名, 出力) を追加する
 
 
 def plt_pause(sec):
@@ -24,11 +26,13 @@ def calc_width_height(length):
 
 
 def plot_img(self, name, batch, ax):
-	if not plot_enabled:
+	if not plot_enabled and not capture_enabled:
 		return self
 
 	def proc(x):
-		if show_plot and name:
+		if captured is not None:
+			captured.append(('plot_img', name, x.detach()[batch].sum(dim=0).cpu().numpy()))
+		if show_plot and name and ax is not None:
 			img = x.detach()[batch].sum(dim=0).cpu().numpy()
 			ax.cla()
 			ax.imshow(img)
@@ -39,11 +43,13 @@ def plot_img(self, name, batch, ax):
 
 
 def plot_dense(self, name, batch, ax):
-	if not plot_enabled:
+	if not plot_enabled and not capture_enabled:
 		return self
 
 	def proc(x):
-		if show_plot and name:
+		if captured is not None:
+			captured.append(('plot_dense', name, x.detach()[batch].cpu().numpy()))
+		if show_plot and name and ax is not None:
 			img = x.detach()[batch].cpu().numpy()
 			img = img.reshape(calc_width_height(img.size))
 			ax.cla()
@@ -55,11 +61,13 @@ def plot_dense(self, name, batch, ax):
 
 
 def plot_action(self, name, batch, ax, x_data):
-	if not plot_enabled:
+	if not plot_enabled and not capture_enabled:
 		return self
 
 	def proc(x):
-		if show_plot and name:
+		if captured is not None:
+			captured.append(('plot_action', name, x.detach()[batch].cpu().numpy()))
+		if show_plot and name and ax is not None:
 			ax.cla()
 			ax.plot(x_data, x.detach()[batch].cpu().numpy())
 			ax.set_title(name)
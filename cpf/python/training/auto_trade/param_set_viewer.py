@@ -4,15 +4,15 @@ import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import psycopg2
 
 import parameters
+import db
 
 params = parameters.load()
 
 dbp = params['db']
 ap = params['actor']
-conn = psycopg2.connect(dbp['connection_string'])
+conn = db.connect(dbp['connection_string'])
 conn.autocommit = True
 cur = conn.cursor()
 
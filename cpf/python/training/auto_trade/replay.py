@@ -1,45 +1,247 @@
 import numpy as np
 import torch
 
+
+def to_storage_states(states, state_dtype):
+	"""0～1 の値を持つ状態をリプレイメモリ格納用の型に変換する."""
+	state_dtype = np.dtype(state_dtype)
+	if state_dtype == np.uint8:
+		return np.rint(states * 255).astype(np.uint8)
+	else:
+		return states.astype(state_dtype)
+
+
+def get_batch_fields(params, state_shape, batch_size):
+	"""Actor から送る遷移バッチの各配列の (最大形状, dtype) のリストを取得する.
+
+	Args:
+		params: リプレイメモリ用パラメータ.
+		state_shape: バッチを除いた状態の形状 tuple.
+		batch_size: １回に送る遷移数.
+
+	Returns:
+		先頭が優先度、以降が ReplayMemory.add に渡す遷移バッチの各配列に対応するリスト.
+	"""
+	state_shape = tuple(state_shape)
+	state_dtype = np.dtype(params.get('state_dtype', 'float16'))
+	scalar = lambda dtype: ((batch_size,), dtype)
+	if params.get('storage', 'columnar') == 'frame_ring':
+		# フレームは全遷移の状態が重複無しの場合が最大となる
+		frames = ((batch_size * state_shape[0] * 2,) + state_shape[1:], state_dtype)
+		frame_indices = ((batch_size, state_shape[0]), np.int32)
+		return [
+		    scalar(np.float32), frames, frame_indices,
+		    scalar(np.int8), scalar(np.float32),
+		    scalar(np.int8), frame_indices,
+		    scalar(np.int8)
+		]
+	else:
+		states = ((batch_size,) + state_shape, state_dtype)
+		return [scalar(np.float32), states, scalar(np.int8), scalar(np.float32), scalar(np.int8), states, scalar(np.int8)]
+
+
+class SegmentTree(object):
+	"""NumPy 配列ベースのセグメント木、葉の更新と根方向への集約をバッチでまとめて行う.
+
+	Args:
+		capacity: 葉の数、内部では２の累乗に切り上げられる.
+		op: 子ノード２つから親ノード値を計算する ufunc.
+		neutral: 未使用の葉の値.
+	"""
+
+	def __init__(self, capacity, op, neutral):
+		size = 1
+		depth = 0
+		while size < capacity:
+			size *= 2
+			depth += 1
+		self.capacity = capacity
+		self.size = size
+		self.depth = depth
+		self.op = op
+		self.neutral = neutral
+		self.tree = np.full((2 * size,), neutral, dtype=np.float64) # 1 が根、size 以降が葉
+
+	def update(self, indices, values):
+		"""指定インデックスの葉を更新し、影響する親ノードのみ再計算する."""
+		tree = self.tree
+		op = self.op
+		i = np.asarray(indices, dtype=np.int64) + self.size
+		tree[i] = values
+		for _ in range(self.depth):
+			i = np.unique(i >> 1)
+			l = i << 1
+			tree[i] = op(tree[l], tree[l + 1])
+
+	def get(self, indices):
+		"""指定インデックスの葉の値を取得する."""
+		return self.tree[np.asarray(indices, dtype=np.int64) + self.size]
+
+	def root(self):
+		"""全葉の集約値を取得する."""
+		return self.tree[1]
+
+
+class SumTree(SegmentTree):
+	"""合計値のセグメント木、累積和から葉を探すことで優先度に比例したサンプリングを行う."""
+
+	def __init__(self, capacity):
+		SegmentTree.__init__(self, capacity, np.add, 0.0)
+
+	def total(self):
+		return self.tree[1]
+
+	def find_prefixsum_indices(self, prefixsums):
+		"""累積和が指定値を超える最初の葉のインデックスを全サンプル同時に木を降りて探す.
+
+		Args:
+			prefixsums: 0 以上 total() 未満の値の配列.
+
+		Returns:
+			葉のインデックス配列.
+		"""
+		tree = self.tree
+		s = np.array(prefixsums, dtype=np.float64)
+		i = np.ones(s.shape, dtype=np.int64)
+		for _ in range(self.depth):
+			l = i << 1
+			left = tree[l]
+			# 浮動小数点誤差で優先度 0 の右側へ降りてしまわない様にする
+			go_right = (left <= s) & (0.0 < tree[l + 1])
+			s -= left * go_right
+			i = l + go_right
+		return i - self.size
+
+
+class MinTree(SegmentTree):
+	"""最小値のセグメント木、重要度サンプリングの重み正規化用に最小優先度を取得する."""
+
+	def __init__(self, capacity):
+		SegmentTree.__init__(self, capacity, np.minimum, np.inf)
+
+	def min(self):
+		return self.tree[1]
+
+
 class ReplayMemory(object):
+	"""優先度付きリプレイメモリ、遷移は型付きの列毎に事前確保した配列に格納する.
+
+	params['storage'] が 'frame_ring' の場合はフレームをリングバッファに１回だけ格納し、
+	遷移にはフレームの通し番号を持たせ、サンプリング時に状態を組み立てる.
 
-	def __init__(self, params):
+	Args:
+		params: リプレイメモリ用パラメータ.
+		state_shape: バッチを除いた状態の形状 tuple、(フレーム数, 高さ, 幅).
+	"""
+
+	def __init__(self, params, state_shape):
 		self.capacity = params['soft_capacity']
 		self.priority_exponent = params['priority_exponent']
 		self.importance_sampling_exponent = params['importance_sampling_exponent']
+		self.state_dtype = np.dtype(params.get('state_dtype', 'float16'))
+		self.state_scale = 1.0 / 255 if self.state_dtype == np.uint8 else 1.0 # 格納値から実際の状態値への係数
+		self.frame_ring = params.get('storage', 'columnar') == 'frame_ring' # フレームリング方式で格納するかどうか
+		self.state_shape = tuple(state_shape)
 		self.start = 0
 		self.end = 0
 		self.length = 0
-		self.priorities = np.zeros((self.capacity,), dtype=np.float32)
-		self.transitions = np.zeros((self.capacity,), dtype=np.object)
+		self.sum_tree = SumTree(self.capacity)
+		self.min_tree = MinTree(self.capacity)
 
-	def sample(self, sample_size):
-		# 有効データ部位取得
-		if self.length < self.capacity:
-			priorities = self.priorities[:self.end]
-			transitions = self.transitions[:self.end]
+		# 遷移の各要素毎の列 (状態, アクション, 報酬, Nステップ後アクション, Nステップ後状態, 終端フラグ)
+		# フレームリング方式の場合は状態の代わりにフレーム通し番号を持つ
+		cap = self.capacity
+		if self.frame_ring:
+			state_column_shape = (cap, self.state_shape[0])
+			state_column_dtype = np.int64
+			self.frame_capacity = params.get('frame_capacity', cap * 2) # リングに格納できるフレーム数
+			self.frames = np.zeros((self.frame_capacity,) + self.state_shape[1:], dtype=self.state_dtype)
+			self.frame_count = 0 # これまでに追加されたフレーム数、フレーム通し番号の次の値
+			self.frame_bases = np.zeros((cap,), dtype=np.int64) # 各遷移が参照するフレームの最小通し番号
 		else:
-			priorities = self.priorities
-			transitions = self.transitions
+			state_column_shape = (cap,) + self.state_shape
+			state_column_dtype = self.state_dtype
+		self.columns = (np.zeros(state_column_shape, dtype=state_column_dtype), np.zeros((cap,), dtype=np.int8),
+		                np.zeros((cap,), dtype=np.float32), np.zeros((cap,), dtype=np.int8),
+		                np.zeros(state_column_shape, dtype=state_column_dtype), np.zeros((cap,), dtype=np.int8))
+		self.sample_buffers = {}
+
+	def get_sample_buffers(self, sample_size):
+		"""サンプル取得先となる tensor を取得する、CUDA が使えるならページ固定メモリに確保する."""
+		buffers = self.sample_buffers.get(sample_size)
+		if buffers is None:
+			pin_memory = torch.cuda.is_available()
+			state_dtype = torch.from_numpy(np.empty((0,), dtype=self.state_dtype)).dtype
+			buffers = tuple(
+			    torch.empty((sample_size,) + self.state_shape, dtype=state_dtype, pin_memory=pin_memory) if i == 0 or i == 4
+			    else torch.empty((sample_size,) + c.shape[1:], dtype=torch.from_numpy(c[:0]).dtype, pin_memory=pin_memory)
+			    for i, c in enumerate(self.columns))
+			self.sample_buffers[sample_size] = buffers
+		return buffers
+
+	def sample_indices(self, sample_size):
+		"""優先度に比例したインデックスと重要度サンプリングの重みを取得する.
+
+		Returns:
+			(インデックス, 優先度, 重要度サンプリングの重み) のタプル.
+		"""
+		# 合計値を sample_size 個の区間に分け各区間から１つずつ抽出する
+		total = self.sum_tree.total()
+		segment = total / sample_size
+		prefixsums = (np.arange(sample_size) + np.random.random_sample(sample_size)) * segment
+		indices = self.sum_tree.find_prefixsum_indices(prefixsums)
+		priorities = self.sum_tree.get(indices)
+
+		# 最小優先度のものの重みが 1 となる様に正規化した重みを計算
+		weights = (priorities / self.min_tree.min())**-self.importance_sampling_exponent
 
+		return indices, priorities.astype(np.float32), weights.astype(np.float32)
+
+	def sample(self, sample_size):
+		"""優先度に基づき遷移をサンプリングする.
+
+		Returns:
+			(インデックス, (状態, アクション, 報酬, Nステップ後アクション, Nステップ後状態, 終端フラグ), 優先度, 重要度サンプリングの重み) のタプル.
+			tensor は格納時の型のままなので使用側で変換する必要がある、また次回の sample 呼び出しで上書きされる.
+		"""
 		# 優先度を元にインデックス番号を抽出
-		indices = torch.multinomial(torch.tensor(priorities, dtype=torch.float32), sample_size, replacement=False).numpy()
+		indices, priorities, weights = self.sample_indices(sample_size)
 
-		# 取得されたインデックスを元に tensor 作成
-		transitions = transitions[indices]
-		s = torch.tensor([t[0] for t in transitions], dtype=torch.float32)
-		a = torch.tensor([t[1].astype(np.int64) for t in transitions], dtype=torch.int64)
-		r = torch.tensor([t[2] for t in transitions], dtype=torch.float32)
-		a_latest = torch.tensor([t[3].astype(np.int64) for t in transitions], dtype=torch.int64)
-		s_latest = torch.tensor([t[4] for t in transitions], dtype=torch.float32)
-		terminal = torch.tensor([t[5].astype(np.float32) for t in transitions], dtype=torch.float32)
+		# 取得されたインデックスを元に列毎にまとめて tensor へ集める
+		buffers = self.get_sample_buffers(sample_size)
+		for i, (c, b) in enumerate(zip(self.columns, buffers)):
+			if self.frame_ring and (i == 0 or i == 4):
+				# フレーム通し番号からリング内の位置を求め、フレームを集めて状態を組み立てる
+				frame_indices = c[indices] % self.frame_capacity
+				np.take(self.frames, frame_indices, axis=0, out=b.numpy())
+			else:
+				np.take(c, indices, axis=0, out=b.numpy())
 
-		return indices, (s, a, r, a_latest, s_latest, terminal), priorities[indices]
+		return indices, buffers, priorities, weights
 
 	def set_priorities(self, indices, priorities):
-		self.priorities[indices] = (priorities + self.importance_sampling_exponent)**self.priority_exponent 
+		priorities = (priorities + self.importance_sampling_exponent)**self.priority_exponent
+		self.sum_tree.update(indices, priorities)
+		self.min_tree.update(indices, priorities)
 
 	def add(self, priorities, n_step_transitions):
+		"""遷移を追加する.
+
+		Args:
+			priorities: 各遷移の優先度の元となるTD誤差.
+			n_step_transitions: (状態, アクション, 報酬, Nステップ後アクション, Nステップ後状態, 終端フラグ) の各配列のタプル、状態は to_storage_states で変換済みのもの.
+				フレームリング方式の場合は (フレーム, 状態のフレームインデックス, アクション, 報酬, Nステップ後アクション, Nステップ後状態のフレームインデックス, 終端フラグ) となり、
+				フレームインデックスはこのバッチのフレーム配列内でのインデックスとなる.
+		"""
+		if self.frame_ring:
+			# フレームをリングへ格納し、バッチ内インデックスを通し番号に変換する
+			frames = n_step_transitions[0]
+			frame_base = self.frame_count
+			self.write_ring(self.frames, frame_base % self.frame_capacity, frames)
+			self.frame_count += len(frames)
+			n_step_transitions = (n_step_transitions[1] + frame_base,) + tuple(
+			    n_step_transitions[2:5]) + (n_step_transitions[5] + frame_base, n_step_transitions[6])
+
 		l = len(priorities)
 		cap = self.capacity
 
@@ -47,26 +249,20 @@ class ReplayMemory(object):
 		if cap < l:
 			start = l - cap
 			priorities = priorities[start:]
-			n_step_transitions = n_step_transitions[start:]
+			n_step_transitions = [v[start:] for v in n_step_transitions]
 			l = cap
 			self.end = 0
 
-		priorities = (priorities + self.importance_sampling_exponent)**self.priority_exponent 
-
 		# バッファへコピー、その際バッファ終端を跨ぐなら２回に分けて行う
 		pos = self.end
+		for c, v in zip(self.columns, n_step_transitions):
+			self.write_ring(c, pos, v)
+		if self.frame_ring:
+			self.write_ring(self.frame_bases, pos, np.full((l,), frame_base, dtype=np.int64))
+
+		# 優先度は木へ反映
 		end = pos + l
-		if cap < end:
-			n = cap - pos
-			self.priorities[pos:] = priorities[:n]
-			self.transitions[pos:] = n_step_transitions[:n]
-			s = n
-			n = end - cap
-			self.priorities[:n] = priorities[s:]
-			self.transitions[:n] = n_step_transitions[s:]
-		else:
-			self.priorities[pos:end] = priorities
-			self.transitions[pos:end] = n_step_transitions
+		self.set_priorities(np.arange(pos, end) % cap, priorities)
 
 		# 有効データ数更新
 		self.length += l
@@ -77,5 +273,42 @@ class ReplayMemory(object):
 		self.end = end % cap
 		self.start = (end + cap - self.length) % cap
 
+		# フレームが上書きされてしまった遷移は無効にする
+		if self.frame_ring:
+			self.evict_overwritten_frames()
+
+	def write_ring(self, buffer, pos, values):
+		"""リングバッファへ書き込む、バッファ終端を跨ぐなら２回に分けて行う."""
+		cap = len(buffer)
+		end = pos + len(values)
+		if cap < end:
+			n = cap - pos
+			buffer[pos:] = values[:n]
+			buffer[:end - cap] = values[n:]
+		else:
+			buffer[pos:end] = values
+
+	def evict_overwritten_frames(self):
+		"""参照しているフレームがリング上で上書きされた古い遷移を無効にする."""
+		threshold = self.frame_count - self.frame_capacity
+		cap = self.capacity
+		start = self.start
+		length = self.length
+		bases = self.frame_bases
+
+		# 有効範囲を古い順に２区間に分け、フレーム最小通し番号が昇順であることを利用して境界を探す
+		first_len = min(length, cap - start)
+		n = int(np.searchsorted(bases[start:start + first_len], threshold))
+		if n == first_len and first_len < length:
+			n += int(np.searchsorted(bases[:length - first_len], threshold))
+		if n == 0:
+			return
+
+		indices = (start + np.arange(n)) % cap
+		self.sum_tree.update(indices, 0.0)
+		self.min_tree.update(indices, np.inf)
+		self.length -= n
+		self.start = (start + n) % cap
+
 	def size(self):
 		return self.length
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import time
+from argparse import ArgumentParser
+import numpy as np
+import torch
+
+from replay import SumTree, MinTree
+
+arg_parser = ArgumentParser(prog="replay_benchmark.py")
+arg_parser.add_argument("--sizes", default="100000,1000000,10000000", type=str, help="Comma separated replay sizes")
+arg_parser.add_argument("--batch-size", default=32, type=int, help="Sample size per learner step")
+arg_parser.add_argument("--repeat", default=20, type=int, help="Number of sample/update iterations to time")
+args = arg_parser.parse_args()
+
+priority_exponent = 0.6
+importance_sampling_exponent = 0.4
+
+
+def bench_multinomial(priorities, batch_size, repeat):
+	"""従来の torch.multinomial による全体走査でのサンプリングと優先度更新の時間を計測する."""
+	t = time.perf_counter()
+	for _ in range(repeat):
+		indices = torch.multinomial(torch.tensor(priorities, dtype=torch.float32), batch_size, replacement=False).numpy()
+		td = np.random.random_sample(batch_size).astype(np.float32)
+		priorities[indices] = (td + importance_sampling_exponent)**priority_exponent
+	return (time.perf_counter() - t) / repeat
+
+
+def bench_segment_tree(priorities, batch_size, repeat):
+	"""セグメント木でのサンプリング、重み計算、優先度更新の時間を計測する."""
+	n = len(priorities)
+	sum_tree = SumTree(n)
+	min_tree = MinTree(n)
+	sum_tree.update(np.arange(n), priorities)
+	min_tree.update(np.arange(n), priorities)
+
+	t = time.perf_counter()
+	for _ in range(repeat):
+		total = sum_tree.total()
+		prefixsums = (np.arange(batch_size) + np.random.random_sample(batch_size)) * (total / batch_size)
+		indices = sum_tree.find_prefixsum_indices(prefixsums)
+		weights = (sum_tree.get(indices) / min_tree.min())**-importance_sampling_exponent
+		td = np.random.random_sample(batch_size).astype(np.float32)
+		p = (td + importance_sampling_exponent)**priority_exponent
+		sum_tree.update(indices, p)
+		min_tree.update(indices, p)
+	return (time.perf_counter() - t) / repeat
+
+
+if __name__ == "__main__":
+	torch.set_num_threads(1)
+
+	for n in [int(float(s)) for s in args.sizes.split(',')]:
+		priorities = ((np.random.random_sample(n) + importance_sampling_exponent)**priority_exponent).astype(np.float32)
+		t_mn = bench_multinomial(priorities.copy(), args.batch_size, args.repeat)
+		t_st = bench_segment_tree(priorities.copy(), args.batch_size, args.repeat)
+		print(f'size: {n:>10} multinomial: {t_mn * 1000:10.3f} ms/step segment tree: {t_st * 1000:8.3f} ms/step speedup: {t_mn / t_st:8.1f}x')
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+import time
+import datetime
+from argparse import ArgumentParser
+import numpy as np
+
+import parameters
+import db
+import tables
+import trade_environment
+
+max_train_num = 2**31 - 1
+
+# 集計列の統合方法、ロールアップ済みの行に新たな集計行を足し込む際に使う
+merge_exprs = {
+    'first_train_num': 'least({t}.{c},excluded.{c})',
+    'last_train_num': 'greatest({t}.{c},excluded.{c})',
+    'first_timestamp': 'least({t}.{c},excluded.{c})',
+    'last_timestamp': 'greatest({t}.{c},excluded.{c})',
+    'row_count': '{t}.{c}+excluded.{c}',
+    'q_count': '{t}.{c}+excluded.{c}',
+    'reward_sum': '{t}.{c}+excluded.{c}',
+    'q_reward_sum': '{t}.{c}+excluded.{c}',
+    'last_sum_reward': 'CASE WHEN {t}.last_timestamp<=excluded.last_timestamp THEN excluded.{c} ELSE {t}.{c} END',
+    'action_counts': 'ARRAY(SELECT a+b FROM unnest({t}.{c},excluded.{c}) WITH ORDINALITY AS u(a,b,i) ORDER BY i)',
+}
+# merge_exprs と同じ統合を読み出した行に行う ufunc、last_sum_reward は last_timestamp が最も新しい行の値にする
+merge_ufuncs = {
+    'first_train_num': np.minimum,
+    'last_train_num': np.maximum,
+    'first_timestamp': np.minimum,
+    'last_timestamp': np.maximum,
+    'row_count': np.add,
+    'q_count': np.add,
+    'reward_sum': np.add,
+    'q_reward_sum': np.add,
+}
+
+
+def connect(connection_string):
+	"""ロールアップ用に接続する、集計の SQL は PostgreSQL 用なので他のバックエンドなら例外を投げる."""
+	if db.get_backend(connection_string) is not db.postgresql:
+		raise ValueError(f'Rollup tables require PostgreSQL, connection_string is "{connection_string}"')
+	return db.connect(connection_string)
+
+
+def get_aggregate_sql(tbl, train_bucket_size):
+	"""actor_data の行をロールアップテーブル tbl の行に集計する SELECT 文を取得する.
+
+	パラメータは (param_set_id, 下限 train_num, 上限 train_num) で、下限は含まず上限は含む.
+	"""
+	exprs = {
+	    'param_set_id': 'param_set_id',
+	    'actor_id': 'actor_id',
+	    'ep_count': 'ep_count',
+	    'train_bucket': f'train_num/{train_bucket_size}*{train_bucket_size}',
+	    'first_train_num': 'min(train_num)',
+	    'last_train_num': 'max(train_num)',
+	    'first_timestamp': 'min(timestamp)',
+	    'last_timestamp': 'max(timestamp)',
+	    'row_count': 'count(*)',
+	    'q_count': 'count(*) FILTER (WHERE action=q_action)',
+	    'reward_sum': 'sum(reward::double precision)',
+	    'q_reward_sum': 'coalesce(sum(reward::double precision) FILTER (WHERE action=q_action),0)',
+	    'last_sum_reward': '(array_agg(sum_reward ORDER BY timestamp DESC))[1]',
+	    'action_counts':
+	    f'ARRAY[{",".join([f"count(*) FILTER (WHERE action={a})" for a in range(trade_environment.action_num)])}]::int4[]',
+	}
+	keys = [c.name for c in tbl.get_primary_key_cols()]
+	return f'''SELECT {",".join([exprs[c.name] for c in tbl.get_cols()])}
+FROM actor_data
+WHERE param_set_id=%s AND %s<train_num AND train_num<=%s
+GROUP BY {",".join([exprs[k] for k in keys])}'''
+
+
+def get_upsert_sql(tbl, train_bucket_size):
+	"""actor_data の行を集計して tbl へ足し込む文を取得する、パラメータは get_aggregate_sql と同じ."""
+	keys = [c.name for c in tbl.get_primary_key_cols()]
+	sets = [f'{c.name}={merge_exprs[c.name].format(t=tbl._name, c=c.name)}' for c in tbl.get_cols() if c.name not in keys]
+	return f'''INSERT INTO {tbl._name}({",".join([c.name for c in tbl.get_cols()])})
+{get_aggregate_sql(tbl, train_bucket_size)}
+ON CONFLICT ({",".join(keys)}) DO UPDATE SET {",".join(sets)};'''
+
+
+def rollup(conn, param_set_id, train_bucket_size, margin, compact_keep=None):
+	"""前回から増えた actor_data の行をエピソード毎と train_num の区間毎のロールアップテーブルへ足し込む.
+
+	集計済みの train_num の上限を rollup_state に記録し、次回はその続きの行だけを読む.
+	actor_data の登録は遅れて届くことがあるため、未集計の最新の行から margin 秒以内に作られた行は次回へ回す.
+	train_num は単調に増えるので、それより前に作られた行の最大 train_num 未満までを集計する.
+	集計済みの上限以下の行は二度と読まないため、作られてから margin 秒以上遅れて届いた行は集計されない.
+	エピソードや区間が複数回に分かれて集計されても、既存の行へ足し込むので結果は一度に集計した場合と同じになる.
+
+	Args:
+		conn: 自動コミットでない接続、全体を１トランザクションで行う.
+		param_set_id: パラメータセットID.
+		train_bucket_size: actor_train_summary の１行に集計する train_num の幅.
+		margin: 集計を保留する最新の行からの秒数、None なら全て集計する.
+		compact_keep: None 以外なら集計済みの actor_data の行のうち、集計済み上限からこの幅より古いものを削除する.
+
+	Returns:
+		(集計済みの train_num の上限, 削除した actor_data の行数).
+	"""
+	es = tables.ActorEpisodeSummary()
+	ts = tables.ActorTrainSummary()
+	with conn:
+		with conn.cursor() as cur:
+			# 同時に実行されても二重に足し込まないよう状態の行をロックする
+			cur.execute(
+			    'INSERT INTO rollup_state VALUES (%s,%s,-1,-1,now()) ON CONFLICT DO NOTHING;'
+			    'SELECT train_bucket_size,rolled_train_num,compacted_train_num FROM rollup_state WHERE param_set_id=%s FOR UPDATE;',
+			    (param_set_id, train_bucket_size, param_set_id))
+			stored_bucket_size, rolled_train_num, compacted_train_num = cur.fetchone()
+			if stored_bucket_size != train_bucket_size:
+				raise ValueError(
+				    f'param_set_id {param_set_id} is rolled up with train_bucket_size {stored_bucket_size}, not {train_bucket_size}')
+
+			if margin is None:
+				cur.execute('SELECT max(train_num) FROM actor_data WHERE param_set_id=%s AND %s<train_num;',
+				            (param_set_id, rolled_train_num))
+			else:
+				cur.execute(
+				    'SELECT max(train_num)-1 FROM actor_data WHERE param_set_id=%s AND %s<train_num AND timestamp<=('
+				    'SELECT max(timestamp) FROM actor_data WHERE param_set_id=%s AND %s<train_num)-%s*interval \'1 second\';',
+				    (param_set_id, rolled_train_num, param_set_id, rolled_train_num, margin))
+			upto = cur.fetchone()[0]
+			if upto is not None and rolled_train_num < upto:
+				params = (param_set_id, rolled_train_num, upto)
+				cur.execute(get_upsert_sql(es, train_bucket_size), params)
+				cur.execute(get_upsert_sql(ts, train_bucket_size), params)
+				rolled_train_num = upto
+
+			deleted = 0
+			if compact_keep is not None and compacted_train_num < rolled_train_num - compact_keep:
+				compacted_train_num = rolled_train_num - compact_keep
+				cur.execute('DELETE FROM actor_data WHERE param_set_id=%s AND train_num<=%s;', (param_set_id, compacted_train_num))
+				deleted = cur.rowcount
+
+			cur.execute(
+			    'UPDATE rollup_state SET rolled_train_num=%s,compacted_train_num=%s,timestamp=now() WHERE param_set_id=%s;',
+			    (rolled_train_num, compacted_train_num, param_set_id))
+			return rolled_train_num, deleted
+
+
+def get_rolled_train_num(cur, param_set_id):
+	"""集計済みの train_num の上限、未集計なら -1."""
+	cur.execute('SELECT rolled_train_num FROM rollup_state WHERE param_set_id=%s;', (param_set_id,))
+	r = cur.fetchone()
+	return r[0] if r else -1
+
+
+def merge_rows(rows, keys):
+	"""主キーが同じ行を merge_exprs と同じ方法で１行に統合する.
+
+	Args:
+		rows: ロールアップテーブルの列の構造化配列.
+		keys: 主キーの列名リスト.
+
+	Returns:
+		主キー順に並んだ構造化配列.
+	"""
+	if len(rows) == 0:
+		return rows
+	rows = rows[np.lexsort([rows['last_timestamp']] + [rows[k] for k in reversed(keys)])]
+	same = np.ones(len(rows) - 1, np.bool_)
+	for k in keys:
+		same &= rows[k][1:] == rows[k][:-1]
+	starts = np.flatnonzero(np.concatenate([[True], ~same]))
+	if len(starts) == len(rows):
+		return rows
+
+	# 主キーと last_sum_reward は last_timestamp が最も新しい各グループ末尾の行の値を使う
+	ends = np.append(starts[1:], len(rows)) - 1
+	merged = rows[ends]
+	for name, ufunc in merge_ufuncs.items():
+		if name in rows.dtype.names:
+			merged[name] = ufunc.reduceat(rows[name], starts)
+	for g in np.flatnonzero(starts < ends):
+		merged['action_counts'][g] = np.sum(rows['action_counts'][starts[g]:ends[g] + 1].tolist(), axis=0).tolist()
+	return merged
+
+
+def read_summary(cur, tbl, param_set_id, train_bucket_size):
+	"""ロールアップ済みの行と、まだ集計されていない actor_data の行をその場で集計した行を合わせて構造化配列で返す.
+
+	集計済みの上限を跨ぐエピソードや区間は両方に含まれるので、merge_rows で主キー毎に１行へ統合する.
+	行は主キー順に並ぶ.
+
+	Args:
+		cur: カーソル.
+		tbl: tables.ActorEpisodeSummary または tables.ActorTrainSummary.
+		param_set_id: パラメータセットID.
+		train_bucket_size: ActorTrainSummary の場合の train_num の幅.
+	"""
+	rolled_train_num = get_rolled_train_num(cur, param_set_id)
+	cols = tbl.get_cols()
+	names = [c.name for c in cols]
+	types = [c.type for c in cols]
+	rolled = db.select(cols).frm(tbl).where('param_set_id=%s').read_arrays(cur, param_set_id)
+	tail = db.read_arrays(cur, get_aggregate_sql(tbl, train_bucket_size), (param_set_id, rolled_train_num, max_train_num),
+	                      names, types)
+	return merge_rows(np.concatenate([rolled, tail]), [c.name for c in tbl.get_primary_key_cols()])
+
+
+def run(params, param_set_id, control):
+	"""学習中に定期的にロールアップする、終了時には全 Actor が止まっているので残りを全て集計する."""
+	dbp = params['db']
+	interval = dbp['rollup_interval']
+	conn = connect(dbp['connection_string'])
+	last = time.perf_counter()
+	while not control.quit:
+		time.sleep(0.1)
+		if interval <= time.perf_counter() - last:
+			rollup(conn, param_set_id, dbp['rollup_train_bucket_size'], dbp['rollup_margin_seconds'], dbp['rollup_compact_keep'])
+			last = time.perf_counter()
+	rollup(conn, param_set_id, dbp['rollup_train_bucket_size'], None, dbp['rollup_compact_keep'])
+	conn.close()
+
+
+if __name__ == "__main__":
+	arg_parser = ArgumentParser(prog="rollup.py")
+	arg_parser.add_argument("param_set_id", type=str, help="Parameter set ID or 'latest'")
+	arg_parser.add_argument("--interval", default=0.0, type=float, help="Seconds between rollups, run once if 0")
+	arg_parser.add_argument("--margin-seconds", default=None, type=float,
+	                        help="Rows created within this many seconds of the newest row are left for the next rollup")
+	arg_parser.add_argument("--all", action="store_true", help="Roll up all rows, use only when no actor is running")
+	arg_parser.add_argument("--compact-keep", default=None, type=int,
+	                        help="Delete rolled up actor_data rows older than this train_num range, keep all if omitted")
+	args = arg_parser.parse_args()
+
+	params = parameters.load()
+	dbp = params['db']
+	conn = connect(dbp['connection_string'])
+	if args.param_set_id == 'latest':
+		with conn, conn.cursor() as cur:
+			cur.execute('SELECT max(param_set_id) FROM param_set;')
+			param_set_id = cur.fetchone()[0]
+	else:
+		param_set_id = int(args.param_set_id)
+	margin = dbp['rollup_margin_seconds'] if args.margin_seconds is None else args.margin_seconds
+	if args.all:
+		margin = None
+	compact_keep = dbp['rollup_compact_keep'] if args.compact_keep is None else args.compact_keep
+
+	while True:
+		t = time.perf_counter()
+		rolled_train_num, deleted = rollup(conn, param_set_id, dbp['rollup_train_bucket_size'], margin, compact_keep)
+		print(f'{datetime.datetime.now()} param_set_id: {param_set_id} rolled up to train_num: {rolled_train_num} '
+		      f'deleted: {deleted} rows {time.perf_counter() - t:.3f} s')
+		if args.interval <= 0:
+			break
+		time.sleep(args.interval)
+	conn.close()
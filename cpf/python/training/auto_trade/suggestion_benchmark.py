@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import time
+import random
+from argparse import ArgumentParser
+import numpy as np
+
+import trade_environment
+import action_suggester
+import synthetic_data
+
+arg_parser = ArgumentParser(prog="suggestion_benchmark.py")
+arg_parser.add_argument("--data", default=None, type=str, help="Binary history file, a synthetic one is generated if omitted")
+arg_parser.add_argument("--records", default=200000, type=int, help="Number of records of the synthetic history file")
+arg_parser.add_argument("--episodes", default=10, type=int, help="Number of episodes to run")
+arg_parser.add_argument("--spread-adj", default=3, type=float, help="spread_adj of TpActionSuggester")
+arg_parser.add_argument("--seed", default=0, type=int, help="Random seed")
+args = arg_parser.parse_args()
+
+
+def get_next_turning_index_original(suggester):
+	i1 = np.where(suggester.env.index_in_episode <= suggester.tp_indices)[0][:1]
+	return i1.item() if i1.size else -1
+
+
+def get_suggested_action_original(suggester):
+	"""従来の TpActionSuggester.get_suggested_action、比較用."""
+	tp_indices = suggester.tp_indices
+	tp_values = suggester.tp_values
+	value = suggester.env.get_value()
+	tp_idx = get_next_turning_index_original(suggester)
+	tp_delta = None
+	on_tp = False
+	if 0 <= tp_idx:
+		if tp_indices[tp_idx] == suggester.env.index_in_episode:
+			on_tp = True
+			tp_idx += 1
+		if tp_idx < len(tp_values):
+			tp_delta = tp_values[tp_idx] - value
+		threshould = suggester.threshould
+
+	suggested_action = 0
+	if suggester.env.position_type == 0:
+		if tp_delta is not None:
+			if threshould < tp_delta:
+				suggested_action = 1
+			elif tp_delta < -threshould:
+				suggested_action = 2
+	else:
+		if on_tp:
+			suggested_action = 3
+			if tp_delta is not None:
+				if threshould < tp_delta:
+					suggested_action = 1
+				elif tp_delta < -threshould:
+					suggested_action = 2
+		else:
+			suggested_action = 0
+			if tp_delta is not None:
+				if threshould < tp_delta and suggester.env.position_type != 1:
+					suggested_action = 1
+				elif tp_delta < -threshould and suggester.env.position_type != -1:
+					suggested_action = 2
+	return suggested_action
+
+
+def adjust_reward_original(adjuster, action):
+	"""従来の TpRewardAdjuster.adjust_reward、比較用."""
+	env = adjuster.env
+	tp_indices = adjuster.action_suggester.tp_indices
+	tp_values = adjuster.action_suggester.tp_values
+	value = env.get_value()
+	tp_idx = get_next_turning_index_original(adjuster.action_suggester)
+	tp_delta = None
+	on_tp = False
+	if 0 <= tp_idx:
+		if tp_indices[tp_idx] == env.index_in_episode:
+			on_tp = True
+			tp_idx += 1
+		if tp_idx < len(tp_values):
+			tp_delta = tp_values[tp_idx] - value
+
+	reward = 0.0
+	if env.is_action_ignored(action):
+		action = 0
+	if 1 <= action and action <= 3 and env.position_type != 0:
+		if tp_delta is not None and not on_tp:
+			reward -= adjuster.adj_rate * env.position_type * tp_delta
+	if action == 0:
+		if tp_delta is not None:
+			if env.position_type == 0:
+				if adjuster.threshould < abs(tp_delta):
+					reward -= adjuster.adj_rate * abs(tp_delta)
+			else:
+				pr = env.calc_positional_reward()
+				miss_position = tp_delta * env.position_type < 0
+				if adjuster.loss_cut_check and miss_position and pr < 0:
+					reward += pr * adjuster.adj_rate
+				if adjuster.securing_profit_check and on_tp and miss_position and 0 < pr:
+					reward -= pr * adjuster.adj_rate
+	elif action == 1 or action == 2:
+		if tp_delta is not None:
+			reward += adjuster.adj_rate * (1.0 if action == 1 else -1.0) * tp_delta
+	return reward
+
+
+if __name__ == "__main__":
+	if args.data is None:
+		tmpdir, args.data = synthetic_data.write_temporary(args.records, seed=args.seed)
+	random.seed(args.seed)
+	env = trade_environment.TradeEnvironment(args.data)
+	suggester = action_suggester.TpActionSuggester(env, spread_adj=args.spread_adj)
+	adjusters = [
+	    action_suggester.TpRewardAdjuster(suggester, adj_rate=0.01, loss_cut_check=lc, securing_profit_check=sp)
+	    for lc in (False, True) for sp in (False, True)
+	]
+
+	mismatch = 0
+	checks = 0
+	t_original = 0.0
+	t_table = 0.0
+	t_batch = 0.0
+	steps = 0
+	for _ in range(args.episodes):
+		env.reset()
+		suggester.start_episode()
+		terminal = False
+		states = []
+		expected_all = []
+		while not terminal:
+			# 全アクション分の提示と報酬調整を従来の処理と表引きで比較、時間は１ステップで行う分(提示１回と調整１回)を計測
+			t = time.perf_counter()
+			expected_action = get_suggested_action_original(suggester)
+			expected = [[adjust_reward_original(adj, a) for a in range(trade_environment.action_num)] for adj in adjusters]
+			t_original += (time.perf_counter() - t) / (1 + len(adjusters) * trade_environment.action_num)
+			t = time.perf_counter()
+			actual_action = suggester.get_suggested_action()
+			actual = [[adj.adjust_reward(a) for a in range(trade_environment.action_num)] for adj in adjusters]
+			t_table += (time.perf_counter() - t) / (1 + len(adjusters) * trade_environment.action_num)
+
+			mismatch += expected_action != actual_action
+			mismatch += sum(e != a for es, as_ in zip(expected, actual) for e, a in zip(es, as_))
+			checks += 1 + len(adjusters) * trade_environment.action_num
+			steps += 1
+			states.append((env.index_in_episode, env.position_type, env.calc_positional_reward()))
+			expected_all.append(expected)
+
+			action = random.choice([expected_action] * 3 + list(range(trade_environment.action_num)))
+			_, _, terminal, _ = env.step(action, action)
+
+		# エピソード全ステップの全アクション分をまとめて取得
+		indices, position_types, positional_rewards = (np.array(a) for a in zip(*states))
+		t = time.perf_counter()
+		batch = [adj.adjust_rewards(indices, position_types, positional_rewards) for adj in adjusters]
+		t_batch += (time.perf_counter() - t) / (len(adjusters) * trade_environment.action_num)
+		expected_all = np.array(expected_all).transpose(1, 0, 2)
+		mismatch += np.count_nonzero(expected_all != np.array(batch))
+		checks += expected_all.size
+
+	print(f'mismatches: {mismatch} / {checks}')
+	print(f'original: {t_original / steps * 1e6:8.2f} us/call table: {t_table / steps * 1e6:8.2f} us/call '
+	      f'speedup: {t_original / t_table:6.1f}x batch over episode: {t_batch / steps * 1e6:8.2f} us/call speedup: {t_original / t_batch:6.1f}x')
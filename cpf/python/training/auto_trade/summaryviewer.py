@@ -0,0 +1,62 @@
+import sys
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+import parameters
+import tables
+import rollup
+
+params = parameters.load()
+dbp = params['db']
+conn = rollup.connect(dbp['connection_string'])
+conn.autocommit = True
+cur = conn.cursor()
+
+# actor_data の全行ではなくロールアップテーブルから描画する、まだ集計されていない分はその場で集計する
+if __name__ == "__main__":
+	if sys.argv[1] == 'latest':
+		df = pd.read_sql(f'SELECT max(param_set_id) FROM param_set', conn)
+		param_set_id = int(df['max'][0])
+	else:
+		param_set_id = int(sys.argv[1])
+
+	min_actor_id = int(sys.argv[2]) if 2 < len(sys.argv) else 0
+	max_actor_id = int(sys.argv[3]) if 3 < len(sys.argv) else 7
+
+	ps = pd.read_sql(f'SELECT * FROM param_set WHERE param_set_id={param_set_id}', conn)
+	title = f"{ps['state_dict_prefix'][0]} {ps['model'][0]} hidden_size: {ps['hidden_size'][0]} {ps['action_suggester'][0]} {ps['reward_adjuster'][0]} {ps['policy'][0]}"
+
+	bucket_size = dbp['rollup_train_bucket_size']
+	train_rows = rollup.read_summary(cur, tables.ActorTrainSummary(), param_set_id, bucket_size)
+	episode_rows = rollup.read_summary(cur, tables.ActorEpisodeSummary(), param_set_id, bucket_size)
+
+	plt.style.use('seaborn-whitegrid')
+
+	fig = plt.figure()
+	fig.suptitle(title, fontsize=12)
+	ax_action = fig.add_subplot(4, 1, 1)
+	ax_action.set_title('Reward Q action')
+	ax_q_action = fig.add_subplot(4, 1, 2)
+	ax_q_action.set_title('Reward random action')
+	ax_sum = fig.add_subplot(4, 1, 3)
+	ax_sum.set_title('Reward sum')
+	ax_episode = fig.add_subplot(4, 1, 4)
+	ax_episode.set_title('Episode reward')
+
+	for i in range(min_actor_id, max_actor_id + 1):
+		r = train_rows[train_rows['actor_id'] == i]
+		if len(r) != 0:
+			q_reward = np.cumsum(r['q_reward_sum'])
+			random_reward = np.cumsum(r['reward_sum'] - r['q_reward_sum'])
+			ax_action.set_title(f'Reward Q action : sum={q_reward[-1]}')
+			ax_q_action.set_title(f'Reward random action : sum={random_reward[-1]}')
+			pd.DataFrame({'train_num': r['train_bucket'], 'reward': q_reward}).plot(x='train_num', ax=ax_action)
+			pd.DataFrame({'train_num': r['train_bucket'], 'reward': random_reward}).plot(x='train_num', ax=ax_q_action)
+			pd.DataFrame({'train_num': r['train_bucket'], 'sum_reward': r['last_sum_reward']}).plot(x='train_num', ax=ax_sum)
+
+		e = episode_rows[episode_rows['actor_id'] == i]
+		if len(e) != 0:
+			pd.DataFrame({'ep_count': e['ep_count'], 'reward': e['reward_sum']}).plot(x='ep_count', ax=ax_episode)
+
+	plt.show()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+import numpy as np
+
+import trade_environment
+
+# 既定のレジーム、(１足あたりの対数価格のドリフト, １足あたりの対数価格の標準偏差)
+default_regimes = (
+    (0.0, 1.0e-4), # レンジ
+    (2.0e-5, 1.5e-4), # 上昇トレンド
+    (-2.0e-5, 1.5e-4), # 下降トレンド
+    (0.0, 4.0e-4), # 高ボラティリティ
+)
+
+
+class Generator:
+	"""read_records と同じ形式の足データを、レジームが切り替わるランダムウォークで生成する.
+
+	各足の対数価格の変化は現在のレジームのドリフトと標準偏差による正規乱数で、レジームは平均 regime_length 足で
+	別のレジームへ切り替わる.
+	数十GBのデータでも価格が int32 に収まる様に、対数価格は min_value と max_value の間で反射させる.
+	session_records 足毎に gap_seconds 秒の空白時間を挟むので、get_separation_indices はそこでエピソードを区切る.
+	チャンク毎にシードとチャンク番号から作る乱数列を使い、価格とレジームの状態はチャンク間で引き継ぐ.
+	同じ引数なら同じデータになる.
+
+	Args:
+		seed: 乱数シード.
+		regimes: (ドリフト, 標準偏差) のリスト.
+		regime_length: レジームが続く平均足数.
+		start_value: 最初の始値、固定小数点の整数値.
+		min_value: 終値の下限.
+		max_value: 終値の上限、高値も int32 に収まる範囲にする.
+		start_time: 最初の足の UNIX 時間.
+		bar_seconds: 足の間隔秒数.
+		session_records: 空白時間を挟まずに続く足数.
+		gap_seconds: セッション間の空白時間の秒数.
+		chunk_records: １度に生成する足数.
+	"""
+
+	def __init__(self,
+	             seed=0,
+	             regimes=default_regimes,
+	             regime_length=240,
+	             start_value=100000,
+	             min_value=1000,
+	             max_value=100000000,
+	             start_time=1500000000,
+	             bar_seconds=60,
+	             session_records=1440,
+	             gap_seconds=8 * 60 * 60,
+	             chunk_records=1 << 22):
+		separation_interval = 60 * 60 # get_separation_indices の区切りの間隔
+		if separation_interval < bar_seconds:
+			raise ValueError(f'bar_seconds must be {separation_interval} or less to keep sessions together')
+		if bar_seconds + gap_seconds <= separation_interval:
+			raise ValueError(f'bar_seconds + gap_seconds must be more than {separation_interval} to separate sessions')
+		if not 0 < min_value < max_value:
+			raise ValueError('min_value and max_value must satisfy 0 < min_value < max_value')
+		if not min_value <= start_value <= max_value:
+			raise ValueError('start_value must be between min_value and max_value')
+		if np.iinfo(np.int32).max < max_value * (1.0 + max(r[1] for r in regimes)):
+			raise ValueError('max_value is too large to keep high values in int32')
+
+		self.seed = seed
+		self.drifts = np.array([r[0] for r in regimes], np.float32)
+		self.vols = np.array([r[1] for r in regimes], np.float32)
+		self.regime_length = regime_length
+		self.log_min = float(np.log(min_value))
+		self.log_max = float(np.log(max_value))
+		self.start_time = start_time
+		self.bar_seconds = bar_seconds
+		self.session_records = session_records
+		self.gap_seconds = gap_seconds
+		self.chunk_records = chunk_records
+
+		self.index = 0 # 次に生成する足の通し番号
+		self.chunk_index = 0
+		self.log_value = float(np.log(start_value)) # 前の足の終値の丸めと反射の前の対数
+		self.last_close = start_value # 前の足の終値、次の足の始値になる
+		self.regime = 0 # 現在のレジーム
+		self.regime_left = 0 # 現在のレジームが続く残り足数
+
+	def make_regimes(self, rng, n):
+		"""n 足分の足毎のレジーム番号を生成する."""
+		regime_num = len(self.drifts)
+		head = min(self.regime_left, n)
+		runs = [np.full(head, self.regime, np.int8)]
+		left = n - head
+		if 0 < left:
+			# 続く足数は幾何分布、次のレジームは現在以外から一様に選ぶ
+			count = left // self.regime_length + 16
+			while True:
+				lengths = rng.geometric(1.0 / self.regime_length, count)
+				if left <= lengths.sum():
+					break
+				count *= 2
+			lengths = lengths[:np.searchsorted(np.cumsum(lengths), left) + 1]
+			if 1 < regime_num:
+				steps = rng.integers(1, regime_num, len(lengths))
+				regimes = (self.regime + np.cumsum(steps)) % regime_num
+			else:
+				regimes = np.zeros(len(lengths), np.int64)
+			runs.append(np.repeat(regimes.astype(np.int8), lengths)[:left])
+			self.regime = int(regimes[-1])
+			self.regime_left = int(lengths.sum()) - left
+		else:
+			self.regime_left -= head
+		return np.concatenate(runs)
+
+	def generate(self, n):
+		"""続く n 足を生成する.
+
+		Returns:
+			trade_environment.record_dtype の構造化配列.
+		"""
+		rng = np.random.default_rng([self.seed, self.chunk_index])
+		self.chunk_index += 1
+
+		# 乱数は float32 で生成し、誤差が溜まらないよう対数価格の累積以降は float64 で行う
+		regimes = self.make_regimes(rng, n)
+		vols = self.vols.take(regimes)
+		returns = rng.standard_normal(n, np.float32)
+		returns *= vols
+		returns += self.drifts.take(regimes)
+		log_close = np.cumsum(returns, dtype=np.float64)
+		log_close += self.log_value
+		self.log_value = float(log_close[-1])
+
+		# 反射させずに続けた値を状態とし、[log_min, log_max] へ折り返すことで反射壁のあるランダムウォークにする
+		span = self.log_max - self.log_min
+		log_close -= self.log_min
+		np.mod(log_close, 2.0 * span, out=log_close)
+		log_close -= span
+		np.abs(log_close, out=log_close)
+		np.subtract(self.log_max, log_close, out=log_close)
+
+		records = np.empty(n, trade_environment.record_dtype)
+		close = np.rint(np.exp(log_close, out=log_close), out=log_close).astype(np.int32)
+		records['close'] = close
+
+		# 始値は前の足の終値
+		opens = records['open']
+		opens[0] = self.last_close
+		opens[1:] = close[:-1]
+		self.last_close = int(close[-1])
+
+		# 高値と安値は始値と終値の外側に、標準偏差に比例する一様乱数の幅を足す
+		widths = rng.random((2, n), np.float32)
+		widths *= vols
+		for field, width, func, sign in (('high', widths[0], np.maximum, 1), ('low', widths[1], np.minimum, -1)):
+			edge = func(opens, close).astype(np.float64)
+			width = np.rint(width * edge)
+			width *= sign
+			width += edge
+			records[field] = width
+
+		i = np.arange(self.index, self.index + n, dtype=np.int64)
+		records['time'] = self.start_time + i * self.bar_seconds + i // self.session_records * self.gap_seconds
+		self.index += n
+		return records
+
+	def chunks(self, num):
+		"""num 足を chunk_records 足毎に生成する."""
+		end = self.index + num
+		while self.index < end:
+			yield self.generate(min(self.chunk_records, end - self.index))
+
+	def get_separation_indices(self, num):
+		"""num 足のデータに対して get_separation_indices が返すのと同じインデックス."""
+		return np.arange(self.session_records, num, self.session_records, dtype=np.intp)
+
+
+def write(binary_filepath, num, write_index=True, **kwargs):
+	"""num 足のデータを生成してバイナリファイルに書き込む.
+
+	Args:
+		binary_filepath: 書き込むファイルパス.
+		num: 足数.
+		write_index: True ならエピソード区切りインデックスのキャッシュも書き込み、読み込み時の計算を省く.
+		kwargs: Generator の引数.
+
+	Returns:
+		書き込んだ足数.
+	"""
+	generator = Generator(**kwargs)
+	with open(binary_filepath, 'wb') as f:
+		for records in generator.chunks(num):
+			records.tofile(f)
+	if write_index:
+		trade_environment.save_separation_indices(binary_filepath, generator.get_separation_indices(num))
+	return num
+
+
+def write_temporary(num, **kwargs):
+	"""num 足のデータを一時ディレクトリに生成する、ベンチマークで履歴ファイルが指定されなかった時用.
+
+	Returns:
+		(tempfile.TemporaryDirectory, ファイルパス)、ディレクトリは cleanup() かプロセス終了時に削除される.
+	"""
+	tmpdir = tempfile.TemporaryDirectory()
+	binary_filepath = os.path.join(tmpdir.name, 'synthetic.dat')
+	write(binary_filepath, num, **kwargs)
+	return tmpdir, binary_filepath
+
+
+def parse_size(s):
+	"""'100M' や '10G' の様な 1024 単位の接尾辞付きバイト数を整数にする."""
+	units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+	s = s.strip().upper().rstrip('B')
+	if s and s[-1] in units:
+		return int(float(s[:-1]) * units[s[-1]])
+	return int(s)
+
+
+if __name__ == "__main__":
+	arg_parser = ArgumentParser(prog="synthetic_data.py")
+	arg_parser.add_argument("output", type=str, help="Binary history file to write")
+	arg_parser.add_argument("--size", default="100M", type=str, help="File size such as 500M or 10G, ignored if --records is given")
+	arg_parser.add_argument("--records", default=None, type=int, help="Number of records")
+	arg_parser.add_argument("--seed", default=0, type=int, help="Random seed")
+	arg_parser.add_argument("--regime-length", default=240, type=int, help="Mean number of records a regime lasts")
+	arg_parser.add_argument("--start-value", default=100000, type=int, help="First open value in fixed point")
+	arg_parser.add_argument("--min-value", default=1000, type=int, help="Lower bound of close values")
+	arg_parser.add_argument("--max-value", default=100000000, type=int, help="Upper bound of close values")
+	arg_parser.add_argument("--bar-seconds", default=60, type=int, help="Seconds between records in a session")
+	arg_parser.add_argument("--session-records", default=1440, type=int, help="Number of records in a session")
+	arg_parser.add_argument("--gap-seconds", default=8 * 60 * 60, type=int, help="Seconds between sessions")
+	arg_parser.add_argument("--chunk-records", default=1 << 22, type=int, help="Number of records generated at once")
+	arg_parser.add_argument("--no-index", action="store_true", help="Do not write the episode index cache")
+	args = arg_parser.parse_args()
+
+	num = args.records if args.records is not None else parse_size(args.size) // trade_environment.record_dtype.itemsize
+	t = time.perf_counter()
+	write(args.output,
+	      num,
+	      write_index=not args.no_index,
+	      seed=args.seed,
+	      regime_length=args.regime_length,
+	      start_value=args.start_value,
+	      min_value=args.min_value,
+	      max_value=args.max_value,
+	      bar_seconds=args.bar_seconds,
+	      session_records=args.session_records,
+	      gap_seconds=args.gap_seconds,
+	      chunk_records=args.chunk_records)
+	elapsed = time.perf_counter() - t
+	nbytes = num * trade_environment.record_dtype.itemsize
+	print(f'{args.output}: {num} records {nbytes / (1 << 20):.1f} MiB {num // args.session_records + 1} sessions '
+	      f'{elapsed:.2f} s {nbytes / (1 << 20) / elapsed:.0f} MiB/s')
@@ -49,11 +49,10 @@ class ActorData(db.Tbl):
 		self.position_index_in_episode = db.int32
 		self.sum_reward = db.float32
 
-		self.idx([self.param_set_id])
-		self.idx([self.actor_id])
-		self.idx([self.timestamp])
-		self.idx([self.train_num])
-		self.idx([self.ep_count])
+		self.partition_by([self.param_set_id])
+		self.idx([self.actor_id, self.ep_count])
+		self.idx([self.train_num], 'brin')
+		self.idx([self.timestamp], 'brin')
 
 
 class LearnerData(db.Tbl):
@@ -72,10 +71,43 @@ class LearnerData(db.Tbl):
 		self.target_sync_num = db.int32
 		self.send_param_num = db.int32
 
-		self.idx([self.param_set_id])
-		self.idx([self.train_num])
-		self.idx([self.timestamp])
-		self.idx([self.param_set_id, self.timestamp])
+		self.partition_by([self.param_set_id])
+		self.idx([self.train_num], 'brin')
+		self.idx([self.timestamp], 'brin')
+
+
+class LearnerSummary(db.Tbl):
+
+	def __init__(self, alias=None):
+		super().__init__('learner_summary', alias)
+		self.param_set_id = db.int16
+		self.timestamp = db.timestamp
+		self.train_num = db.int32
+		self.step_num = db.int32
+		self.step_count = db.int32
+		self.steps_per_sec = db.float32
+		self.loss_mean = db.float32
+		self.loss_var = db.float32
+		self.loss_min = db.float32
+		self.loss_max = db.float32
+		self.q_mean = db.float32
+		self.q_var = db.float32
+		self.q_min = db.float32
+		self.q_max = db.float32
+		self.q_hist = db.array_int32
+		self.before_priority_quantiles = db.array_float32
+		self.after_priority_quantiles = db.array_float32
+		self.sample_indices = db.array_int32
+		self.sample_before_priorities = db.array_float32
+		self.sample_after_priorities = db.array_float32
+		self.target_sync_num = db.int32
+		self.send_param_num = db.int32
+		self.insert_num = db.int32 # 集計期間中にリプレイメモリへ追加された遷移数
+		self.inserts_per_sec = db.float32
+		self.replay_ratio = db.float32 # 集計期間中の遷移１つあたりの学習回数、遷移の追加が無ければ NULL
+
+		self.partition_by([self.param_set_id])
+		self.idx([self.train_num], 'brin')
 
 
 class RewardAdjData(db.Tbl):
@@ -88,7 +120,60 @@ class RewardAdjData(db.Tbl):
 		self.index_in_episode = db.int32
 		self.reward_adj = db.float32
 
-		self.idx([self.param_set_id])
-		self.idx([self.actor_id])
-		self.idx([self.ep_count])
-		self.idx([self.index_in_episode])
+		self.partition_by([self.param_set_id])
+		self.idx([self.actor_id, self.ep_count, self.index_in_episode])
+
+
+class ActorEpisodeSummary(db.Tbl):
+
+	def __init__(self, alias=None):
+		super().__init__('actor_episode_summary', alias)
+		self.param_set_id = db.int16
+		self.actor_id = db.int16
+		self.ep_count = db.int32
+		self.first_train_num = db.int32
+		self.last_train_num = db.int32
+		self.first_timestamp = db.timestamp
+		self.last_timestamp = db.timestamp
+		self.row_count = db.int32
+		self.q_count = db.int32
+		self.reward_sum = db.float64
+		self.q_reward_sum = db.float64
+		self.last_sum_reward = db.float32
+		self.action_counts = db.array_int32
+
+		self.pk([self.param_set_id, self.actor_id, self.ep_count])
+		self.partition_by([self.param_set_id])
+
+
+class ActorTrainSummary(db.Tbl):
+
+	def __init__(self, alias=None):
+		super().__init__('actor_train_summary', alias)
+		self.param_set_id = db.int16
+		self.actor_id = db.int16
+		self.train_bucket = db.int32
+		self.first_timestamp = db.timestamp
+		self.last_timestamp = db.timestamp
+		self.row_count = db.int32
+		self.q_count = db.int32
+		self.reward_sum = db.float64
+		self.q_reward_sum = db.float64
+		self.last_sum_reward = db.float32
+		self.action_counts = db.array_int32
+
+		self.pk([self.param_set_id, self.actor_id, self.train_bucket])
+		self.partition_by([self.param_set_id])
+
+
+class RollupState(db.Tbl):
+
+	def __init__(self, alias=None):
+		super().__init__('rollup_state', alias)
+		self.param_set_id = db.int16
+		self.train_bucket_size = db.int32
+		self.rolled_train_num = db.int32
+		self.compacted_train_num = db.int32
+		self.timestamp = db.timestamp
+
+		self.pk([self.param_set_id])
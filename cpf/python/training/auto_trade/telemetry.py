@@ -0,0 +1,153 @@
+import time
+import datetime
+import numpy as np
+import torch
+
+import tables
+
+quantile_levels = np.array([0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0]) # 優先度の分位点の位置、learner_summary の *_priority_quantiles の並び
+
+
+def quantiles(values, levels):
+	"""np.quantile の linear と同じ分位点を、ソートとインデックス参照で求める."""
+	s = np.sort(values)
+	pos = levels * (len(s) - 1)
+	lo = np.floor(pos).astype(np.int64)
+	hi = np.minimum(lo + 1, len(s) - 1)
+	return s[lo] + (s[hi] - s[lo]) * (pos - lo)
+
+
+def histogram(values, bins, min, max):
+	"""min から max を等間隔に分けたビン毎の個数、np.histogram より速い."""
+	if max <= min:
+		counts = np.zeros(bins, np.int64)
+		counts[bins // 2] = len(values)
+		return counts
+	i = ((values - min) * (bins / (max - min))).astype(np.int64)
+	return np.bincount(np.minimum(i, bins - 1), minlength=bins)
+
+
+class LearnerTelemetry:
+	"""Learner の各ステップの統計値を溜め、summary_steps ステップ毎に learner_summary へ１行登録する.
+
+	ステップ毎には確保済みのバッファへコピーするだけで、デバイスとの同期やリストへの変換はしない.
+	GPU 上の値は GPU 上のバッファに溜めて集計時に１回だけ CPU へ転送し、CPU 上の値は numpy のバッファへ直接コピーする.
+	集計時には loss の平均と分散、Q 値のヒストグラム、優先度の分位点と、ウィンドウ内の遷移から一様に選んだサンプルを求める.
+	ウィンドウ内にリプレイメモリへ追加された遷移数と、遷移１つあたりの学習回数も記録する.
+
+	Args:
+		writer: learner_summary の行を登録する db.CopyWriter など write(record) を持つもの.
+		param_set_id: パラメータセットID.
+		summary_steps: １行に集計するステップ数.
+		histogram_bins: Q 値のヒストグラムのビン数.
+		sample_size: １行に残す遷移サンプル数.
+		seed: サンプル選択用の乱数シード.
+	"""
+
+	def __init__(self, writer, param_set_id, summary_steps, histogram_bins=32, sample_size=32, seed=None):
+		self.writer = writer
+		self.param_set_id = param_set_id
+		self.summary_steps = summary_steps
+		self.histogram_bins = histogram_bins
+		self.sample_size = sample_size
+		self.rng = np.random.default_rng(seed)
+		self.record_type = tables.LearnerSummary().get_record_type()
+		self.count = 0 # 現在のウィンドウに溜まっているステップ数
+		self.on_device = False # loss と Q 値を CPU 以外のデバイス上に溜めるかどうか
+		self.losses = None # (summary_steps,) loss
+		self.qs = None # (summary_steps, バッチサイズ, 行動数) Q 値
+		self.before_priorities = None # (summary_steps, バッチサイズ) 更新前の優先度
+		self.after_priorities = None # (summary_steps, バッチサイズ) 更新後の優先度
+		self.indices = None # (summary_steps, バッチサイズ) リプレイメモリ内インデックス
+		self.window_start_time = time.perf_counter()
+		self.window_start_inserted_num = 0 # 現在のウィンドウ開始時点のリプレイメモリへの通算追加遷移数
+
+	def start(self, inserted_num=0):
+		"""学習開始時に呼び出し、リプレイメモリが溜まるまでの時間と遷移数を最初のウィンドウに含めないようにする."""
+		self.window_start_time = time.perf_counter()
+		self.window_start_inserted_num = inserted_num
+
+	def allocate(self, q, indices):
+		n = self.summary_steps
+		self.on_device = q.device.type != 'cpu'
+		if self.on_device:
+			self.losses = torch.empty(n, dtype=torch.float32, device=q.device)
+			self.qs = torch.empty((n,) + tuple(q.shape), dtype=torch.float32, device=q.device)
+		else:
+			self.losses = np.empty(n, np.float32)
+			self.qs = np.empty((n,) + tuple(q.shape), np.float32)
+		self.before_priorities = np.empty((n, len(indices)), np.float32)
+		self.after_priorities = np.empty((n, len(indices)), np.float32)
+		self.indices = np.empty((n, len(indices)), np.int64)
+
+	def add(self, train_num, step_num, loss, q, before_priorities, after_priorities, indices, target_sync_num,
+	        send_param_num, inserted_num=0):
+		"""１ステップ分の値を溜める、summary_steps に達したら集計して登録する.
+
+		Args:
+			train_num: 通算学習回数.
+			step_num: 今回の学習開始からのステップ数.
+			loss: loss の tensor.
+			q: (バッチサイズ, 行動数) の Q 値の tensor.
+			before_priorities: 更新前の優先度.
+			after_priorities: 更新後の優先度.
+			indices: サンプルしたリプレイメモリ内インデックス.
+			target_sync_num: ターゲットネットワーク同期回数.
+			send_param_num: Actor へのパラメータ送信回数.
+			inserted_num: リプレイメモリへの通算追加遷移数.
+		"""
+		if self.losses is None:
+			self.allocate(q, indices)
+		i = self.count
+		if self.on_device:
+			with torch.no_grad():
+				self.losses[i] = loss.detach()
+				self.qs[i] = q.detach()
+		else:
+			self.losses[i] = loss.item()
+			self.qs[i] = q.detach().numpy()
+		self.before_priorities[i] = before_priorities
+		self.after_priorities[i] = after_priorities
+		self.indices[i] = indices
+		self.count = i + 1
+		if self.summary_steps <= self.count:
+			self.flush(train_num, step_num, target_sync_num, send_param_num, inserted_num)
+
+	def flush(self, train_num, step_num, target_sync_num, send_param_num, inserted_num=0):
+		"""溜まっている分を集計して１行登録し、ウィンドウを空にする."""
+		n = self.count
+		if n == 0:
+			return
+		now = time.perf_counter()
+		elapsed = max(now - self.window_start_time, 1e-9)
+		steps_per_sec = n / elapsed
+		self.window_start_time = now
+		self.count = 0
+
+		insert_num = inserted_num - self.window_start_inserted_num
+		self.window_start_inserted_num = inserted_num
+		replay_ratio = n / insert_num if 0 < insert_num else None # 追加が無かった期間は NULL にする
+
+		losses = self.losses[:n]
+		qs = self.qs[:n]
+		if self.on_device:
+			losses = losses.cpu().numpy()
+			qs = qs.cpu().numpy()
+		losses = losses.astype(np.float64)
+		qs = qs.reshape(-1)
+		q_min = float(qs.min())
+		q_max = float(qs.max())
+		q_hist = histogram(qs, self.histogram_bins, q_min, q_max)
+
+		before_priorities = self.before_priorities[:n].reshape(-1)
+		after_priorities = self.after_priorities[:n].reshape(-1)
+		sample = self.rng.choice(len(after_priorities), min(self.sample_size, len(after_priorities)), replace=False)
+		sample.sort()
+
+		self.writer.write(
+		    self.record_type(self.param_set_id, datetime.datetime.now(), train_num, step_num, n, steps_per_sec,
+		                     losses.mean(), losses.var(), losses.min(), losses.max(), qs.mean(), qs.var(), q_min, q_max,
+		                     q_hist.astype(np.int32), quantiles(before_priorities, quantile_levels).astype(np.float32),
+		                     quantiles(after_priorities, quantile_levels).astype(np.float32),
+		                     self.indices[:n].reshape(-1)[sample], before_priorities[sample], after_priorities[sample],
+		                     target_sync_num, send_param_num, insert_num, insert_num / elapsed, replay_ratio))
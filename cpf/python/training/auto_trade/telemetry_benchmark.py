@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import time
+import datetime
+from argparse import ArgumentParser
+import numpy as np
+import torch
+
+import db
+import tables
+from telemetry import LearnerTelemetry
+
+arg_parser = ArgumentParser(prog="telemetry_benchmark.py")
+arg_parser.add_argument("--steps", default=20000, type=int, help="Number of learner steps")
+arg_parser.add_argument("--batch-size", default=32, type=int, help="Replay sample size")
+arg_parser.add_argument("--action-dim", default=3, type=int, help="Number of actions")
+arg_parser.add_argument("--summary-steps", default=100, type=int, help="Steps aggregated into a summary row")
+arg_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str, help="Torch device")
+args = arg_parser.parse_args()
+
+
+class ListWriter:
+	"""CopyWriter.write と同じくレコードを溜めるだけの writer、呼び出し側の負荷のみ計測するため."""
+
+	def __init__(self):
+		self.records = []
+		self.write = self.records.append
+
+
+def binary_size(tbl, records):
+	"""レコード群の COPY バイナリ形式でのバイト数."""
+	encoders = [db.get_binary_encoder(c.type) for c in tbl.get_cols()]
+	return sum([2 + sum([len(e(v)) for e, v in zip(encoders, r)]) for r in records])
+
+
+def make_steps(num):
+	"""Learner の１ステップ分に相当する値の組を num 種類作成する."""
+	rng = np.random.default_rng(0)
+	steps = []
+	for _ in range(num):
+		steps.append((torch.rand((), device=args.device), torch.randn((args.batch_size, args.action_dim), device=args.device),
+		              rng.random(args.batch_size, np.float32), rng.random(args.batch_size, np.float32),
+		              rng.integers(0, 100000, args.batch_size)))
+	return steps
+
+
+if __name__ == "__main__":
+	steps = make_steps(64)
+
+	# 従来のステップ毎の learner_data 登録
+	raw_tbl = tables.LearnerData()
+	record_type = raw_tbl.get_record_type()
+	raw_writer = ListWriter()
+	now = datetime.datetime.now
+	start = time.perf_counter()
+	for i in range(args.steps):
+		loss, q, before_priorities, after_priorities, indices = steps[i % len(steps)]
+		raw_writer.write(
+		    record_type(1, now(), i, i, loss.item(), q[0].tolist(), before_priorities.tolist(), after_priorities.tolist(),
+		                indices.tolist(), 0, 0))
+	t_raw = (time.perf_counter() - start) / args.steps
+	raw_rows = len(raw_writer.records)
+	raw_bytes = binary_size(raw_tbl, raw_writer.records)
+	print(f'learner_data per step: {t_raw * 1e6:8.2f} us/step {raw_rows:8} rows {raw_bytes:10} bytes')
+
+	# 集計して learner_summary へ登録
+	summary_tbl = tables.LearnerSummary()
+	summary_writer = ListWriter()
+	telemetry = LearnerTelemetry(summary_writer, 1, args.summary_steps, seed=0)
+	start = time.perf_counter()
+	for i in range(args.steps):
+		loss, q, before_priorities, after_priorities, indices = steps[i % len(steps)]
+		telemetry.add(i, i, loss, q, before_priorities, after_priorities, indices, 0, 0)
+	telemetry.flush(args.steps, args.steps, 0, 0)
+	t_summary = (time.perf_counter() - start) / args.steps
+	summary_rows = len(summary_writer.records)
+	summary_bytes = binary_size(summary_tbl, summary_writer.records)
+	print(f'learner_summary:       {t_summary * 1e6:8.2f} us/step {summary_rows:8} rows {summary_bytes:10} bytes')
+	print(f'step overhead: {t_raw / t_summary:6.1f}x smaller rows: {raw_rows / summary_rows:6.1f}x fewer '
+	      f'bytes: {raw_bytes / summary_bytes:6.1f}x fewer')
@@ -1,47 +1,109 @@
+import os
 import typing
 import random
+import multiprocessing as mp
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 import pandas as pd
 import matplotlib.pyplot as plt
-import cv2
+
+from chart_renderer import ChartRenderer
 
 action_num = 4
 overlay_num = 1
 
-ma_kernel_sizes = np.array([5, 15, 31, 61], np.int64)
-ma_kernel_size_halfs = ma_kernel_sizes // 2
-ma_kernels = [np.ones(size) / size for size in ma_kernel_sizes]
-
 chance_ma_kernel_size = 15
 chance_ma_kernel_size_halfs = chance_ma_kernel_size // 2
 chance_ma_kernel = np.ones(chance_ma_kernel_size) / chance_ma_kernel_size
 
+record_dtype = np.dtype([('time', 'u8'), ('open', 'i4'), ('high', 'i4'), ('low', 'i4'), ('close', 'i4')]) # バイナリファイルの１レコード
+
 
-def load_from_csv(csv_filepath):
+def load_from_csv(csv_filepath, chunksize=None):
+	"""CSV を読み込む、chunksize を指定したら指定行数毎の DataFrame のイテレータを返す."""
 	dtypes_csv = [('time', 'str'), ('open', 'f4'), ('high', 'f4'), ('low', 'f4'), ('close', 'f4'), ('volume', 'i4')]
-	df = pd.read_csv(csv_filepath, names=('time', 'open', 'high', 'low', 'close', 'volume'), parse_dates=[0], dtype=dtypes_csv)
+	df = pd.read_csv(csv_filepath,
+	                 names=('time', 'open', 'high', 'low', 'close', 'volume'),
+	                 parse_dates=[0],
+	                 dtype=dtypes_csv,
+	                 chunksize=chunksize)
 	return df
 
 
-def csv_to_binary(csv_filepath, binary_filepath):
-	df = load_from_csv(csv_filepath)
-	df['time'] = df['time'].values.astype('u8') // 1000000000
-	df['open'] = (df['open'] * 1000).astype('i4')
-	df['high'] = (df['high'] * 1000).astype('i4')
-	df['low'] = (df['low'] * 1000).astype('i4')
-	df['close'] = (df['close'] * 1000).astype('i4')
-	df = df.drop('volume', axis=1)
-	records = df.to_records(index=False)
-	with open(binary_filepath, 'wb') as f:
-		f.write(records.tobytes())
+def dataframe_to_records(df):
+	"""load_from_csv で読み込んだ DataFrame をバイナリファイルのレコード形式に変換する、価格は 1000 倍の固定小数点."""
+	records = np.empty((len(df),), dtype=record_dtype)
+	records['time'] = df['time'].values.astype('datetime64[s]').astype('u8')
+	for name in ('open', 'high', 'low', 'close'):
+		records[name] = (df[name].values * 1000).astype('i4')
+	return records
+
+
+def csv_to_binary(csv_filepath, binary_filepath, append=False, chunksize=1000000):
+	"""CSV を指定行数ずつ読み込みながらバイナリファイルへ変換する.
+
+	Args:
+		csv_filepath: CSV ファイルパス.
+		binary_filepath: 出力先バイナリファイルパス.
+		append: True なら既存のバイナリファイルに追記する、既存の最終レコードより新しい時刻のレコードのみ書き込む.
+		chunksize: 一度に読み込む行数.
+
+	Returns:
+		書き込んだレコード数.
+	"""
+	last_time = None
+	if append and os.path.isfile(binary_filepath) and record_dtype.itemsize <= os.path.getsize(binary_filepath):
+		last_time = int(read_records(binary_filepath)['time'][-1])
+
+	count = 0
+	with open(binary_filepath, 'ab' if append else 'wb') as f:
+		for df in load_from_csv(csv_filepath, chunksize):
+			records = dataframe_to_records(df)
+			if last_time is not None:
+				records = records[last_time < records['time']]
+			f.write(records.tobytes())
+			count += len(records)
+	return count
+
+
+def csvs_to_binary(csv_filepaths, binary_filepath, append=False, chunksize=1000000):
+	"""複数の CSV を順に１つのバイナリファイルへ変換する.
+
+	Returns:
+		書き込んだレコード数.
+	"""
+	count = 0
+	for i, csv_filepath in enumerate(csv_filepaths):
+		count += csv_to_binary(csv_filepath, binary_filepath, append or 0 < i, chunksize)
+	return count
+
+
+def csvs_to_binaries(filepath_pairs, append=False, chunksize=1000000, processes=None):
+	"""複数の CSV をプロセスプールで並列にバイナリファイルへ変換する.
+
+	出力先が同じ CSV は同じプロセスで指定順に変換して１ファイルにまとめる、日毎の CSV を銘柄毎のファイルへ追記する場合など.
+
+	Args:
+		filepath_pairs: (CSV ファイルパス, 出力先バイナリファイルパス) のリスト.
+		append: True なら既存のバイナリファイルに追記する.
+		chunksize: 一度に読み込む行数.
+		processes: プロセス数、None ならCPU数.
+
+	Returns:
+		出力先バイナリファイルパスから書き込んだレコード数への辞書.
+	"""
+	groups = {}
+	for csv_filepath, binary_filepath in filepath_pairs:
+		groups.setdefault(binary_filepath, []).append(csv_filepath)
+	with mp.Pool(processes) as pool:
+		counts = pool.starmap(csvs_to_binary, [(csv_filepaths, binary_filepath, append, chunksize)
+		                                       for binary_filepath, csv_filepaths in groups.items()])
+	return dict(zip(groups.keys(), counts))
 
 
 def read_records(binary_filepath):
-	dtypes = [('time', 'u8'), ('open', 'i4'), ('high', 'i4'), ('low', 'i4'), ('close', 'i4')]
-	with open(binary_filepath, 'rb') as f:
-		b = np.frombuffer(f.read(), dtype=dtypes)
-	return b
+	"""バイナリファイルを読み取り専用でメモリマップする、全プロセスで OS のページキャッシュを共有する."""
+	return np.memmap(binary_filepath, dtype=record_dtype, mode='r')
 
 
 def records_to_dataframe(records):
@@ -51,22 +113,63 @@ def records_to_dataframe(records):
 
 
 def records_to_time(records):
-	return records[['time']].view(('u8', 1))
+	return records['time']
 
 
 def values_view_from_records(records):
-	return records[['open', 'high', 'low', 'close']].view(('i4', 4))
+	o = records['open']
+	return as_strided(o, shape=(o.shape[0], 4), strides=(o.strides[0], o.itemsize), writeable=False)
 
 
 def get_separation_indices(records):
 	interval = 60 * 60
-	time = records[['time']].astype('u8')
+	time = records['time']
 	dif_time = np.diff(time)
 	time_areas = np.nonzero((dif_time > interval).astype('i4'))[0]
 	time_areas += 1
 	return time_areas
 
 
+def load_separation_indices(binary_filepath, records=None):
+	"""エピソード区切りインデックスをバイナリファイル横のキャッシュから読み込む.
+
+	キャッシュが無いか、バイナリファイルのサイズか更新日時が記録と異なる場合は計算して保存し直す.
+
+	Args:
+		binary_filepath: バイナリファイルパス.
+		records: 読み込み済みのレコード、None ならキャッシュ更新時に読み込む.
+
+	Returns:
+		get_separation_indices と同じインデックス.
+	"""
+	cache_filepath = binary_filepath + '.episodes.npz'
+	st = os.stat(binary_filepath)
+	try:
+		with np.load(cache_filepath) as cache:
+			if int(cache['size']) == st.st_size and int(cache['mtime_ns']) == st.st_mtime_ns:
+				return cache['indices']
+	except (OSError, KeyError, ValueError):
+		pass
+
+	if records is None:
+		records = read_records(binary_filepath)
+	indices = get_separation_indices(records)
+	save_separation_indices(binary_filepath, indices)
+	return indices
+
+
+def save_separation_indices(binary_filepath, indices):
+	"""エピソード区切りインデックスを現在のバイナリファイルのサイズと更新日時と共にキャッシュへ保存する."""
+	cache_filepath = binary_filepath + '.episodes.npz'
+	st = os.stat(binary_filepath)
+
+	# 複数プロセスが同時に作成しても壊れない様に一時ファイルから置き換える
+	tmp_filepath = f'{cache_filepath}.{os.getpid()}.tmp'
+	with open(tmp_filepath, 'wb') as f:
+		np.savez(f, size=st.st_size, mtime_ns=st.st_mtime_ns, indices=indices)
+	os.replace(tmp_filepath, cache_filepath)
+
+
 def tickdata(filepath):
 	"""binary to pandas DataFrame using numpy.
 
@@ -106,6 +209,7 @@ class TradeEnvironment:
 		self.h = height_width[0] # グラフ画像高さ(px)
 		self.h_max = self.h - 1 # グラフ画像高さ(px)-1
 		self.img = np.zeros((1, self.h, self.w), np.float32) # グラフ描画先データ、これが状態となる
+		self.renderer = ChartRenderer(height_width, window_size) # グラフ描画処理
 
 		# グラフ描画時の窓サイズ計算
 		self.window_size = window_size
@@ -113,17 +217,12 @@ class TradeEnvironment:
 		# 全データ読み込み
 		self.records = read_records(binary_filepath)
 		# 一定期間データが存在しないエリアを探し出し、その間を１エピソードとする
-		self.episodes = get_separation_indices(self.records)
+		self.episodes = load_separation_indices(binary_filepath, self.records)
 
 		# エピソードとして使える区間があるか調べる
 		if self.episodes.shape[0] < 2:
 			raise Exception('No area exists for episode in histrical data.')
-		valid_episode_exists = False
-		for i in range(self.episodes.shape[0] - 1):
-			if self.window_size * 2 <= self.episodes[i + 1] - self.episodes[i]:
-				valid_episode_exists = True
-				break
-		if not valid_episode_exists:
+		if not (self.window_size * 2 <= np.diff(self.episodes)).any():
 			raise Exception('No episode area exists lager than window size.')
 
 		# その他変数初期化
@@ -150,110 +249,9 @@ class TradeEnvironment:
 		self.index_in_episode = 0 # episode_values 内での現在値に対応するインデックス
 
 	def draw_img(self) -> None:
-		end = self.index_in_episode + 1 # エピソード内での現在の最新値インデックス+1
-		img = self.img # 描画先バッファ
-		w = self.w # 画像幅(px)
-		h = self.h # 画像高さ(px)
-		chart_x = 5 # チャート部のX左端(px)
-		chart_y = 0 # チャート部のY上端(px)
-		chart_w = w - 10 # チャート部の幅(px)
-		chart_h = h # チャート部の高さ(px)
-		chart_w_for_scale = chart_w - 1 # チャート部X座標スケーリング用のチャート幅(px)
-		chart_h_for_scale = chart_h - 1 # チャート部Y座標スケーリング用のチャート高さ(px)
-		chart_right = chart_x + chart_w # チャート右端のX左端(px)+1
-		chart_bottom = chart_y + chart_h # チャート下端のY左端(px)+1
-		h_max = self.h_max
-
-		img[:] = 0
-		position_type = self.position_type
-		position_start_value = self.position_start_value
-		positional_reward = self.calc_positional_reward() if position_start_value else 0
-
-		if positional_reward < 0:
-			ind_x1 = 0
-			ind_x2 = 5
-		elif 0 < positional_reward:
-			ind_x1 = w - 5
-			ind_x2 = w
-
-		window_size = self.window_size
-		time = self.episode_time[end - window_size:end]
-		values = self.episode_values[end - window_size:end]
-		ma = []
-
-		# 可能なら移動平均を計算
-		for ki in range(len(ma_kernel_sizes)):
-			size_needed = window_size + ma_kernel_size_halfs[ki] * 2
-			if size_needed <= end:
-				start = end - size_needed
-				ma.append(np.convolve(self.episode_values[start:end, 1], ma_kernels[ki], mode='valid'))
-				ma.append(np.convolve(self.episode_values[start:end, 2], ma_kernels[ki], mode='valid'))
-				ma.append(np.convolve(self.episode_values[start:end, 3], ma_kernels[ki], mode='valid'))
-
-		# 表示範囲となる最大最小を探す
-		time_max = time.max()
-		time_min = time_max - window_size * 60
-		values_min = values.min()
-		values_max = values.max()
-
-		for y in ma:
-			values_min = min(values_min, y.min())
-			values_max = max(values_max, y.max())
-
-		if position_type:
-			values_min = min(values_min, position_start_value)
-			values_max = max(values_max, position_start_value)
-
-		# values_min -= values_min % 100
-		# values_max += 100 - values_max % 100
-
-		time_scale = chart_w_for_scale / (time_max - time_min)
-		value_scale = -chart_h_for_scale / (values_max - values_min)
-		value_translate = chart_h_for_scale - values_min * value_scale
-
-		cur = int(np.rint(values[-1, 3] * value_scale + value_translate).item())
-		if position_type:
-			pos = int(np.rint(position_start_value * value_scale + value_translate).item())
-		else:
-			pos = 0
-
-		trg = img[0]
-		chart_trg = trg[chart_y:chart_bottom, chart_x:chart_right]
-
-		# インジケーター描画
-
-		# 目盛り描画
-		for y in np.rint(
-		    np.arange(values_min - values_min % 50, values_max + 51 - (values_max % 50), 50) * value_scale +
-		    value_translate).astype(np.int32):
-			if 0 <= y and y < chart_trg.shape[0]:
-				chart_trg[y, :] = 0.1
-
-		# ポジション持っていたら、ポジった値から現在値まで塗りつぶす
-		if position_type and positional_reward:
-			ind_y1 = max(min(pos, cur), 0)
-			ind_y2 = min(max(pos, cur), h_max) + 1
-			trg[ind_y1:ind_y2, ind_x1:ind_x2] = 1
-
-		# 現在値として水平線を描画
-		if 0 <= cur and cur < h:
-			cur_y1 = max(cur - 1, 0)
-			cur_y2 = min(cur + 1, h_max) + 1
-			trg[cur_y1:cur_y2, :] = 1.0
-
-		# チャートを描画開始
-		pts = np.empty((values.shape[0], 1, 2), dtype=np.int32)
-		pts[:, 0, 0] = np.rint((time - time_min) * time_scale)
-
-		# 可能なら移動平均線を描画
-		for y in ma:
-			pts[:, 0, 1] = np.rint(y * value_scale + value_translate)
-			cv2.polylines(chart_trg, [pts], False, 0.3)
-
-		# open, high, low, close を描画
-		for value_type in range(4):
-			pts[:, 0, 1] = np.rint(values[:, value_type] * value_scale + value_translate)
-			cv2.polylines(chart_trg, [pts], False, 0.7)
+		"""現在のエピソード内インデックスとポジションでチャートを self.img に描画する."""
+		self.renderer.render(self.img[np.newaxis], (self.index_in_episode,), (self.position_type,),
+		                     (self.position_start_value,))
 
 	def reset(self, random_episode_or_index=True) -> np.ndarray:
 		"""エピソードをリセットしエピソードの先頭初期状態に戻る.
@@ -288,6 +286,7 @@ class TradeEnvironment:
 				rcds = self.records[i1:i2]
 				self.episode_time = records_to_time(rcds)
 				self.episode_values = values_view_from_records(rcds)
+				self.renderer.set_episode(self.episode_time, self.episode_values, self.cur_episode)
 				self.index_in_episode = self.window_size
 				self.draw_img()
 				return self.img
@@ -4,9 +4,10 @@ import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import psycopg2
 
 import parameters
+import db
+import tables
 import trade_environment
 import action_suggester
 
@@ -14,13 +15,13 @@ params = parameters.load()
 dbp = params['db']
 ep = params['env']
 ap = params['actor']
-conn = psycopg2.connect(dbp['connection_string'])
+conn = db.connect(dbp['connection_string'])
 conn.autocommit = True
 cur = conn.cursor()
 
 if __name__ == "__main__":
 	if sys.argv[1] == 'latest':
-		df = pd.read_sql(f'SELECT max(param_set_id) FROM param_set', conn)
+		df = pd.read_sql(f'SELECT max(param_set_id) AS max FROM param_set', conn)
 		param_set_id = int(df['max'][0])
 	else:
 		param_set_id = int(sys.argv[1])
@@ -30,7 +31,7 @@ if __name__ == "__main__":
 	print(f'actor_id: {actor_id}')
 
 	if sys.argv[3] == 'latest':
-		df = pd.read_sql(f'SELECT max(ep_count) FROM actor_data WHERE param_set_id={param_set_id} AND actor_id={actor_id}',
+		df = pd.read_sql(f'SELECT max(ep_count) AS max FROM actor_data WHERE param_set_id={param_set_id} AND actor_id={actor_id}',
 		                 conn)
 		ep_count = int(df['max'][0])
 	else:
@@ -57,21 +58,23 @@ if __name__ == "__main__":
 	fig.suptitle(title, fontsize=12)
 	ax = fig.add_subplot(1, 1, 1)
 
-	df = pd.read_sql(
-	    f'SELECT index_in_episode, action, q_action, position_index_in_episode, position_action, position_q_action, reward FROM actor_data WHERE param_set_id={param_set_id} AND actor_id={actor_id} AND ep_count={ep_count}',
-	    conn)
+	ad = tables.ActorData()
+	df = db.select([
+	    ad.index_in_episode, ad.action, ad.q_action, ad.position_index_in_episode, ad.position_action, ad.position_q_action,
+	    ad.reward
+	]).frm(ad).where('param_set_id=%s AND actor_id=%s AND ep_count=%s').read_frame(cur, param_set_id, actor_id, ep_count)
 
 	data_cur = df['index_in_episode'].values, df['action'].values, df['q_action'].values
 	data_entry = df['position_index_in_episode'].values, df['position_action'].values, df['position_q_action'].values
 	reward = df['reward'].values
 	print(df)
 
-	df = pd.read_sql(
-	    f'SELECT index_in_episode, reward_adj FROM reward_adj_data WHERE param_set_id={param_set_id} AND actor_id={actor_id} AND ep_count={ep_count} ORDER BY index_in_episode',
-	    conn)
+	rad = tables.RewardAdjData()
+	df = db.select([rad.index_in_episode, rad.reward_adj]).frm(rad).where('param_set_id=%s AND actor_id=%s AND ep_count=%s').order_by(
+	    [rad.index_in_episode]).read_frame(cur, param_set_id, actor_id, ep_count)
 	print(df)
 
-	env = trade_environment.TradeEnvironment('test.dat', ep['window_size'], ep['frames_height_width'][1:])
+	env = trade_environment.TradeEnvironment(ep.get('data_file', 'test.dat'), ep['window_size'], ep['frames_height_width'][1:])
 	suggester = action_suggester.TpActionSuggester(env)
 
 	env.reset(episode_index)
@@ -5,8 +5,12 @@ import json
 from argparse import ArgumentParser
 import psycopg2
 
+import db
 import db_initializer
-from replay import ReplayMemory
+import rollup
+import replay
+import transport
+import viewer
 from actor import Actor
 from learner import Learner
 
@@ -20,13 +24,13 @@ arg_parser.add_argument(
 args = arg_parser.parse_args()
 
 
-def learner(params, param_set_id, status_dict, shared_state, shared_mem):
-	learner = Learner(params, param_set_id, status_dict, shared_state, shared_mem)
+def learner(params, param_set_id, control, shared_mem, flow):
+	learner = Learner(params, param_set_id, control, shared_mem, flow)
 	learner.learn()
 
 
-def actor(params, param_set_id, i, status_dict, shared_state, shared_mem):
-	actor = Actor(params, param_set_id, i, status_dict, shared_state, shared_mem)
+def actor(params, param_set_id, i, control, shared_mem, snapshots, flow):
+	actor = Actor(params, param_set_id, i, control, shared_mem, snapshots, flow)
 	actor.run()
 
 
@@ -36,30 +40,57 @@ if __name__ == "__main__":
 
 	param_set_id = db_initializer.initialize(params)
 
-	mp_manager = mp.Manager()
-	status_dict = mp_manager.dict()
-	shared_state = mp_manager.dict()
-	shared_mem = mp_manager.Queue()
+	# 終了フラグや学習回数は毎ステップ参照するので、プロセス間通信の要らない共有メモリ上に置く
+	control = transport.ControlBlock(params['actor']['num_actors'])
 
-	status_dict['quit'] = False
-	status_dict['Q_state_dict_stored'] = False
-	status_dict['request_quit'] = False
+	# Actor から Learner への遷移バッチは共有メモリ上のリングバッファで渡す
+	shared_mem = transport.SharedMemoryQueue(
+	    replay.get_batch_fields(params['replay_memory'], params['env']['frames_height_width'],
+	                            params['actor']['n_step_transition_batch_size']), params['actor']['transport_slots'])
 
-	# A learner is started before the Actors so that the shared_state is populated with a Q_state_dict
-	learner_proc = mp.Process(target=learner, args=(params, param_set_id, status_dict, shared_state, shared_mem))
+	# Actor は Learner から返されるクレジットの分だけ先行して送信する、wait_shared_memory_clear が false なら待たない
+	flow = None
+	if params['actor']['wait_shared_memory_clear']:
+		flow = transport.FlowControl(params['actor']['num_actors'], params['actor']['transport_credits'],
+		                             params['learner']['target_replay_ratio'])
+
+	# A learner is started before the Actors so that the control block is populated with the shared weights name
+	learner_proc = mp.Process(target=learner, args=(params, param_set_id, control, shared_mem, flow))
 	learner_proc.start()
-	while not status_dict['Q_state_dict_stored']:
+	while not control.Q_state_dict_stored:
 		time.sleep(0.001)
 
+	# actor_data を定期的にロールアップテーブルへ集計する、集計の SQL は PostgreSQL 用
+	rollup_proc = None
+	if 0 < params['db']['rollup_interval'] and db.get_backend(params['db']['connection_string']) is db.postgresql:
+		rollup_proc = mp.Process(target=rollup.run, args=(params, param_set_id, control))
+		rollup_proc.start()
+
+	# 表示は別プロセスで行い、Actor は共有メモリ上のスナップショットを書き込むだけにする、viewer_fps が 0 なら何も表示しない
+	snapshots = None
+	viewer_proc = None
+	if 0 < params['actor']['viewer_fps']:
+		snapshots = transport.SnapshotChannel(viewer.get_snapshot_fields(params), params['actor']['num_actors'])
+		viewer_proc = mp.Process(target=viewer.run, args=(params, control, snapshots))
+		viewer_proc.start()
+
 	#  TODO: Test with multiple actors
 	actor_procs = []
 	for i in range(params["actor"]["num_actors"]):
-		p = mp.Process(target=actor, args=(params, param_set_id, i, status_dict, shared_state, shared_mem))
+		p = mp.Process(target=actor, args=(params, param_set_id, i, control, shared_mem, snapshots, flow))
 		p.start()
 		actor_procs.append(p)
 
 	[actor_proc.join() for actor_proc in actor_procs]
 	print('actor all join')
-	status_dict['quit'] = True
+	control.quit = True
 	learner_proc.join()
+	if rollup_proc is not None:
+		rollup_proc.join()
+	if viewer_proc is not None:
+		viewer_proc.join()
+		snapshots.close()
 	print("Main: replay_mem.size:", shared_mem.qsize())
+	print(f'Main: inserted transitions: {control.inserted_num} train_num: {control.train_num} actor steps: {control.actor_steps.sum()}')
+	shared_mem.close()
+	control.close()
@@ -0,0 +1,549 @@
+import time
+import multiprocessing as mp
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+
+
+def attach_shared_memory(name):
+	"""既存の共有メモリに接続する.
+
+	子プロセスは親と同じ resource_tracker を共有するので、追跡対象への登録が重複しても作成側の unlink で解除される.
+	"""
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		return shared_memory.SharedMemory(name=name)
+
+
+class SharedMemoryQueue:
+	"""固定サイズのスロットを持つ共有メモリ上のリングバッファ、Actor から Learner へ遷移バッチを pickle せずに渡す.
+
+	１要素は (優先度, (配列, ...)) のタプルで、各配列は fields で指定された最大形状以下で先頭次元のみ可変.
+	書き込みは複数プロセスから可能だが読み出しは１プロセスのみで行う.
+	空きスロットと書き込み済みの要素の数はセマフォで数え、書き込み側も読み出し側もポーリングせずにブロックして待つ.
+
+	Args:
+		fields: (最大形状, dtype) のリスト、優先度と遷移バッチの各配列に対応する.
+		slot_num: スロット数.
+	"""
+
+	def __init__(self, fields, slot_num, lock=None, name=None, free=None, items=None):
+		self.fields = [(tuple(shape), np.dtype(dtype)) for shape, dtype in fields]
+		self.slot_num = slot_num
+		self.lock = lock if lock is not None else mp.Lock() # head/tail 更新用ロック
+		self.free = free if free is not None else mp.Semaphore(slot_num) # 空きスロット数
+		self.items = items if items is not None else mp.Semaphore(0) # 書き込み完了した未読の要素数
+		self.owner = name is None
+
+		# レイアウト計算、各領域は 64 バイト境界に揃える
+		def align(n):
+			return (n + 63) // 64 * 64
+
+		field_num = len(self.fields)
+		layout = []
+		offset = 0
+		layout.append((offset, (2,), np.int64)) # head, tail
+		offset = align(offset + 2 * 8)
+		layout.append((offset, (slot_num,), np.int8)) # 書き込み完了フラグ
+		offset = align(offset + slot_num)
+		layout.append((offset, (slot_num, field_num), np.int64)) # 各配列の先頭次元の長さ
+		offset = align(offset + slot_num * field_num * 8)
+		layout.append((offset, (slot_num,), np.int32)) # 書き込んだ Actor のID
+		offset = align(offset + slot_num * 4)
+		for shape, dtype in self.fields:
+			layout.append((offset, (slot_num,) + shape, dtype))
+			offset = align(offset + slot_num * int(np.prod(shape, dtype=np.int64)) * dtype.itemsize)
+		self.layout = layout
+		self.nbytes = offset
+
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+			self.shm.buf[:64] = bytes(64)
+		else:
+			self.shm = attach_shared_memory(name)
+		self.map_arrays()
+
+	def map_arrays(self):
+		buf = self.shm.buf
+		arrays = [np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset) for offset, shape, dtype in self.layout]
+		self.indices = arrays[0]
+		self.ready = arrays[1]
+		self.lengths = arrays[2]
+		self.senders = arrays[3]
+		self.slots = arrays[4:]
+
+	def __getstate__(self):
+		return self.fields, self.slot_num, self.lock, self.shm.name, self.free, self.items
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def qsize(self):
+		"""未読の要素数、書き込み途中のものも含む."""
+		return int(self.indices[0] - self.indices[1])
+
+	def put(self, item, block=True, timeout=None, sender=-1):
+		"""要素を書き込む.
+
+		Args:
+			item: (優先度, (配列, ...)) のタプル.
+			block: 空きスロットが無い場合に待つかどうか.
+			timeout: 待つ最大秒数、None なら無制限.
+			sender: 書き込む Actor のID、drain で読み出し側に渡される.
+
+		Returns:
+			書き込めたら True.
+		"""
+		indices = self.indices
+		slot_num = self.slot_num
+
+		# 空きスロットを確保してから予約する、確保できていれば予約は必ず成功する
+		if not self.free.acquire(block, timeout):
+			return False
+		with self.lock:
+			head = int(indices[0])
+			indices[0] = head + 1
+
+		# ロック外で予約したスロットへ直接書き込み、最後に完了フラグを立てる
+		slot = head % slot_num
+		priorities, batch = item
+		lengths = self.lengths[slot]
+		for i, v in enumerate((priorities,) + tuple(batch)):
+			n = len(v)
+			self.slots[i][slot, :n] = v
+			lengths[i] = n
+		self.senders[slot] = sender
+		self.ready[slot] = 1
+		self.items.release()
+		return True
+
+	def wait(self, timeout=None):
+		"""書き込み済みの要素が１つ以上になるまで待つ.
+
+		Returns:
+			要素があれば True、timeout 秒待っても無ければ False.
+		"""
+		if not self.items.acquire(True, timeout):
+			return False
+		self.items.release()
+		return True
+
+	def drain(self, func, max_count=None, with_sender=False):
+		"""書き込み済みの要素を古い順に共有メモリ上のビューのまま関数に渡し、スロットを解放する.
+
+		Args:
+			func: func(優先度, (配列, ...)) の形で呼び出される、引数はこの呼び出し中のみ有効.
+			max_count: 処理する最大要素数、None なら無制限.
+			with_sender: True なら func(書き込んだ Actor のID, 優先度, (配列, ...)) の形で呼び出す.
+
+		Returns:
+			処理した要素数.
+		"""
+		indices = self.indices
+		slot_num = self.slot_num
+		count = 0
+		while max_count is None or count < max_count:
+			tail = int(indices[1])
+			if tail == int(indices[0]):
+				break
+			slot = tail % slot_num
+			if not self.ready[slot]:
+				break
+			# 書き込み側は完了フラグを立てた直後に数えるので、待つとしてもごく短時間
+			self.items.acquire()
+			lengths = self.lengths[slot]
+			arrays = [a[slot, :lengths[i]] for i, a in enumerate(self.slots)]
+			if with_sender:
+				func(int(self.senders[slot]), arrays[0], tuple(arrays[1:]))
+			else:
+				func(arrays[0], tuple(arrays[1:]))
+			self.ready[slot] = 0
+			with self.lock:
+				indices[1] = tail + 1
+			self.free.release()
+			count += 1
+		return count
+
+	def get(self):
+		"""最古の要素のコピーを取得する、無ければ None."""
+		items = []
+		self.drain(lambda priorities, batch: items.append((priorities.copy(), tuple(v.copy() for v in batch))), 1)
+		return items[0] if items else None
+
+	def close(self):
+		self.slots = None
+		self.senders = None
+		self.lengths = None
+		self.ready = None
+		self.indices = None
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+def state_dicts_numel(state_dicts):
+	"""state_dict 群の全要素数を取得する."""
+	return sum(t.numel() for sd in state_dicts for t in sd.values())
+
+
+class SharedWeights:
+	"""Learner から Actor へモデルの重みを配信する共有メモリ上のフラットなバッファ.
+
+	先頭のシーケンス番号を書き込み中は奇数にするシーケンスロックで、読み出し側はロック無しで一貫した重みを得る.
+	配信した時刻も持ち、読み出し側は重みが届くまでの遅延を計れる.
+
+	Args:
+		numel: 配信する全要素数、state_dicts_numel で計算する.
+		name: 既存の共有メモリに接続する場合はその名前、None なら新規作成.
+	"""
+
+	def __init__(self, numel, name=None):
+		self.numel = numel
+		self.owner = name is None
+		nbytes = 64 + numel * 4
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+			self.shm.buf[:64] = bytes(64)
+		else:
+			self.shm = attach_shared_memory(name)
+		self.name = self.shm.name
+		self.seq = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+		self.publish_time = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=8) # time.time() での配信時刻
+		self.flat = np.ndarray((numel,), dtype=np.float32, buffer=self.shm.buf, offset=64)
+		self.read_publish_time = 0.0 # 最後に read_into で読み込んだ重みの配信時刻
+
+	def __getstate__(self):
+		return self.numel, self.name
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def version(self):
+		"""これまでに配信された回数を取得する."""
+		return int(self.seq[0]) // 2
+
+	def publish(self, state_dicts):
+		"""state_dict 群の値を書き込む、書き込み側は１プロセスのみ.
+
+		Returns:
+			配信後のバージョン.
+		"""
+		flat = torch.from_numpy(self.flat)
+		self.seq[0] += 1
+		offset = 0
+		with torch.no_grad():
+			for sd in state_dicts:
+				for t in sd.values():
+					n = t.numel()
+					flat[offset:offset + n].copy_(t.reshape(-1))
+					offset += n
+		self.publish_time[0] = time.time()
+		self.seq[0] += 1
+		return self.version()
+
+	def read_into(self, state_dicts):
+		"""state_dict 群の tensor へ直接コピーする、書き込みと重なったらやり直す.
+
+		Returns:
+			読み込んだバージョン.
+		"""
+		flat = torch.from_numpy(self.flat)
+		while True:
+			seq = int(self.seq[0])
+			if seq & 1:
+				time.sleep(0)
+				continue
+			offset = 0
+			with torch.no_grad():
+				for sd in state_dicts:
+					for t in sd.values():
+						n = t.numel()
+						t.copy_(flat[offset:offset + n].view(t.shape))
+						offset += n
+			publish_time = float(self.publish_time[0])
+			if int(self.seq[0]) == seq:
+				self.read_publish_time = publish_time
+				return seq // 2
+
+	def close(self):
+		self.seq = None
+		self.publish_time = None
+		self.flat = None
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+class FlowControl:
+	"""Actor から Learner への遷移バッチの流量を Actor 毎のクレジットで制御する.
+
+	Actor は送信前にクレジットを１つ取得し、Learner はバッチをリプレイメモリへ追加した後にクレジットを返す.
+	Actor が先行できるのはクレジット数のバッチまでで、ポーリングせずにセマフォで待つ.
+	target_replay_ratio が 0 より大きければ、Learner は遷移１つあたりの学習回数がそれに達するまでクレジットを返さず、
+	達していれば学習せずに新たな遷移を待つ.
+	どちらの状態でも一方は進めるので、Actor と Learner が互いに待ち続けることは無い.
+	クレジットと比率の管理は Learner プロセス内の状態で行い、Actor はセマフォのみ使う.
+
+	Args:
+		actor_num: Actor 数.
+		credits: Actor 毎のクレジット数.
+		target_replay_ratio: 目標とする遷移１つあたりの学習回数、0 なら比率は制御しない.
+	"""
+
+	def __init__(self, actor_num, credits, target_replay_ratio=0.0, semaphores=None):
+		self.actor_num = actor_num
+		self.credits = credits
+		self.target_replay_ratio = target_replay_ratio
+		self.semaphores = semaphores if semaphores is not None else [mp.Semaphore(credits) for _ in range(actor_num)]
+
+		# 以下は Learner プロセス内のみで使う
+		self.pending = deque() # クレジットを返していない (Actor のID, 遷移数)
+		self.inserted_num = 0 # 追加された通算遷移数
+		self.released_num = 0 # クレジットを返した通算遷移数
+		self.update_num = 0 # 通算学習回数
+		self.started = False
+		self.start_inserted_num = 0
+		self.start_update_num = 0
+
+	def __getstate__(self):
+		return self.actor_num, self.credits, self.target_replay_ratio, self.semaphores
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def acquire(self, actor_id, timeout=None):
+		"""Actor が送信前にクレジットを取得する.
+
+		Returns:
+			取得できたら True、timeout 秒待っても取得できなければ False.
+		"""
+		return self.semaphores[actor_id].acquire(True, timeout)
+
+	def start(self):
+		"""Learner の学習開始時に呼び出す、それまでに追加された遷移は比率の計算に含めない."""
+		self.started = True
+		self.start_inserted_num = self.inserted_num
+		self.start_update_num = self.update_num
+		self.release_due()
+
+	def inserted(self, actor_id, n):
+		"""Learner が actor_id からの n 遷移のバッチをリプレイメモリへ追加した."""
+		self.inserted_num += n
+		self.pending.append((actor_id, n))
+		self.release_due()
+
+	def updated(self):
+		"""Learner が１回学習した."""
+		self.update_num += 1
+		self.release_due()
+
+	def required_update_num(self, inserted_num):
+		"""inserted_num 遷移に対して目標の比率を満たす学習回数."""
+		return self.target_replay_ratio * (inserted_num - self.start_inserted_num)
+
+	def release_due(self):
+		"""目標の比率を満たしている分のクレジットを古い順に返す."""
+		pending = self.pending
+		update_num = self.update_num - self.start_update_num
+		while pending:
+			actor_id, n = pending[0]
+			if self.started and 0 < self.target_replay_ratio and update_num < self.required_update_num(
+			    self.released_num + n):
+				break
+			pending.popleft()
+			self.released_num += n
+			self.semaphores[actor_id].release()
+
+	def ahead(self):
+		"""Learner が追加済みの遷移に対して目標の比率以上に学習していて、新たな遷移を待つべきかどうか."""
+		return self.started and 0 < self.target_replay_ratio and self.required_update_num(
+		    self.inserted_num) <= self.update_num - self.start_update_num
+
+
+class ControlBlock:
+	"""Learner と Actor が毎ステップ参照する終了フラグやカウンタを置く共有メモリ上の制御ブロック.
+
+	mp.Manager の dict と違い読み書きはサーバープロセスとの通信を伴わないただのメモリアクセスになる.
+	各値は int64 で、１つの値を書き込むのは１プロセスのみか、フラグを 0 から 1 にするだけにする.
+	重みを配信する SharedWeights の共有メモリ名も持ち、Actor はこれで接続する.
+	Actor 毎のステップ数と重みの読み込み回数、配信から読み込みまでの遅延の合計も置き、ベンチマークなどから参照できる.
+
+	Args:
+		actor_num: Actor 数、Actor 毎のステップ数の領域を確保する.
+		name: 既存の共有メモリに接続する場合はその名前、None なら新規作成.
+	"""
+
+	value_names = ('quit', 'request_quit', 'Q_state_dict_stored', 'train_num', 'inserted_num') # 値の並び
+	weights_name_size = 64 # SharedWeights の共有メモリ名の最大バイト数
+
+	def __init__(self, actor_num, name=None):
+		self.actor_num = actor_num
+		self.owner = name is None
+		nbytes = 64 + self.weights_name_size + actor_num * 8 * 3
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+			self.shm.buf[:nbytes] = bytes(nbytes)
+		else:
+			self.shm = attach_shared_memory(name)
+		self.values = np.ndarray((len(self.value_names),), dtype=np.int64, buffer=self.shm.buf)
+		self.weights_name_buf = np.ndarray((self.weights_name_size,), dtype=np.uint8, buffer=self.shm.buf, offset=64)
+		offset = 64 + self.weights_name_size
+		self.actor_steps = np.ndarray((actor_num,), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+		offset += actor_num * 8
+		self.actor_sync_num = np.ndarray((actor_num,), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+		offset += actor_num * 8
+		self.actor_sync_latency = np.ndarray((actor_num,), dtype=np.float64, buffer=self.shm.buf, offset=offset) # 秒の合計
+
+	def __getstate__(self):
+		return self.actor_num, self.shm.name
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	@property
+	def quit(self):
+		"""Learner などの全プロセスへの終了指示."""
+		return bool(self.values[0])
+
+	@quit.setter
+	def quit(self, value):
+		self.values[0] = int(value)
+
+	@property
+	def request_quit(self):
+		"""Actor からの終了要求、１つの Actor が立てると全 Actor が終了する."""
+		return bool(self.values[1])
+
+	@request_quit.setter
+	def request_quit(self, value):
+		self.values[1] = int(value)
+
+	@property
+	def Q_state_dict_stored(self):
+		"""Learner が最初の重みを配信したかどうか."""
+		return bool(self.values[2])
+
+	@Q_state_dict_stored.setter
+	def Q_state_dict_stored(self, value):
+		self.values[2] = int(value)
+
+	@property
+	def train_num(self):
+		"""Learner の通算学習回数."""
+		return int(self.values[3])
+
+	@train_num.setter
+	def train_num(self, value):
+		self.values[3] = value
+
+	@property
+	def inserted_num(self):
+		"""Learner がリプレイメモリへ追加した通算遷移数."""
+		return int(self.values[4])
+
+	@inserted_num.setter
+	def inserted_num(self, value):
+		self.values[4] = value
+
+	@property
+	def weights_name(self):
+		"""SharedWeights の共有メモリ名."""
+		return self.weights_name_buf.tobytes().rstrip(b'\0').decode()
+
+	@weights_name.setter
+	def weights_name(self, value):
+		b = value.encode()
+		if self.weights_name_size < len(b):
+			raise ValueError(f'Shared memory name too long: {value}')
+		self.weights_name_buf[:] = 0
+		self.weights_name_buf[:len(b)] = np.frombuffer(b, np.uint8)
+
+	def close(self):
+		self.values = None
+		self.weights_name_buf = None
+		self.actor_steps = None
+		self.actor_sync_num = None
+		self.actor_sync_latency = None
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+class SnapshotChannel:
+	"""Actor の最新の状態や推論結果を表示用プロセスへ渡す共有メモリ上のスナップショット.
+
+	Actor 毎に１スロットを持ち、書き込みは上書きのみで表示側が読み逃しても Actor は待たない.
+	スロット毎のシーケンス番号を書き込み中は奇数にするシーケンスロックで、読み出し側は一貫した内容を得る.
+
+	Args:
+		fields: (名前, 形状, dtype) のリスト、フレームや Q 値、中間出力などに対応する.
+		actor_num: Actor 数.
+		name: 既存の共有メモリに接続する場合はその名前、None なら新規作成.
+	"""
+
+	def __init__(self, fields, actor_num, name=None):
+		self.fields = [(field_name, tuple(shape), np.dtype(dtype)) for field_name, shape, dtype in fields]
+		self.actor_num = actor_num
+		self.owner = name is None
+
+		# レイアウト計算、各領域は 64 バイト境界に揃える
+		def align(n):
+			return (n + 63) // 64 * 64
+
+		layout = []
+		offset = align(actor_num * 8) # シーケンス番号
+		for _, shape, dtype in self.fields:
+			layout.append((offset, (actor_num,) + shape, dtype))
+			offset = align(offset + actor_num * int(np.prod(shape, dtype=np.int64)) * dtype.itemsize)
+		self.layout = layout
+		self.nbytes = offset
+
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+			self.shm.buf[:self.nbytes] = bytes(self.nbytes)
+		else:
+			self.shm = attach_shared_memory(name)
+		self.seq = np.ndarray((actor_num,), dtype=np.int64, buffer=self.shm.buf)
+		self.arrays = [np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset) for offset, shape, dtype in layout]
+
+	def __getstate__(self):
+		return self.fields, self.actor_num, self.shm.name
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def version(self, actor_id):
+		"""指定 Actor がこれまでに書き込んだ回数を取得する."""
+		return int(self.seq[actor_id]) // 2
+
+	def publish(self, actor_id, values):
+		"""指定 Actor のスロットへ fields と同じ並びの値を書き込む、スロット毎の書き込み側は１プロセスのみ."""
+		seq = self.seq
+		seq[actor_id] += 1
+		for a, v in zip(self.arrays, values):
+			a[actor_id] = v
+		seq[actor_id] += 1
+
+	def read(self, actor_id):
+		"""指定 Actor のスロットのコピーを取得する、書き込みと重なったらやり直す.
+
+		Returns:
+			(バージョン, 配列のリスト) のタプル.
+		"""
+		while True:
+			seq = int(self.seq[actor_id])
+			if seq & 1:
+				time.sleep(0)
+				continue
+			values = [a[actor_id].copy() for a in self.arrays]
+			if int(self.seq[actor_id]) == seq:
+				return seq // 2, values
+
+	def close(self):
+		self.seq = None
+		self.arrays = None
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import time
+import multiprocessing as mp
+from argparse import ArgumentParser
+import numpy as np
+
+import replay
+import transport
+
+arg_parser = ArgumentParser(prog="transport_benchmark.py")
+arg_parser.add_argument("--actors", default="1,2,4,8", type=str, help="Comma separated numbers of actor processes")
+arg_parser.add_argument("--batches", default=200, type=int, help="Number of batches each actor sends")
+arg_parser.add_argument("--batch-size", default=16, type=int, help="Transitions per batch")
+arg_parser.add_argument("--state-shape", default="5,80,90", type=str, help="State shape (frames,height,width)")
+arg_parser.add_argument("--slots", default=64, type=int, help="Number of shared memory slots")
+args = arg_parser.parse_args()
+
+
+def make_batch(fields):
+	"""ダミーの遷移バッチを作成する."""
+	arrays = [np.random.random_sample(shape).astype(dtype) for shape, dtype in fields]
+	return arrays[0], tuple(arrays[1:])
+
+
+def producer(queue, fields, batches, ready, start):
+	item = make_batch(fields)
+	ready.release()
+	start.wait()
+	for _ in range(batches):
+		queue.put(item)
+
+
+def run(queue, fields, actor_num, batches, consume):
+	"""actor_num 個のプロセスから送り、全て受け取るまでの時間を計測する."""
+	ready = mp.Semaphore(0)
+	start = mp.Event()
+	procs = [mp.Process(target=producer, args=(queue, fields, batches, ready, start)) for _ in range(actor_num)]
+	for p in procs:
+		p.start()
+	for p in procs:
+		ready.acquire()
+	t = time.perf_counter()
+	start.set()
+	received = 0
+	total = actor_num * batches
+	while received < total:
+		n = consume()
+		if n == 0:
+			time.sleep(0.0001)
+		received += n
+	elapsed = time.perf_counter() - t
+	for p in procs:
+		p.join()
+	return elapsed
+
+
+if __name__ == "__main__":
+	state_shape = tuple(int(s) for s in args.state_shape.split(','))
+	fields = replay.get_batch_fields({}, state_shape, args.batch_size)
+	scratch = [np.empty(shape, dtype) for shape, dtype in fields]
+
+	def store(priorities, batch):
+		# Learner がリプレイメモリへコピーするのに相当する処理
+		for d, v in zip(scratch, (priorities,) + batch):
+			d[:len(v)] = v
+
+	mp_manager = mp.Manager()
+
+	for actor_num in [int(s) for s in args.actors.split(',')]:
+		transitions = actor_num * args.batches * args.batch_size
+
+		manager_queue = mp_manager.Queue()
+
+		def consume_manager_queue():
+			n = 0
+			while manager_queue.qsize():
+				store(*manager_queue.get())
+				n += 1
+			return n
+
+		t_mq = run(manager_queue, fields, actor_num, args.batches, consume_manager_queue)
+
+		shm_queue = transport.SharedMemoryQueue(fields, args.slots)
+		t_shm = run(shm_queue, fields, actor_num, args.batches, lambda: shm_queue.drain(store))
+		shm_queue.close()
+
+		print(f'actors: {actor_num:>3} manager queue: {transitions / t_mq:10.0f} transitions/s '
+		      f'shared memory: {transitions / t_shm:10.0f} transitions/s speedup: {t_mq / t_shm:6.1f}x')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import time
+from argparse import ArgumentParser
+import numpy as np
+
+import trade_environment
+import action_suggester
+import synthetic_data
+
+arg_parser = ArgumentParser(prog="turning_points_benchmark.py")
+arg_parser.add_argument("--data", default=None, type=str, help="Binary history file, a synthetic one is generated if omitted")
+arg_parser.add_argument("--records", default=200000, type=int, help="Number of records of the synthetic history file")
+arg_parser.add_argument("--seed", default=0, type=int, help="Random seed of the synthetic history file")
+arg_parser.add_argument("--gaps", default="5,15,50", type=str, help="Comma separated turning point thresholds")
+arg_parser.add_argument("--random-lengths", default="1,2,10,1000", type=str, help="Comma separated lengths of random walks for equivalence check")
+arg_parser.add_argument("--random-num", default=300, type=int, help="Number of random walks per length")
+args = arg_parser.parse_args()
+
+
+def detect_turning_points_original(values, gap):
+	"""従来の detect_turning_points、比較用."""
+	indices = []
+	stalkers = np.empty((len(values),), dtype=np.int32)
+	last_value = int(values[0])
+	stalker = last_value
+	stalkers[0] = stalker
+	last_i = 0
+	for i in range(1, len(values)):
+		v = int(values[i])
+		up = last_value < stalker and stalker <= v
+		down = stalker < last_value and v <= stalker
+		if up or down:
+			delta_array = values[last_i:i + 1]
+			tpi = last_i + int(np.argmin(delta_array) if up else np.argmax(delta_array))
+			tpv = int(values[tpi])
+			indices.append(tpi)
+			last_i = i
+			stalker = tpv - gap if up else tpv + gap
+		else:
+			d = v - stalker
+			if d < -gap:
+				stalker = v + gap
+			elif gap < d:
+				stalker = v - gap
+		stalkers[i] = stalker
+		last_value = v
+	return np.array(indices, dtype=np.int32), stalkers
+
+
+def same(a, b):
+	return np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
+
+
+if __name__ == "__main__":
+	print(f'numba: {"enabled" if action_suggester.njit is not None else "not available, pure python fallback"}')
+	gaps = [int(s) for s in args.gaps.split(',')]
+
+	# ランダムウォークでの一致確認、同値が続く場合も含める
+	rng = np.random.default_rng(0)
+	mismatch = 0
+	total = 0
+	for n in [int(s) for s in args.random_lengths.split(',')]:
+		for _ in range(args.random_num):
+			values = np.cumsum(rng.integers(-3, 4, size=n)).astype(np.int32)
+			for gap in gaps:
+				mismatch += not same(detect_turning_points_original(values, gap), action_suggester.detect_turning_points(values, gap))
+				total += 1
+	print(f'random walk mismatches: {mismatch} / {total}')
+
+	if args.data is None:
+		tmpdir, args.data = synthetic_data.write_temporary(args.records, seed=args.seed)
+	records = trade_environment.read_records(args.data)
+	episodes = trade_environment.get_separation_indices(records)
+	c = trade_environment.values_view_from_records(records)[:, 3]
+	for gap in gaps:
+		# エピソード毎の従来の検出
+		t = time.perf_counter()
+		expected = [detect_turning_points_original(c[i1:i2], gap) for i1, i2 in zip(episodes[:-1], episodes[1:])]
+		t_original = time.perf_counter() - t
+
+		# エピソード毎の新しい検出
+		action_suggester.detect_turning_points(c[episodes[0]:episodes[1]], gap) # Numba のコンパイルを除外する
+		t = time.perf_counter()
+		actual = [action_suggester.detect_turning_points(c[i1:i2], gap) for i1, i2 in zip(episodes[:-1], episodes[1:])]
+		t_new = time.perf_counter() - t
+
+		# 全エピソード一括の検出
+		action_suggester.detect_turning_points_episodes(c, episodes[:2], gap)
+		t = time.perf_counter()
+		batch_indices, batch_stalkers = action_suggester.detect_turning_points_episodes(c, episodes, gap)
+		t_batch = time.perf_counter() - t
+
+		mismatch = sum(not same(e, a) for e, a in zip(expected, actual))
+		mismatch += sum(not same(e, (bi, batch_stalkers[i1:i2]))
+		                for e, bi, i1, i2 in zip(expected, batch_indices, episodes[:-1], episodes[1:]))
+		n = episodes[-1] - episodes[0]
+		print(f'gap: {gap:>4} mismatches: {mismatch} original: {n / t_original:12.0f} values/s '
+		      f'new: {n / t_new:12.0f} values/s ({t_original / t_new:6.1f}x) '
+		      f'batch: {n / t_batch:12.0f} values/s ({t_original / t_batch:6.1f}x)')
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+import cv2
+import torch
+import matplotlib.pyplot as plt
+
+import trade_environment
+import model
+
+
+def get_snapshot_fields(params):
+	"""SnapshotChannel の fields を取得する.
+
+	先頭はフレームを合計した画像と Q 値で、続いて model の plot_* フックで取り出される中間出力が並ぶ.
+	中間出力の形状はモデルを生成してダミーの入力で１回推論して調べる.
+	"""
+	lp = params['learner']
+	state_shape = tuple(params['env']['frames_height_width'])
+	action_dim = trade_environment.action_num
+
+	model.capture_enabled = True
+	try:
+		Q = eval(f'model.{lp["model"]}(state_shape, action_dim, hidden_size={lp["hidden_size"]})')
+	finally:
+		model.capture_enabled = False
+	model.captured = []
+	try:
+		with torch.no_grad():
+			Q.eval()
+			Q(torch.zeros((1,) + state_shape))
+		captured = model.captured
+	finally:
+		model.captured = None
+
+	fields = [('frame', state_shape[1:], np.float32), ('q', (action_dim,), np.float32)]
+	for i, (kind_name, name, x) in enumerate(captured):
+		fields.append((name if name else f'{kind_name} {i}', x.shape, np.float32))
+	return fields
+
+
+def get_plot_actor_id(params):
+	"""中間出力を取り出してプロットする Actor のID."""
+	ap = params['actor']
+	return min(ap.get('viewer_actor', 7), ap['num_actors'] - 1)
+
+
+def run(params, control, snapshots):
+	"""Actor が書き込んだスナップショットを最大 viewer_fps の頻度で表示する.
+
+	Actor 毎のフレームを cv2 のウィンドウへ、get_plot_actor_id の Actor の中間出力と Q 値を matplotlib へ描画する.
+	ESC キーで全 Actor に終了を要求し、Learner などと同じく control.quit で終了する.
+	"""
+	ap = params['actor']
+	interval = 1.0 / ap['viewer_fps']
+	plot_actor_id = get_plot_actor_id(params)
+	fields = snapshots.fields
+
+	# 中間出力と Q 値を１つの figure に並べる
+	plot_fields = fields[2:] + fields[1:2]
+	fig = plt.figure()
+	fig.suptitle(f'Actor# {plot_actor_id}', fontsize=12)
+	h, w = model.calc_width_height(len(plot_fields))
+	axes = [fig.add_subplot(h, w, i + 1) for i in range(len(plot_fields))]
+	x_data = np.arange(fields[1][1][0])
+
+	versions = [0] * snapshots.actor_num
+	while not control.quit:
+		t = time.perf_counter()
+		for actor_id in range(snapshots.actor_num):
+			version, values = snapshots.read(actor_id)
+			if version == versions[actor_id]:
+				continue
+			versions[actor_id] = version
+
+			img = values[0]
+			m = img.max()
+			if 0 < m:
+				img *= 1.0 / m
+			cv2.imshow(f'Actor# {actor_id}', img)
+
+			if actor_id == plot_actor_id:
+				for ax, (name, shape, _), x in zip(axes, plot_fields, values[2:] + values[1:2]):
+					ax.cla()
+					if len(shape) == 1 and len(x) == len(x_data):
+						ax.plot(x_data, x)
+					elif len(shape) == 1:
+						ax.imshow(x.reshape(model.calc_width_height(x.size)))
+					else:
+						ax.imshow(x)
+					ax.set_title(name)
+				plt.pause(0.001)
+
+		if cv2.waitKey(1) == 27:
+			control.request_quit = True
+
+		time.sleep(max(0.0, interval - (time.perf_counter() - t)))
+
+	cv2.destroyAllWindows()
+	plt.close(fig)
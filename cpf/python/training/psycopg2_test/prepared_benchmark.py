@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import datetime
+from argparse import ArgumentParser
+import psycopg2
+
+# auto_trade の db 層を計測する、このディレクトリの db.py は古い版なので auto_trade を優先する
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'auto_trade'))
+import db
+import tables
+
+arg_parser = ArgumentParser(prog="prepared_benchmark.py")
+arg_parser.add_argument("--connection-string", default="dbname=auto_trade user=postgres", type=str, help="Connection string")
+arg_parser.add_argument("--rows", default=20000, type=int, help="Number of records inserted into the benchmark table")
+arg_parser.add_argument("--queries", default=5000, type=int, help="Number of repeated queries")
+arg_parser.add_argument("--batch-sizes", default="10,100,1000", type=str, help="Comma separated record counts per get_inserts call")
+args = arg_parser.parse_args()
+
+
+def get_inserts_old(tbl):
+	"""従来の get_inserts、呼び出し毎にレコード数分の (%s,...) を持つ SQL を組み立てる."""
+	cols = ','.join([c.name for c in tbl.get_cols()])
+	sql = f'INSERT INTO {tbl._name}({cols}) VALUES'
+
+	def insert(cursor, records):
+		values = []
+		params = []
+		for r in records:
+			values.append(f'({",".join(["%s" for _ in r])})')
+			params.extend(r)
+		cursor.execute(sql + ",".join(values), params)
+
+	return insert
+
+
+def read_old(buildable, cursor, *params):
+	"""従来の SqlBuildable.read、呼び出し毎に SQL とレコード型を作り直す."""
+	rt = buildable.build_record_type()
+	forward_buffer = []
+	buildable.build(forward_buffer, [])
+	cursor.execute('\n'.join(forward_buffer), params)
+	for r in cursor:
+		yield rt(*r)
+
+
+def make_records(record_type, num):
+	now = datetime.datetime.now()
+	return [
+	    record_type(1, i % 8, now, i, i // 100, i % 50, i % 1000, i % 4, (i + 1) % 4, 0.5, i % 4, (i + 2) % 4, i % 1000, float(i))
+	    for i in range(num)
+	]
+
+
+def measure(name, count, func):
+	t = time.perf_counter()
+	func()
+	t = time.perf_counter() - t
+	print(f'{name:>40}: {count / t:10.0f} /s')
+	return t
+
+
+if __name__ == "__main__":
+	conn = psycopg2.connect(args.connection_string)
+	conn.autocommit = True
+	cur = conn.cursor()
+
+	ad = tables.ActorData()
+	ad._name = 'actor_data_prepared_benchmark'
+	record_type = ad.get_record_type()
+	records = make_records(record_type, args.rows)
+
+	# 複数レコードの INSERT
+	for batch_size in [int(s) for s in args.batch_sizes.split(',')]:
+		batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+		for name, inserts in (('old', get_inserts_old(ad)), ('execute_values', ad.get_inserts())):
+			cur.execute(ad.get_drop_statement() + ad.get_create_statement() + ad.get_create_partition_statement(1))
+			measure(f'inserts {name} batch {batch_size} rows', len(records), lambda: [inserts(cur, b) for b in batches])
+
+	# １レコードの INSERT
+	for prepared in (False, True):
+		cur.execute(ad.get_drop_statement() + ad.get_create_statement() + ad.get_create_partition_statement(1))
+		insert = ad.get_insert(prepared=prepared)
+		n = min(args.queries, len(records))
+		measure(f'insert prepared={prepared} rows', n, lambda: [insert(cur, r) for r in records[:n]])
+
+	cur.execute(ad.get_drop_statement() + ad.get_create_statement() + ad.get_create_partition_statement(1))
+	ad.get_inserts()(cur, records)
+	cur.execute(f'CREATE INDEX ON {ad._name}(train_num);ANALYZE {ad._name};')
+
+	# 繰り返しの検索
+	filter = lambda c: c.name in ('param_set_id', 'actor_id', 'train_num')
+	keys = [(r.param_set_id, r.actor_id, r.train_num) for r in records[:args.queries]]
+	for prepared in (False, True):
+		find = ad.get_find([ad.ep_count, ad.reward], filter, prepared=prepared)
+		measure(f'find prepared={prepared} queries', len(keys), lambda: [find(cur, k) for k in keys])
+		is_exists = ad.get_is_exists(filter, prepared=prepared)
+		measure(f'is_exists prepared={prepared} queries', len(keys), lambda: [is_exists(cur, k) for k in keys])
+
+	# SqlBuildable.read の繰り返し
+	s = db.select([ad.train_num, ad.ep_count, ad.reward]).frm(ad).where('train_num=%s')
+	train_nums = [r.train_num for r in records[:args.queries]]
+	measure('read old queries', len(train_nums), lambda: [list(read_old(s, cur, n)) for n in train_nums])
+	measure('read cached queries', len(train_nums), lambda: [list(s.read(cur, n)) for n in train_nums])
+	measure('read cached prepared queries', len(train_nums), lambda: [list(s.read(cur, n, prepared=True)) for n in train_nums])
+
+	cur.execute(ad.get_drop_statement())
+	conn.close()